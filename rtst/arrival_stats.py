@@ -0,0 +1,90 @@
+from array import array
+
+##########################################################################################################
+## Report inter-arrival statistics
+##
+##   The read thread timestamps every report as it comes off the device.  ArrivalStats keeps, per
+##   message type, a fixed-bin histogram of the time between consecutive reports of that type, so
+##   percentiles can be read at any time without storing samples.  Default bins are 25 us wide and
+##   cover 0 - 20 ms; anything longer lands in an overflow bin (max is still exact).
+##########################################################################################################
+class InterArrivalHistogram:
+    def __init__(self, bin_width_us=25, num_bins=800):
+        self.bin_width_ns = bin_width_us * 1000
+        self.num_bins = num_bins
+
+        # Last bin counts everything past the end of the range
+        self.bins = array('Q', bytes(8 * (num_bins + 1)))
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def add(self, delta_ns):
+        index = delta_ns // self.bin_width_ns
+        if index >= self.num_bins:
+            index = self.num_bins
+        self.bins[index] += 1
+        self.count += 1
+        self.total_ns += delta_ns
+        if delta_ns > self.max_ns:
+            self.max_ns = delta_ns
+
+    # Upper edge of the bin holding the p-th percentile, in us
+    def percentile(self, p):
+        if not self.count:
+            return 0.
+
+        target = self.count * p / 100.
+        seen = 0
+        for index, n in enumerate(self.bins):
+            seen += n
+            if seen >= target:
+                if index == self.num_bins:
+                    return self.max_ns / 1000.
+                return (index + 1) * self.bin_width_ns / 1000.
+        return self.max_ns / 1000.
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_us': self.total_ns / self.count / 1000. if self.count else 0.,
+            'p50_us': self.percentile(50),
+            'p95_us': self.percentile(95),
+            'p99_us': self.percentile(99),
+            'max_us': self.max_ns / 1000.,
+        }
+
+class ArrivalStats:
+    def __init__(self, bin_width_us=25, num_bins=800):
+        self.bin_width_us = bin_width_us
+        self.num_bins = num_bins
+
+        # msg_type: last arrival time (ns) / histogram
+        self.last_arrival_ns = {}
+        self.histograms = {}
+
+    # Called from the read thread for every report
+    def add(self, msg_type, arrival_ns):
+        last = self.last_arrival_ns.get(msg_type)
+        self.last_arrival_ns[msg_type] = arrival_ns
+        if last is None:
+            return
+
+        histogram = self.histograms.get(msg_type)
+        if histogram is None:
+            histogram = self.histograms[msg_type] = InterArrivalHistogram(self.bin_width_us, self.num_bins)
+        histogram.add(arrival_ns - last)
+
+    # {msg_type: summary dict}
+    def get_stats(self):
+        return {msg_type: histogram.summary() for msg_type, histogram in list(self.histograms.items())}
+
+    # Message type with the most reports, i.e. the main state stream
+    def busiest_type(self):
+        best = None
+        best_count = 0
+        for msg_type, histogram in list(self.histograms.items()):
+            if histogram.count > best_count:
+                best = msg_type
+                best_count = histogram.count
+        return best
@@ -0,0 +1,170 @@
+import re
+import math
+import struct
+
+import numpy as np
+
+from valve_message_handler import ValveMessageHandler, valve_message_layouts, message_types_with
+from hid_capture import read_capture
+
+##########################################################################################################
+## Vectorized batch decoder
+##
+##   Decodes many raw input reports at once into one NumPy structured array per message type, for
+##   offline analysis of captures (see hid_capture.py).  The dtypes are generated from the
+##   valve_messages layouts ValveMessageHandler uses, field offsets included, so the two decoders
+##   can't drift apart.  Derived fields (roll / pitch / yaw, deadzoned sticks, stick noise) are
+##   computed as whole columns by add_derived_fields().
+##
+##   Unlike ValveMessageHandler nothing is merged across message types; each array holds exactly the
+##   fields of its own message.
+##
+##   Needs NumPy, which is an optional dependency (pip install numpy); the live tool runs without it.
+##########################################################################################################
+
+HEADER_SIZE = ValveMessageHandler.HEADER_SIZE
+REPORT_WIDTH = ValveMessageHandler.RX_BUFFER_SIZE
+
+format_item = re.compile(r'(\d*)([xcbB?hHiIlLqQnNefdsp])')
+
+# Structured dtype matching a native-mode struct format, with the same field offsets
+def layout_dtype(layout):
+    msg_format = layout.struct.format
+    names = []
+    formats = []
+    offsets = []
+
+    prefix = ''
+    index = 0
+    for (count, code) in format_item.findall(msg_format):
+        for i in range(int(count) if count else 1):
+            if code != 'x':
+                names.append(layout.field_names[index])
+                formats.append(np.dtype(code))
+                offsets.append(struct.calcsize(prefix + code) - struct.calcsize(code))
+                index += 1
+            prefix += code
+
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': layout.struct.size})
+
+message_dtypes = {msg_type: layout_dtype(layout) for msg_type, layout in valve_message_layouts.items()}
+
+# Pack reports (bytes-like, any length) into an (N, REPORT_WIDTH) uint8 array, zero padded the way
+# ValveMessageHandler pads its receive buffer.  Reports shorter than a header plus one byte are
+# dropped, as the live decoder ignores them.
+def reports_to_array(reports):
+    reports = [report[:REPORT_WIDTH] for report in reports if len(report) >= HEADER_SIZE + 1]
+    raw = np.zeros((len(reports), REPORT_WIDTH), dtype=np.uint8)
+    for (i, report) in enumerate(reports):
+        raw[i, :len(report)] = np.frombuffer(report, dtype=np.uint8)
+    return raw
+
+# raw is an (N, width) uint8 array of reports, width >= REPORT_WIDTH for messages with long
+# payloads.  Returns ({msg_type: structured array}, {msg_type: row indices into raw}); unknown
+# types and other message versions are skipped like the live decoder does.
+def decode_array(raw):
+    raw = np.asarray(raw, dtype=np.uint8)
+    if raw.ndim != 2 or raw.shape[1] < HEADER_SIZE:
+        raise ValueError('Expected an (N, width) array of reports')
+
+    version = np.ascontiguousarray(raw[:, 0:2]).view(np.uint16).reshape(-1)
+    msg_types = np.where(version == 1, raw[:, 2], -1)
+
+    messages = {}
+    rows = {}
+    for msg_type in np.unique(msg_types):
+        dtype = message_dtypes.get(int(msg_type))
+        if dtype is None:
+            continue
+
+        index = np.flatnonzero(msg_types == msg_type)
+        payload = raw[index, HEADER_SIZE:HEADER_SIZE + dtype.itemsize]
+        if payload.shape[1] < dtype.itemsize:
+            payload = np.pad(payload, ((0, 0), (0, dtype.itemsize - payload.shape[1])))
+        messages[int(msg_type)] = np.ascontiguousarray(payload).view(dtype).reshape(-1)
+        rows[int(msg_type)] = index
+
+    return (messages, rows)
+
+def decode_reports(reports):
+    return decode_array(reports_to_array(reports))
+
+# Decode a capture file.  Returns ({msg_type: structured array}, {msg_type: arrival ns array}).
+def decode_capture(path):
+    records = read_capture(path)
+    (messages, rows) = decode_reports([report for (timestamp_ns, report) in records])
+
+    timestamps = np.array([timestamp_ns for (timestamp_ns, report) in records
+                           if len(report) >= HEADER_SIZE + 1], dtype=np.uint64)
+    return (messages, {msg_type: timestamps[index] for msg_type, index in rows.items()})
+
+##########################################################################################################
+## Derived fields
+##########################################################################################################
+# Vectorized ValveMessageHandler.euler(): (roll, pitch, yaw) in degrees, rounded to 0.01
+def euler(q0, q1, q2, q3):
+    degrees = 360. / (2 * math.pi)
+
+    pitch = np.round(degrees * np.arctan2(2 * (q0 * q1 + q2 * q3), 1 - 2 * (q1 * q1 + q2 * q2)), 2)
+    roll = np.round(degrees * np.arcsin(np.clip(2 * (q0 * q2 - q3 * q1), -1., 1.)), 2)
+    yaw = np.round(degrees * np.arctan2(2 * (q0 * q3 + q1 * q2), 1 - 2 * (q2 * q2 + q3 * q3)), 2)
+    return (roll, pitch, yaw)
+
+# Stick pair with both axes inside the deadzone zeroed, as in ValveMessageHandler
+def deadzone(x, y, stick_deadzone):
+    inside = (x < stick_deadzone) & (x > -stick_deadzone) & (y < stick_deadzone) & (y > -stick_deadzone)
+    return (np.where(inside, 0, x), np.where(inside, 0, y))
+
+# Rolling sample stdev (n - 1) of the last `window` values, as RunningWindowStats.  NaN for the
+# first value, where ValveMessageHandler leaves the field out.
+def rolling_stdev(values, window):
+    values = values.astype(np.int64)
+    total = np.concatenate(([0], np.cumsum(values)))
+    total_sq = np.concatenate(([0], np.cumsum(values * values)))
+    end = np.arange(1, len(values) + 1)
+    start = np.maximum(end - window, 0)
+    n = end - start
+    s = total[end] - total[start]
+    sq = total_sq[end] - total_sq[start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variance = (n * sq - s * s) / (n * (n - 1.))
+    return np.where(n > 1, np.sqrt(np.maximum(variance, 0.)), np.nan)
+
+# Derived inputs, named and required as ValveMessageHandler declares them, so both decoders derive
+# for the same message types
+EULER_FIELDS = ('gyro_quat_w', 'gyro_quat_x', 'gyro_quat_y', 'gyro_quat_z')
+STICK_FIELDS = ('left_stick_x', 'left_stick_y', 'right_stick_x', 'right_stick_y')
+# (field, key) of the stick noise the handler tracks by default, log2 scaled over len_history samples
+NOISE_FIELDS = (('left_x', 'l_x_stdev'), ('left_y', 'l_y_stdev'), ('right_x', 'r_x_stdev'), ('right_y', 'r_y_stdev'))
+NOISE_WINDOW = 128
+
+# Return a copy of a message array with the fields ValveMessageHandler derives for its type added:
+# roll / pitch / yaw, the dz_* sticks and the *_stdev stick noise.  Noise is over this array only,
+# in its order.  Message types with none of the inputs are returned unchanged.
+def add_derived_fields(msg_type, messages, stick_deadzone=ValveMessageHandler.STICK_DEADZONE):
+    columns = {}
+    if msg_type in message_types_with(EULER_FIELDS):
+        q = [messages[name] / 32768. for name in EULER_FIELDS]
+        (columns['roll'], columns['pitch'], columns['yaw']) = euler(*q)
+
+    if msg_type in message_types_with(STICK_FIELDS):
+        for side in ('left', 'right'):
+            (x, y) = ('{}_stick_x'.format(side), '{}_stick_y'.format(side))
+            (columns['dz_' + x], columns['dz_' + y]) = deadzone(messages[x], messages[y], stick_deadzone)
+
+    for (field, key) in NOISE_FIELDS:
+        if msg_type in message_types_with((field,)):
+            columns[key] = np.round(np.log2(rolling_stdev(messages[field], NOISE_WINDOW) + 1) * 10)
+
+    if not columns:
+        return messages
+
+    names = messages.dtype.names
+    dtype = np.dtype([(name, messages.dtype.fields[name][0]) for name in names] +
+                     [(name, column.dtype) for name, column in columns.items()])
+    result = np.empty(len(messages), dtype=dtype)
+    for name in names:
+        result[name] = messages[name]
+    for name, column in columns.items():
+        result[name] = column
+    return result
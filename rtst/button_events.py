@@ -0,0 +1,164 @@
+import collections
+
+from packet_ring import PacketRingBuffer
+
+##########################################################################################################
+## Button bits
+##
+##   (name, field, mask) of every known button in the buttons_0 / buttons_1 words of the controller
+##   state messages (see steamcontrollerpublic.h).  Unnamed bits get a name like 'buttons_0_bit27'.
+##########################################################################################################
+button_bits = (
+    ('trigger_right',           'buttons_0', 0x00000001),
+    ('trigger_left',            'buttons_0', 0x00000002),
+    ('bumper_right',            'buttons_0', 0x00000004),
+    ('bumper_left',             'buttons_0', 0x00000008),
+    ('y',                       'buttons_0', 0x00000010),
+    ('b',                       'buttons_0', 0x00000020),
+    ('x',                       'buttons_0', 0x00000040),
+    ('a',                       'buttons_0', 0x00000080),
+    ('up',                      'buttons_0', 0x00000100),
+    ('right',                   'buttons_0', 0x00000200),
+    ('left',                    'buttons_0', 0x00000400),
+    ('down',                    'buttons_0', 0x00000800),
+    ('select',                  'buttons_0', 0x00001000),
+    ('steam',                   'buttons_0', 0x00002000),
+    ('start',                   'buttons_0', 0x00004000),
+    ('grip_left',               'buttons_0', 0x00008000),
+    ('grip_right',              'buttons_0', 0x00010000),
+    ('padclick_left',           'buttons_0', 0x00020000),
+    ('padclick_right',          'buttons_0', 0x00040000),
+    ('finger_present_left',     'buttons_0', 0x00080000),
+    ('finger_present_right',    'buttons_0', 0x00100000),
+    ('battery_low',             'buttons_0', 0x00200000),
+    ('thumbstick_left_button',  'buttons_0', 0x00400000),
+    ('thumbstick_right_button', 'buttons_0', 0x04000000),
+
+    ('grip2_left',              'buttons_1', 0x00000200),
+    ('grip2_right',             'buttons_1', 0x00000400),
+    ('thumbstick_left_touch',   'buttons_1', 0x00004000),
+    ('thumbstick_right_touch',  'buttons_1', 0x00008000),
+    ('alt_guide',               'buttons_1', 0x00040000),
+)
+
+# name: mask within its own word
+button_masks = {name: mask for (name, field, mask) in button_bits}
+
+button_fields = ('buttons_0', 'buttons_1')
+
+# Name of every bit of each word, indexed [word][bit]
+button_bit_names = []
+for (word, field) in enumerate(button_fields):
+    names = ['{}_bit{}'.format(field, bit) for bit in range(32)]
+    for (name, bit_field, mask) in button_bits:
+        if bit_field == field:
+            names[mask.bit_length() - 1] = name
+    button_bit_names.append(tuple(names))
+
+# name: (field, mask) of every bit, named or not
+button_bit_fields = {name: (field, 1 << bit)
+                     for (field, names) in zip(button_fields, button_bit_names) for (bit, name) in enumerate(names)}
+
+# One press or release.  duration_ns / duration_packets is how long the button was in its
+# previous state (held, for a release), None for a button's first edge.  bounce is set when that
+# was shorter than the tracker's bounce window.
+ButtonEvent = collections.namedtuple('ButtonEvent',
+    ('time_ns', 'packet_num', 'button', 'pressed', 'duration_ns', 'duration_packets', 'bounce'))
+
+##########################################################################################################
+## Button edge events
+##
+##   Fed the button words of every controller state message by the read thread, so presses shorter
+##   than a UI frame still show up.  Changed bits are found by XOR with the previous words; a
+##   message with no change costs two compares.  Each edge is published as a ButtonEvent into a
+##   bounded PacketRingBuffer (read it with a cursor) and counted per button:
+##     presses / releases, shortest and longest press, and bounces (an edge less than
+##     bounce_packets frames after the button's previous edge, i.e. contact chatter or a glitch).
+##   Bounces are judged on the controller's frame counter, which unlike host time isn't squeezed
+##   by batched reads or by replaying a capture.
+##
+##   The words of the first message only set the starting state; buttons already held then don't
+##   produce presses.
+##########################################################################################################
+class ButtonEventTracker:
+    def __init__(self, queue_size=4096, bounce_packets=5):
+        self.bounce_packets = bounce_packets
+        self.event_queue = PacketRingBuffer(queue_size)
+
+        self.words = None
+
+        # button name: (time_ns, packet_num) of its last edge
+        self.last_edge = {}
+
+        # button name: stats dict, see get_stats()
+        self.stats = {}
+
+    # Forget the last button words and edges, so a new connection starts from its own first
+    # message.  Events and stats already published are kept.
+    def reset(self):
+        self.words = None
+        self.last_edge = {}
+
+    # Called from the read thread for every controller state message
+    def update(self, buttons_0, buttons_1, packet_num, time_ns):
+        words = self.words
+        if words is None:
+            self.words = (buttons_0, buttons_1)
+            return
+        if buttons_0 == words[0] and buttons_1 == words[1]:
+            return
+
+        self.words = (buttons_0, buttons_1)
+        for (word, (new, old)) in enumerate(((buttons_0, words[0]), (buttons_1, words[1]))):
+            changed = new ^ old
+            while changed:
+                bit = changed & -changed
+                changed ^= bit
+                self.add_edge(button_bit_names[word][bit.bit_length() - 1], bool(new & bit), packet_num, time_ns)
+
+    def add_edge(self, button, pressed, packet_num, time_ns):
+        stats = self.stats.get(button)
+        if stats is None:
+            stats = self.stats[button] = {
+                'presses': 0,
+                'releases': 0,
+                'bounces': 0,
+                'min_press_ns': None,
+                'max_press_ns': None,
+                'min_press_packets': None,
+            }
+
+        duration_ns = None
+        duration_packets = None
+        bounce = False
+        last_edge = self.last_edge.get(button)
+        if last_edge:
+            duration_ns = time_ns - last_edge[0]
+            duration_packets = (packet_num - last_edge[1]) & 0xFFFFFFFF
+            if duration_packets < self.bounce_packets:
+                bounce = True
+                stats['bounces'] += 1
+        self.last_edge[button] = (time_ns, packet_num)
+
+        if pressed:
+            stats['presses'] += 1
+        else:
+            stats['releases'] += 1
+            if duration_ns is not None:
+                if stats['min_press_ns'] is None or duration_ns < stats['min_press_ns']:
+                    stats['min_press_ns'] = duration_ns
+                if stats['max_press_ns'] is None or duration_ns > stats['max_press_ns']:
+                    stats['max_press_ns'] = duration_ns
+                if stats['min_press_packets'] is None or duration_packets < stats['min_press_packets']:
+                    stats['min_press_packets'] = duration_packets
+
+        self.event_queue.push(ButtonEvent(time_ns, packet_num, button, pressed, duration_ns, duration_packets, bounce))
+
+    # Cursor returning every event published after this call (see PacketCursor.read())
+    def new_cursor(self, from_start=False):
+        return self.event_queue.new_cursor(from_start)
+
+    # {button: {'presses', 'releases', 'bounces', 'min_press_ns', 'max_press_ns', 'min_press_packets'}}
+    # for every button that changed state
+    def get_stats(self):
+        return {button: dict(stats) for button, stats in list(self.stats.items())}
@@ -0,0 +1,185 @@
+import collections
+import threading
+import time
+
+##########################################################################################################
+## Device clock to host clock mapping
+##
+##   last_packet_num counts controller frames.  Fitting host arrival time against it over a sliding
+##   window gives the controller's real frame period in host nanoseconds, which maps any packet
+##   number to host time and shows how far the controller clock drifts from its nominal rate.
+##
+##   Reports are only ever delayed by the transport, never early, so the fit is a least-squares line
+##   refitted with outliers (residuals more than reject_k median absolute deviations out) dropped,
+##   then shifted down to the fastest arrival in the window.  That lower envelope is the best
+##   estimate of when each frame left the controller (plus the fixed minimum transport delay, which
+##   can't be observed from the host).  How far each report arrived after the envelope is its
+##   transport latency jitter.
+##
+##   add() is O(1).  With background=True the refit (a few ms over a full window) runs on a worker
+##   thread of its own instead of on the caller, which is the HID read thread; device_time_ns()
+##   keeps using the previous fit until the new one is published, and the worker gives up the GIL
+##   between its passes over the window so the read thread is never held up by a whole refit.
+##   close() stops the worker.
+##########################################################################################################
+class DeviceClockEstimator:
+    # USB frame timing grid used to guess the nominal frame period when none is given
+    NOMINAL_GRID_NS = 125000
+
+    def __init__(self, window=2000, refit_interval=500, reject_k=3.0, nominal_period_ns=None, background=False):
+        self.window = window
+        self.refit_interval = refit_interval
+        self.reject_k = reject_k
+        self.nominal_period_ns = nominal_period_ns
+        self.background = background
+
+        # (unwrapped packet number, arrival ns)
+        self.samples = collections.deque(maxlen=window)
+        self.samples_lock = threading.Lock()
+        self.last_packet_num = None
+        self.wrap_offset = 0
+        self.since_fit = 0
+
+        # Fit: host_ns = origin_ns + (packet_num - origin_packet) * period_ns, published as one
+        # (origin_packet, origin_ns, period_ns) tuple so a reader never sees half of a refit
+        self.fitted = False
+        self.fit_params = (0, 0, 0.)
+        self.period_ns = 0.
+        self.rejected = 0
+        self.latency_mean_ns = 0.
+        self.latency_max_ns = 0.
+
+        self.refit_wake = threading.Event()
+        self.refit_thread = None
+        self.closed = False
+
+    def add(self, packet_num, arrival_ns):
+        if packet_num == self.last_packet_num:
+            return
+
+        # 32-bit counter wrap
+        if self.last_packet_num is not None and packet_num < self.last_packet_num - 0x80000000:
+            self.wrap_offset += 0x100000000
+        self.last_packet_num = packet_num
+
+        with self.samples_lock:
+            self.samples.append((packet_num + self.wrap_offset, arrival_ns))
+        self.since_fit += 1
+        if self.since_fit >= self.refit_interval or (not self.fitted and self.since_fit >= 16):
+            self.since_fit = 0
+            if not self.background:
+                self.fit()
+                return
+
+            if self.refit_thread is None and not self.closed:
+                self.refit_thread = threading.Thread(target=self.__do_refit_thread, daemon=True)
+                self.refit_thread.start()
+            self.refit_wake.set()
+
+    def __do_refit_thread(self):
+        while True:
+            self.refit_wake.wait()
+            self.refit_wake.clear()
+            if self.closed:
+                return
+            self.fit()
+
+    # Stop the refit thread, if any
+    def close(self):
+        self.closed = True
+        self.refit_wake.set()
+
+    def fit(self):
+        with self.samples_lock:
+            samples = list(self.samples)
+        if len(samples) < 16:
+            return
+
+        # Work relative to the first sample to keep the floats small
+        (x0, y0) = samples[0]
+        points = [(x - x0, y - y0) for (x, y) in samples]
+        self.yield_reader()
+
+        (slope, intercept) = self.least_squares(points)
+        if slope <= 0:
+            return
+        self.yield_reader()
+
+        # Drop outliers and refit
+        residuals = [y - (intercept + slope * x) for (x, y) in points]
+        self.yield_reader()
+        median = sorted(residuals)[len(residuals) // 2]
+        self.yield_reader()
+        rejected = 0
+        mad = sorted(abs(r - median) for r in residuals)[len(residuals) // 2]
+        self.yield_reader()
+        if mad > 0:
+            limit = self.reject_k * mad
+            kept = [p for p, r in zip(points, residuals) if abs(r - median) <= limit]
+            rejected = len(points) - len(kept)
+            self.yield_reader()
+            if len(kept) >= 16:
+                (slope, intercept) = self.least_squares(kept)
+                self.yield_reader()
+                residuals = [y - (intercept + slope * x) for (x, y) in points]
+                self.yield_reader()
+
+        # Shift the line down to the earliest arrival
+        floor = min(residuals)
+        latencies = [r - floor for r in residuals]
+
+        self.fit_params = (x0, y0 + intercept + floor, slope)
+        self.rejected = rejected
+        self.period_ns = slope
+        self.latency_mean_ns = sum(latencies) / len(latencies)
+        self.latency_max_ns = max(latencies)
+        self.fitted = True
+
+    # Between the passes of a background refit, hand the GIL to the read thread if it's waiting
+    def yield_reader(self):
+        if self.background:
+            time.sleep(0)
+
+    @staticmethod
+    def least_squares(points):
+        n = len(points)
+        sum_x = sum(x for (x, y) in points)
+        sum_y = sum(y for (x, y) in points)
+        mean_x = sum_x / n
+        mean_y = sum_y / n
+        sxx = sum((x - mean_x) ** 2 for (x, y) in points)
+        if not sxx:
+            return (0., mean_y)
+        sxy = sum((x - mean_x) * (y - mean_y) for (x, y) in points)
+        slope = sxy / sxx
+        return (slope, mean_y - slope * mean_x)
+
+    # Host time (CLOCK_MONOTONIC ns) at which the controller produced packet_num, or None before
+    # the first fit.
+    def device_time_ns(self, packet_num):
+        if not self.fitted:
+            return None
+        if self.last_packet_num is not None and packet_num > self.last_packet_num + 0x80000000:
+            packet_num -= 0x100000000
+        (origin_packet, origin_ns, period_ns) = self.fit_params
+        return int(origin_ns + (packet_num + self.wrap_offset - origin_packet) * period_ns)
+
+    def get_nominal_period_ns(self):
+        if self.nominal_period_ns:
+            return self.nominal_period_ns
+        return max(1, round(self.period_ns / self.NOMINAL_GRID_NS)) * self.NOMINAL_GRID_NS
+
+    def get_stats(self):
+        if not self.fitted:
+            return {}
+
+        nominal = self.get_nominal_period_ns()
+        return {
+            'period_us': self.period_ns / 1000.,
+            'nominal_period_us': nominal / 1000.,
+            'drift_ppm': (self.period_ns - nominal) / nominal * 1e6,
+            'latency_mean_us': self.latency_mean_ns / 1000.,
+            'latency_max_us': self.latency_max_ns / 1000.,
+            'samples': len(self.samples),
+            'rejected': self.rejected,
+        }
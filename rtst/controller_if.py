@@ -2,12 +2,14 @@ import struct
 import logging
 import math
 import os
+import threading
 from time import sleep
 
 logger = logging.getLogger('RTST.CNTRLR')
 
 from hid_dev_mgr import HidDeviceManager
 from valve_message_handler import ValveMessageHandler
+from spectrum_analyzer import SpectrumAnalyzer
 
 class ControllerInterface:
 
@@ -16,9 +18,29 @@ class ControllerInterface:
 
     TIMP_TRACKPAD_CAL_DELAY_S = 1.0
     ## Requires a vid_pid pairs list, and an optional Callback on conneciton
-    def __init__(self, vid_pid_endpoint_list, connect_cb ):
+    ## backend selects the HID transport ('hidapi' or 'hidraw', see hid_dev_mgr.hid_backends)
+    ## batch_read drains all queued input reports per read thread wakeup (see HidDeviceManager)
+    ## read_cpu / read_fifo_priority / read_nice set the read thread's CPU affinity and scheduling
+    def __init__(self, vid_pid_endpoint_list, connect_cb, backend='hidapi', batch_read=False, read_cpu=None, read_fifo_priority=None, read_nice=None):
         self.logger = logging.getLogger('RTST.CNTRLR')
-        self.hid_dev_mgr =  HidDeviceManager(vid_pid_endpoint_list, connect_cb, ValveMessageHandler())
+        self.hid_dev_mgr =  HidDeviceManager(vid_pid_endpoint_list, connect_cb, ValveMessageHandler(), backend=backend, batch_read=batch_read,
+                                             read_cpu=read_cpu, read_fifo_priority=read_fifo_priority, read_nice=read_nice)
+
+        # Per-connection cache of attributes (0x83), string attributes (0xAE) and device info
+        # (0xA1), which don't change while a controller stays connected.  Filled in the background on
+        # connect and dropped on disconnect.  device_cache_generation counts connections so a reply
+        # that was in flight across a reconnect isn't cached for the new device.
+        self.device_cache = {}
+        self.device_cache_lock = threading.Lock()
+        self.device_cache_generation = 0
+
+        # key: times it was invalidated on its own (see invalidate_cached())
+        self.device_cache_invalidations = {}
+        self.hid_dev_mgr.add_connection_listener(self.connection_changed)
+
+        # Noise spectrum analysis, started by the first start_spectrum_analysis()
+        self.spectrum_analyzer = None
+        self.spectrum_lock = threading.Lock()
     
     ##########################################################################################################
     ## System Utility Commands
@@ -46,6 +68,129 @@ class ControllerInterface:
     def get_data(self):
         return self.hid_dev_mgr.get_data()
 
+    # Same as get_data(), but a read-only view that isn't copied.  Use this on hot paths.
+    def get_data_view(self):
+        return self.hid_dev_mgr.get_data_view()
+
+    # Get a cursor that returns every button press / release (ButtonEvent tuples, see
+    # button_events.py) decoded after this call.
+    def new_button_event_cursor(self, from_start=False):
+        return self.hid_dev_mgr.msg_handler.button_events.new_cursor(from_start)
+
+    # Per button press / release / bounce counts and shortest / longest press
+    def get_button_stats(self):
+        return self.hid_dev_mgr.msg_handler.button_events.get_stats()
+
+    # Latest decoded state as a StateVector: value(i) / last_updated(i) for the field at
+    # get_state_field_index(name).  Read-only; cheaper than get_data() for per-packet consumers.
+    def get_state(self):
+        return self.hid_dev_mgr.get_state()
+
+    # Stable index of a message field in the StateVector, or None
+    def get_state_field_index(self, name):
+        return self.hid_dev_mgr.msg_handler.state.layout.field_index.get(name)
+
+    # Get a cursor that returns every decoded packet (as a read-only data mapping; copy() gives a
+    # dict) published after this call.
+    # Use this instead of polling get_data() when no packet may be missed.
+    def new_packet_cursor(self, from_start=False):
+        return self.hid_dev_mgr.new_packet_cursor(from_start)
+
+    # Per-opcode feature report counts, throughput and latency (see HidDeviceManager.get_transaction_stats())
+    def get_transaction_stats(self):
+        return self.hid_dev_mgr.get_transaction_stats()
+
+    def reset_transaction_stats(self):
+        self.hid_dev_mgr.reset_transaction_stats()
+
+    # Per message type report inter-arrival times (see HidDeviceManager.get_arrival_stats())
+    def get_arrival_stats(self):
+        return self.hid_dev_mgr.get_arrival_stats()
+
+    # Inter-arrival summary of the controller state stream, or None before any reports
+    def get_state_arrival_stats(self):
+        return self.hid_dev_mgr.get_state_arrival_stats()
+
+    def reset_arrival_stats(self):
+        self.hid_dev_mgr.reset_arrival_stats()
+
+    # Controller clock vs. host clock: frame period, drift (ppm) and transport latency jitter
+    def get_clock_stats(self):
+        return self.hid_dev_mgr.get_clock_stats()
+
+    # Average reports per read thread wakeup in batch_read mode
+    def get_read_batch_stats(self):
+        return self.hid_dev_mgr.get_read_batch_stats()
+
+    # Per message type frame counter gaps: loss totals, 1 s / 10 s / 60 s loss rates, gap length
+    # histogram and bursts (see ValveMessageHandler.get_sequence_stats())
+    def get_sequence_stats(self):
+        return self.hid_dev_mgr.msg_handler.get_sequence_stats()
+
+    # Scheduling policy / affinity the read thread got and its measured wakeup latency
+    def get_read_scheduling(self):
+        return self.hid_dev_mgr.get_read_scheduling()
+
+    # Record raw input reports to a capture file (see hid_capture.py)
+    def start_capture(self, path):
+        self.hid_dev_mgr.start_capture(path)
+
+    def stop_capture(self):
+        return self.hid_dev_mgr.stop_capture()
+
+    ##########################################################################################################
+    ## Device attribute cache
+    ##########################################################################################################
+    # String attributes the UI shows, prefetched with the attributes and device info on connect
+    CACHED_STR_ATTRIBUTES = (0, 1, 2)
+
+    # Connection listener (hotplug path)
+    def connection_changed(self, hid_dev_mgr, connected):
+        self.invalidate_device_cache()
+        if connected:
+            threading.Thread(target=self.fill_device_cache, args=(self.device_cache_generation,), daemon=True).start()
+
+    def invalidate_device_cache(self):
+        # Bump first so an in-flight fetch can't store into the new cache
+        self.device_cache_generation += 1
+        self.device_cache = {}
+
+    def fill_device_cache(self, generation):
+        self.get_attributes()
+        for attribute_number in self.CACHED_STR_ATTRIBUTES:
+            if generation != self.device_cache_generation:
+                return
+            self.get_str_attribute(attribute_number)
+        for side in (self.SIDE_LEFT, self.SIDE_RIGHT):
+            if generation != self.device_cache_generation:
+                return
+            self.get_device_info(side)
+
+    # Drop one cached value the controller may have changed (e.g. the attributes after a setting).
+    # A fetch of it already in flight doesn't store its reply.
+    def invalidate_cached(self, key):
+        self.device_cache_invalidations[key] = self.device_cache_invalidations.get(key, 0) + 1
+        self.device_cache.pop(key, None)
+
+    # Return the cached value for key, or fetch() it.  Failed fetches (None / empty) aren't cached.
+    # Fetches are serialized so the background fill and a caller never ask the controller twice.
+    def cached(self, key, fetch):
+        value = self.device_cache.get(key)
+        if value is not None:
+            return value
+
+        with self.device_cache_lock:
+            value = self.device_cache.get(key)
+            if value is not None:
+                return value
+
+            generation = self.device_cache_generation
+            invalidations = self.device_cache_invalidations.get(key)
+            value = fetch()
+            if value and generation == self.device_cache_generation and invalidations == self.device_cache_invalidations.get(key):
+                self.device_cache[key] = value
+            return value
+
     # Clear the stored data set
     def clear_data(self):
         return self.hid_dev_mgr.clear_data()
@@ -54,6 +199,7 @@ class ControllerInterface:
         return self.hid_dev_mgr.restart()
     
     def shutdown(self):
+        self.stop_spectrum_analysis()
         return self.hid_dev_mgr.shutdown()
 
     # if more than 1 device of matching VID / PID is attached, switch devices.
@@ -127,6 +273,61 @@ class ControllerInterface:
     def get_stick_deadzone(self):
         return self.hid_dev_mgr.msg_handler.stick_deadzone
 
+    # Publish a running standard deviation of any decoded field as last_data[key] every packet
+    # (see ValveMessageHandler.track_noise()).  Subscribes to it; returns key.
+    def track_noise(self, field, key=None, window=None):
+        key = self.hid_dev_mgr.msg_handler.track_noise(field, key, window)
+        self.subscribe_fields((key,))
+        return key
+
+    def get_noise_stats(self):
+        return self.hid_dev_mgr.msg_handler.get_noise_stats()
+
+    # Derived fields (Euler angles, deadzoned sticks, noise) are only computed while subscribed.
+    # Subscriptions are reference counted: pair every subscribe with an unsubscribe.
+    def subscribe_fields(self, fields):
+        self.hid_dev_mgr.msg_handler.subscribe_fields(fields)
+
+    def unsubscribe_fields(self, fields):
+        self.hid_dev_mgr.msg_handler.unsubscribe_fields(fields)
+
+    def get_derived_field_names(self):
+        return self.hid_dev_mgr.msg_handler.get_derived_field_names()
+
+    # Get a cursor that returns every complete Rushmore debug frame (RushmoreFrame tuples) assembled
+    # after this call.  Frame values are recycled, copy any frame kept beyond the queue size.
+    def new_rushmore_frame_cursor(self, from_start=False):
+        return self.hid_dev_mgr.msg_handler.rushmore_frames.new_cursor(from_start)
+
+    # Counts of complete, torn and incomplete Rushmore frames
+    def get_rushmore_frame_stats(self):
+        return self.hid_dev_mgr.msg_handler.rushmore_frames.get_stats()
+
+    # Analyse the noise spectrum of fields (default SpectrumAnalyzer.DEFAULT_FIELDS) on a thread of
+    # its own, see spectrum_analyzer.py.  Only the first call's settings are used while it runs.
+    # Returns False if it can't run (no NumPy).
+    def start_spectrum_analysis(self, fields=None, window=2048, segment=256, cadence_s=1.0):
+        with self.spectrum_lock:
+            if self.spectrum_analyzer is None:
+                analyzer = SpectrumAnalyzer(self.new_packet_cursor(), fields or SpectrumAnalyzer.DEFAULT_FIELDS,
+                                            window=window, segment=segment, cadence_s=cadence_s)
+                if not analyzer.start():
+                    return False
+                self.spectrum_analyzer = analyzer
+        return True
+
+    def stop_spectrum_analysis(self):
+        with self.spectrum_lock:
+            if self.spectrum_analyzer is not None:
+                self.spectrum_analyzer.stop()
+                self.spectrum_analyzer = None
+
+    # Latest spectrum results: sample rate, and per field rms, dominant peaks and band power
+    # (see SpectrumAnalyzer.analyze()).  {} until the first analysis.
+    def get_spectrum(self):
+        analyzer = self.spectrum_analyzer
+        return analyzer.get_results() if analyzer is not None else {}
+
     # Set the system framerate
     def sys_set_framerate(self, framerate):
          self.set_setting(64, framerate)
@@ -260,9 +461,7 @@ class ControllerInterface:
         # left = 0, right = 1
         report_bytes = struct.pack('=2B', side, 0)
 
-        self.hid_dev_mgr.send_feature_report(op, report_bytes)
-        # Retrieve and parse the result.
-        report_type, report_length, report_bytes = self.hid_dev_mgr.get_feature_report()
+        report_type, report_length, report_bytes = self.hid_dev_mgr.transaction(op, report_bytes)
 
         if not report_length or report_type != op:
                 return None
@@ -333,9 +532,7 @@ class ControllerInterface:
         # left = 0, right = 1
         report_bytes = struct.pack('B', side)
 
-        self.hid_dev_mgr.send_feature_report(op, report_bytes)
-        # Retrieve and parse the result.
-        report_type, report_length, report_bytes = self.hid_dev_mgr.get_feature_report()
+        report_type, report_length, report_bytes = self.hid_dev_mgr.transaction(op, report_bytes)
 
         if not report_length or report_type != op:
                 return None
@@ -361,10 +558,7 @@ class ControllerInterface:
         fulldata = []
         for rowset in range (0, 4):
             report_bytes = struct.pack('2B', side, rowset)
-            self.hid_dev_mgr.send_feature_report(op, report_bytes)
-
-            # Retrieve and parse the result.
-            report_type, report_length, report_bytes = self.hid_dev_mgr.get_feature_report()
+            report_type, report_length, report_bytes = self.hid_dev_mgr.transaction(op, report_bytes)
 
             if not report_length or report_type != op:
                 return None
@@ -384,10 +578,7 @@ class ControllerInterface:
         fulldata = []
         for rowset in range (0, 4):
             report_bytes = struct.pack('2B', side, rowset)
-            self.hid_dev_mgr.send_feature_report(op, report_bytes)
-
-            # Retrieve and parse the result.
-            report_type, report_length, report_bytes = self.hid_dev_mgr.get_feature_report()
+            report_type, report_length, report_bytes = self.hid_dev_mgr.transaction(op, report_bytes)
 
             if not report_length or report_type != op:
                 return None
@@ -463,9 +654,7 @@ class ControllerInterface:
         op = 0xE4
         report_bytes = struct.pack('')
 
-        self.hid_dev_mgr.send_feature_report(op, report_bytes)
-        # Retrieve and parse the result.
-        report_type, report_length, report_bytes =  self.hid_dev_mgr.get_feature_report()
+        report_type, report_length, report_bytes = self.hid_dev_mgr.transaction(op, report_bytes)
         if not report_length or report_type != op:
             return None
 
@@ -495,9 +684,7 @@ class ControllerInterface:
         op = 0xE6
         report_bytes = struct.pack('')
 
-        self.hid_dev_mgr.send_feature_report(op, report_bytes)
-        # Retrieve and parse the result.
-        report_type, report_length, report_bytes =  self.hid_dev_mgr.get_feature_report()
+        report_type, report_length, report_bytes = self.hid_dev_mgr.transaction(op, report_bytes)
 
         if not report_length or report_type != op:
             return None
@@ -559,9 +746,7 @@ class ControllerInterface:
     def imu_get_bias(self):
         op = 0xDD
         report_bytes = struct.pack('')
-        self.hid_dev_mgr.send_feature_report(op, report_bytes)
-        # Retrieve and parse the result.
-        report_type, report_length, report_bytes =  self.hid_dev_mgr.get_feature_report()
+        report_type, report_length, report_bytes = self.hid_dev_mgr.transaction(op, report_bytes)
         if not report_length or report_type != op:
             return None
 
@@ -593,9 +778,7 @@ class ControllerInterface:
         # left = 0, right = 1
         report_bytes = struct.pack('B', side)
 
-        self.hid_dev_mgr.send_feature_report(op, report_bytes)
-        # Retrieve and parse the result.
-        report_type, report_length, report_bytes =  self.hid_dev_mgr.get_feature_report()
+        report_type, report_length, report_bytes = self.hid_dev_mgr.transaction(op, report_bytes)
 
         if not report_length or report_type != op:
             return None
@@ -634,9 +817,7 @@ class ControllerInterface:
         op = 0xDE
         report_bytes = struct.pack('B', side)
 
-        self.hid_dev_mgr.send_feature_report(op, report_bytes)
-        # Retrieve and parse the result.
-        report_type, report_length, report_bytes = self.hid_dev_mgr.get_feature_report()
+        report_type, report_length, report_bytes = self.hid_dev_mgr.transaction(op, report_bytes)
 
         if not report_length or report_type != op:
                 return None
@@ -674,9 +855,7 @@ class ControllerInterface:
         # left = 0, right = 1
         report_bytes = struct.pack('B', side)
 
-        self.hid_dev_mgr.send_feature_report(op, report_bytes)
-        # Retrieve and parse the result.
-        report_type, report_length, report_bytes = self.hid_dev_mgr.get_feature_report()
+        report_type, report_length, report_bytes = self.hid_dev_mgr.transaction(op, report_bytes)
 
         if not report_length or report_type != op:
                 return None
@@ -703,9 +882,7 @@ class ControllerInterface:
         op = 0xDB
         report_bytes = ''
 
-        self.hid_dev_mgr.send_feature_report(op, report_bytes)
-        # Retrieve and parse the result.
-        report_type, report_length, report_bytes = self.hid_dev_mgr.get_feature_report()
+        report_type, report_length, report_bytes = self.hid_dev_mgr.transaction(op, report_bytes)
 
         if not report_length or report_type != op:
                 return None
@@ -743,15 +920,15 @@ class ControllerInterface:
 
         self.hid_dev_mgr.send_feature_report(feature_report_type, report_bytes)
 
+        # Settings can change attributes (frame_rate, data_streaming)
+        self.invalidate_cached('attributes')
+
     def get_setting(self, setting_num):
         feature_report_type = 0x89
         feature_report_length = 3
         report_bytes = struct.pack('=Bh', setting_num, 0)
 
-        self.hid_dev_mgr.send_feature_report(feature_report_type, report_bytes)
-
-        # Retrieve and parse the result.
-        report_type, report_length, report_bytes = self.hid_dev_mgr.get_feature_report()
+        report_type, report_length, report_bytes = self.hid_dev_mgr.transaction(feature_report_type, report_bytes)
         if report_type != 0x89:
             return {}
 
@@ -773,10 +950,7 @@ class ControllerInterface:
     def  get_system_status(self):  
         feature_report_type = 0xE5
         report_bytes = struct.pack('')
-        self.hid_dev_mgr.send_feature_report(feature_report_type, report_bytes)
-
-        # Retrieve and parse the result.
-        report_type, report_length, report_bytes = self.hid_dev_mgr.get_feature_report()
+        report_type, report_length, report_bytes = self.hid_dev_mgr.transaction(feature_report_type, report_bytes)
         if report_type != feature_report_type:
             return {}
 
@@ -804,15 +978,16 @@ class ControllerInterface:
         report_bytes = struct.pack('')
         self.hid_dev_mgr.send_feature_report(feature_report_type, report_bytes)
 
+    # Cached per connection and refetched after any set_setting(); returns a copy.
     def get_attributes(self):
+        return dict(self.cached('attributes', self.read_attributes))
+
+    def read_attributes(self):
         if not self.hid_dev_mgr.is_open():
             return {}
 
         # Send the GET_ATTRIBUTES_VALUES request.
-        self.hid_dev_mgr.send_feature_report(0x83, '')
-
-        # Retrieve and parse the result.
-        report_type, report_length, report_bytes = self.hid_dev_mgr.get_feature_report()
+        report_type, report_length, report_bytes = self.hid_dev_mgr.transaction(0x83, '')
         if report_type != 0x83:
             return {}
 
@@ -873,17 +1048,18 @@ class ControllerInterface:
                 attrs['secondary_trackpad_id'] = val
         return attrs
 
+    # Cached per connection
     def get_str_attribute(self, attribute_number):
+        return self.cached(('str_attribute', attribute_number), lambda: self.read_str_attribute(attribute_number))
+
+    def read_str_attribute(self, attribute_number):
         if not self.hid_dev_mgr.is_open():
             return None
 
         op = 0xAE
 
         # Send the ID_GET_STRING_ATTRIBUTE request.
-        self.hid_dev_mgr.send_feature_report(op, struct.pack('=b', attribute_number))
-
-        # Retrieve the result.
-        report_type, report_length, report_bytes = self.hid_dev_mgr.get_feature_report()
+        report_type, report_length, report_bytes = self.hid_dev_mgr.transaction(op, struct.pack('=b', attribute_number))
 
         if not report_length or report_type != op or report_bytes[0] != attribute_number:
              return None
@@ -896,14 +1072,16 @@ class ControllerInterface:
     ##########################################################################################################
     ## Info Commands
     ##########################################################################################################
+    # Cached per connection
     def get_device_info(self, side):
+        return self.cached(('device_info', side), lambda: self.read_device_info(side))
+
+    def read_device_info(self, side):
         op = 0xA1
         # left = 0, right = 1
         report_bytes = struct.pack('B', side)
 
-        self.hid_dev_mgr.send_feature_report(op, report_bytes)
-        # Retrieve and parse the result.
-        report_type, report_length, report_bytes = self.hid_dev_mgr.get_feature_report()
+        report_type, report_length, report_bytes = self.hid_dev_mgr.transaction(op, report_bytes)
 
         if not report_length or report_type != op:
             return None
@@ -0,0 +1,286 @@
+import os
+import json
+import time
+import struct
+import logging
+
+##########################################################################################################
+## Feature report protocol emulator
+##
+##   Answers the controller's request / response feature report commands the way the firmware does:
+##   settings (0x87 / 0x89 / 0x8E), attributes (0x83, 0xAE), system status (0xE5), device info (0xA1)
+##   and the calibration get / set / persist commands used by ControllerInterface.  Settings and
+##   calibration live in a store that survives device re-opens and, with store_path, is written to a
+##   JSON file.  latency_s delays every reply to model USB round trip time.
+##
+##   send_feature_report() / get_feature_report() take and return the same framing as a HID device
+##   (report ID, type, length, payload), so the emulator can sit behind any virtual device.
+##########################################################################################################
+
+REPORT_SIZE = 64
+
+# Default setting values the emulator reports before anything is set.  Anything else reads as 0.
+default_settings = {
+    19: 1200,       # Rushmore touch threshold
+    20: 1000,       # Rushmore no-touch threshold
+    48: 1,          # IMU mode
+    51: 300,        # Rushmore noise threshold
+    63: 100,        # Rushmore noise floor
+    64: 4,          # Frame rate
+    68: 8000,       # Trigger threshold
+    77: 500,        # Thumbstick touch threshold
+    79: 2,          # Haptic UI intensity
+}
+
+class FeatureReportEmulator:
+    # Attribute tags returned by GET_ATTRIBUTES_VALUES (0x83)
+    ATTRIB_UNIQUE_ID = 0
+    ATTRIB_PRODUCT_ID = 1
+    ATTRIB_CAPABILITIES = 2
+    ATTRIB_FIRMWARE_BUILD_TIME = 4
+    ATTRIB_BOARD_REVISION = 9
+    ATTRIB_BOOTLOADER_BUILD_TIME = 10
+    ATTRIB_CONNECTION_INTERVAL_IN_US = 11
+
+    def __init__(self, latency_s=0.0, store_path=None, product_id=0x1205, serial='VIRTUAL0000', frame_interval_us=1000):
+        self.logger = logging.getLogger('RTST.FEATURE_EMU')
+
+        self.latency_s = latency_s
+        self.store_path = store_path
+        self.product_id = product_id
+        self.serial = serial
+        self.frame_interval_us = frame_interval_us
+
+        self.store = self.load_store()
+
+        # Working calibration starts as the persisted one; *_set_cal commands change the working
+        # copy and PERSIST_CAL (0xE2) commits it.
+        self.cal = json.loads(json.dumps(self.store['cal']))
+
+        self.reply = bytes(REPORT_SIZE + 1)
+        self.request_count = 0
+
+        # opcode: handler(payload) -> reply payload, or None for commands without a reply
+        self.handlers = {
+            0x83: self.get_attributes,
+            0x87: self.set_setting,
+            0x89: self.get_setting,
+            0x8E: self.load_default_settings,
+            0xA1: self.get_device_info,
+            0xAA: self.get_current_trackpad_cal,
+            0xAB: self.get_factory_trackpad_cal,
+            0xAE: self.get_str_attribute,
+            0xD9: self.get_thumbstick_cal,
+            0xDA: self.set_thumbstick_cal,
+            0xDB: self.get_trackpad_cal,
+            0xDC: self.set_trackpad_cal,
+            0xDD: self.get_imu_bias,
+            0xDE: self.get_trigger_cal,
+            0xDF: self.set_trigger_cal,
+            0xE0: self.get_pressure_cal,
+            0xE1: self.set_pressure_cal,
+            0xE2: self.persist_cal,
+            0xE3: self.get_cc_vals,
+            0xE4: self.get_selftest_results,
+            0xE5: self.get_system_status,
+            0xE6: self.get_imu_cal,
+            0xE7: self.set_imu_cal,
+        }
+
+    ##########################################################################################################
+    ## Device interface
+    ##########################################################################################################
+    # data is (report ID, type, length, payload...)
+    def send_feature_report(self, data):
+        data = bytes(data)
+        op = data[1]
+        payload = data[3:3 + data[2]]
+        self.request_count += 1
+
+        handler = self.handlers.get(op)
+        reply = handler(payload) if handler else None
+
+        # Commands without a reply leave the request itself in the report buffer.
+        if reply is None:
+            reply = payload
+        report = struct.pack('=3B', 0, op, len(reply)) + reply
+        self.reply = report + bytes(REPORT_SIZE + 1 - len(report))
+        return len(data)
+
+    def get_feature_report(self, report_id, size):
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        return self.reply[:size]
+
+    ##########################################################################################################
+    ## Store
+    ##########################################################################################################
+    def default_store(self):
+        return {
+            'settings': {},
+            'cal': {
+                'thumbstick': [[0, 4095, 1900, 2200, 0, 4095, 1900, 2200], [0, 4095, 1900, 2200, 0, 4095, 1900, 2200]],
+                'trigger': [[3000, 200, 0], [3000, 200, 0]],
+                'pressure': [[100, 3000, 500], [100, 3000, 500]],
+                'trackpad': [[40, 0, 32767, 0, 32767], [40, 0, 32767, 0, 32767]],
+                'imu': [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+                'user_data': [1, 2],
+            },
+        }
+
+    def load_store(self):
+        store = self.default_store()
+        if self.store_path and os.path.exists(self.store_path):
+            try:
+                with open(self.store_path) as f:
+                    saved = json.load(f)
+                store['settings'].update(saved.get('settings', {}))
+                store['cal'].update(saved.get('cal', {}))
+            except (OSError, ValueError) as e:
+                self.logger.error('Unable to load {}: {}'.format(self.store_path, e))
+        return store
+
+    def save_store(self):
+        if not self.store_path:
+            return
+        try:
+            with open(self.store_path, 'w') as f:
+                json.dump(self.store, f, indent=1)
+        except OSError as e:
+            self.logger.error('Unable to save {}: {}'.format(self.store_path, e))
+
+    ##########################################################################################################
+    ## Settings
+    ##########################################################################################################
+    def set_setting(self, payload):
+        setting_num, setting_val = struct.unpack_from('=Bh', payload)
+        self.store['settings'][str(setting_num)] = setting_val & 0xFFFF
+        self.save_store()
+        return None
+
+    def get_setting(self, payload):
+        setting_num = payload[0]
+        value = self.store['settings'].get(str(setting_num), default_settings.get(setting_num, 0))
+        return struct.pack('=BH', setting_num, value)
+
+    def load_default_settings(self, payload):
+        self.store['settings'] = {}
+        self.save_store()
+        return None
+
+    ##########################################################################################################
+    ## Attributes and status
+    ##########################################################################################################
+    def get_attributes(self, payload):
+        attrs = (
+            (self.ATTRIB_UNIQUE_ID, 0x12345678),
+            (self.ATTRIB_PRODUCT_ID, self.product_id),
+            (self.ATTRIB_CAPABILITIES, 0),
+            (self.ATTRIB_FIRMWARE_BUILD_TIME, 1700000000),
+            (self.ATTRIB_BOARD_REVISION, 30),
+            (self.ATTRIB_BOOTLOADER_BUILD_TIME, 1600000000),
+            (self.ATTRIB_CONNECTION_INTERVAL_IN_US, self.frame_interval_us),
+        )
+        return b''.join(struct.pack('=BL', tag, val) for tag, val in attrs)
+
+    # 0 = board serial, 1 = unit serial, 2 = secondary board serial
+    def get_str_attribute(self, payload):
+        attribute_number = payload[0]
+        strings = {0: 'BRD' + self.serial, 1: self.serial, 2: 'SEC' + self.serial}
+        value = strings.get(attribute_number)
+        if value is None:
+            return struct.pack('=2B', attribute_number, 0xFF)
+        return struct.pack('=B', attribute_number) + value.encode()[:REPORT_SIZE - 2]
+
+    def get_system_status(self, payload):
+        # secondary present, Bosch IMU, no failures
+        return struct.pack('=5B', 1, 0, 0, 0, 0)
+
+    def get_device_info(self, payload):
+        side = payload[0] if payload else 0
+        uid = bytes(range(side * 16, side * 16 + 16))
+        return struct.pack('=2B16s', side, 0, uid)
+
+    def get_selftest_results(self, payload):
+        return struct.pack('=H', 0x0003)
+
+    def get_cc_vals(self, payload):
+        side = payload[0] if payload else 0
+        return struct.pack('=2B2H', side, 1, 1000 + side, 2000 + side)
+
+    def get_imu_bias(self, payload):
+        return struct.pack('=i3i3i2b', 0, 0, 0, 0, 0, 0, 0, 3, 3)
+
+    ##########################################################################################################
+    ## Calibration
+    ##########################################################################################################
+    def get_thumbstick_cal(self, payload):
+        side = payload[0]
+        return struct.pack('=B8H', side, *self.cal['thumbstick'][side])
+
+    def set_thumbstick_cal(self, payload):
+        values = struct.unpack_from('=B8H', payload)
+        self.cal['thumbstick'][values[0]] = list(values[1:])
+        return None
+
+    def get_trigger_cal(self, payload):
+        side = payload[0]
+        return struct.pack('=B2HB', side, *self.cal['trigger'][side])
+
+    def set_trigger_cal(self, payload):
+        values = struct.unpack_from('=B2HB', payload)
+        self.cal['trigger'][values[0]] = list(values[1:])
+        return None
+
+    def get_pressure_cal(self, payload):
+        side = payload[0]
+        return struct.pack('=B3H', side, *self.cal['pressure'][side])
+
+    def set_pressure_cal(self, payload):
+        values = struct.unpack_from('=B3H', payload)
+        self.cal['pressure'][values[0]] = list(values[1:])
+        return None
+
+    # 0xDB / 0xDC are shared: with a side byte they're trackpad truncation cal, without one user data.
+    def get_trackpad_cal(self, payload):
+        if not payload:
+            return struct.pack('=2B', *self.cal['user_data'])
+        side = payload[0]
+        return struct.pack('=Bb4H', side, *self.cal['trackpad'][side])
+
+    def set_trackpad_cal(self, payload):
+        if len(payload) == struct.calcsize('=2B'):
+            self.cal['user_data'] = list(struct.unpack('=2B', payload))
+            return None
+        values = struct.unpack_from('=Bb4H', payload)
+        self.cal['trackpad'][values[0]] = list(values[1:])
+        return None
+
+    def get_imu_cal(self, payload):
+        return struct.pack('=B3b3hb6h', *self.cal['imu'])
+
+    def set_imu_cal(self, payload):
+        self.cal['imu'] = list(struct.unpack_from('=B3b3hb6h', payload))
+        return None
+
+    # Rushmore surface cal, 4 rowsets of 16 values per side
+    def get_factory_trackpad_cal(self, payload):
+        side, rowset = payload[0], payload[1]
+        values = [1000 + side * 100 + rowset * 16 + i for i in range(16)]
+        return struct.pack('=2B16h', side, rowset, *values)
+
+    def get_current_trackpad_cal(self, payload):
+        side, rowset = payload[0], payload[1]
+        values = [1010 + side * 100 + rowset * 16 + i for i in range(16)]
+        return struct.pack('=2B16h', side, rowset, *values)
+
+    # Bitmask selects what to commit: trigger 0x01, joystick 0x02, pressure 0x04, trackpad 0x08,
+    # IMU 0x10, user data 0x20.  The side byte is ignored; both sides are committed.
+    def persist_cal(self, payload):
+        side, bitmask = struct.unpack_from('=2B', payload)
+        for bit, key in ((0x01, 'trigger'), (0x02, 'thumbstick'), (0x04, 'pressure'),
+                         (0x08, 'trackpad'), (0x10, 'imu'), (0x20, 'user_data')):
+            if bitmask & bit:
+                self.store['cal'][key] = json.loads(json.dumps(self.cal[key]))
+        self.save_store()
+        return None
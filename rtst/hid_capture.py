@@ -0,0 +1,165 @@
+import os
+import time
+import struct
+import logging
+
+##########################################################################################################
+## Raw HID capture files and replay
+##
+##   A capture is a small header followed by one record per input report:
+##
+##     header:  magic 'RTSTCAP1', vendor ID (u16), product ID (u16)
+##     record:  CLOCK_MONOTONIC timestamp in ns (u64), report length (u16), report bytes
+##
+##   HidDeviceManager.start_capture() writes one as reports arrive.  ReplayBackend plays one back
+##   through the usual read thread and msg_handler at real time, N times real time or as fast as
+##   possible.
+##########################################################################################################
+
+CAPTURE_MAGIC = b'RTSTCAP1'
+capture_header = struct.Struct('=8sHH')
+capture_record = struct.Struct('=QH')
+
+class HidCaptureWriter:
+    def __init__(self, path, vendor_id=0, product_id=0):
+        self.path = path
+        self.file = open(path, 'wb', buffering=1 << 16)
+        self.file.write(capture_header.pack(CAPTURE_MAGIC, vendor_id, product_id))
+        self.record_count = 0
+
+    def write(self, timestamp_ns, report):
+        self.file.write(capture_record.pack(timestamp_ns, len(report)))
+        self.file.write(report)
+        self.record_count += 1
+
+    def close(self):
+        self.file.close()
+
+# Returns (vendor_id, product_id) from a capture's header
+def read_capture_header(f):
+    header = f.read(capture_header.size)
+    if len(header) < capture_header.size:
+        raise ValueError('Truncated capture header')
+    (magic, vendor_id, product_id) = capture_header.unpack(header)
+    if magic != CAPTURE_MAGIC:
+        raise ValueError('Not an RTST capture file')
+    return (vendor_id, product_id)
+
+# Load every (timestamp_ns, report) in a capture.  A truncated last record is dropped.
+def read_capture(path):
+    records = []
+    with open(path, 'rb') as f:
+        read_capture_header(f)
+        data = f.read()
+
+    offset = 0
+    while offset + capture_record.size <= len(data):
+        (timestamp_ns, length) = capture_record.unpack_from(data, offset)
+        offset += capture_record.size
+        if offset + length > len(data):
+            break
+        records.append((timestamp_ns, data[offset:offset + length]))
+        offset += length
+    return records
+
+##########################################################################################################
+## Replay
+##########################################################################################################
+class ReplayDevice:
+    # speed is a multiple of real time; 0 replays as fast as the reader takes reports.
+    def __init__(self, records, speed=1.0, loop=False):
+        self.logger = logging.getLogger('RTST.REPLAY')
+        self.records = records
+        self.speed = speed
+        self.loop = loop
+
+        self.index = 0
+        self.start_time = None
+        self.finished = False
+        self.closed = False
+
+    def readinto(self, buffer, size, timeout_ms=None):
+        report = self.next_report(timeout_ms)
+        if not report:
+            return 0
+
+        length = min(size, len(report))
+        buffer[:length] = report[:length]
+        return length
+
+    def read(self, size, timeout=None):
+        report = self.next_report(timeout)
+        return report[:size] if report else b''
+
+    # Replay has no device to talk to; feature reports go nowhere.
+    def send_feature_report(self, data):
+        return len(data)
+
+    def get_feature_report(self, report_id, size):
+        return bytes(size)
+
+    def close(self):
+        self.closed = True
+
+    def next_report(self, timeout_ms):
+        if self.closed:
+            raise OSError('Replay device closed')
+
+        if self.index >= len(self.records):
+            if not self.loop or not self.records:
+                # Idle like a device with nothing to send
+                if not self.finished:
+                    self.finished = True
+                    self.logger.info('Replay finished ({} reports)'.format(len(self.records)))
+                time.sleep(timeout_ms / 1000. if timeout_ms is not None else .01)
+                return None
+            self.index = 0
+            self.start_time = None
+
+        (timestamp_ns, report) = self.records[self.index]
+
+        if self.speed:
+            now = time.perf_counter()
+            if self.start_time is None:
+                self.start_time = now - (timestamp_ns - self.records[0][0]) / 1e9 / self.speed
+            wait = self.start_time + (timestamp_ns - self.records[0][0]) / 1e9 / self.speed - now
+            if wait > 0:
+                if timeout_ms is not None and wait > timeout_ms / 1000.:
+                    time.sleep(timeout_ms / 1000.)
+                    return None
+                time.sleep(wait)
+
+        self.index += 1
+        return report
+
+class ReplayBackend:
+    name = 'replay'
+
+    open_errors = (OSError, ValueError)
+
+    def __init__(self, path, speed=1.0, loop=False):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+
+        with open(path, 'rb') as f:
+            (self.vendor_id, self.product_id) = read_capture_header(f)
+
+    # The capture shows up as the device it was recorded from.  Captures started before a device
+    # was connected have no IDs and match any VID / PID.
+    def enumerate(self, vid=0, pid=0):
+        if self.vendor_id and ((vid and vid != self.vendor_id) or (pid and pid != self.product_id)):
+            return []
+
+        return [{
+            'path': ('replay:' + os.path.abspath(self.path)).encode(),
+            'vendor_id': self.vendor_id or vid,
+            'product_id': self.product_id or pid,
+            'serial_number': 'REPLAY',
+            'product_string': 'Capture replay',
+            'interface_number': 2,
+            'usage_page': 0xFF00,
+        }]
+
+    def open(self, path):
+        return ReplayDevice(read_capture(self.path), self.speed, self.loop)
@@ -15,19 +15,265 @@ import ctypes
 import struct
 import array
 import copy
+import types
+import queue
 import logging
-from time import sleep
+from time import perf_counter, monotonic_ns
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from packet_ring import PacketRingBuffer
+from hotplug_monitor import NetlinkHotplugMonitor
+from hidraw_device import HidrawBackend
+from virtual_device import VirtualBackend
+from hid_capture import HidCaptureWriter
+from arrival_stats import ArrivalStats
+from clock_estimator import DeviceClockEstimator
+from thread_sched import apply_thread_scheduling, WakeupLatencyTracker
+from state_vector import snapshot_data
+from valve_message_handler import sequence_field_index, state_message_types
 
 __version__ = "$Revision: #21 $"
 __date__ = "$DateTime: 2021/07/30 11:04:00 $"
 
+##########################################################################################################
+## hidapi transport (default)
+##########################################################################################################
+class HidapiDevice:
+    def __init__(self, device):
+        self.device = device
+
+        # Raw hidapi handle for reading straight into a caller's buffer.  Not every hid binding
+        # exposes it, in which case readinto() falls back to copying from read().
+        self.handle = getattr(device, '_Device__dev', None) if hasattr(hid, 'hidapi') else None
+
+        # ctypes views of the caller's buffers, by id().  The read thread cycles through a fixed set.
+        self.read_arrays = {}
+
+    # Read one input report into buffer and return its length.  timeout_ms=None blocks,
+    # otherwise 0 is returned if no report arrives in time.
+    def readinto(self, buffer, size, timeout_ms=None):
+        if self.handle is None:
+            data = self.device.read(size, timeout_ms)
+            buffer[:len(data)] = data
+            return len(data)
+
+        read_array = self.read_arrays.get(id(buffer))
+        if read_array is None:
+            read_array = self.read_arrays[id(buffer)] = (ctypes.c_char * len(buffer)).from_buffer(buffer)
+
+        if timeout_ms is None:
+            length = hid.hidapi.hid_read(self.handle, read_array, size)
+        else:
+            length = hid.hidapi.hid_read_timeout(self.handle, read_array, size, timeout_ms)
+
+        if length < 0:
+            raise hid.HIDException('hid_read failed')
+        return length
+
+    def read(self, size, timeout=None):
+        return self.device.read(size, timeout)
+
+    def send_feature_report(self, data):
+        return self.device.send_feature_report(data)
+
+    def get_feature_report(self, report_id, size):
+        return self.device.get_feature_report(report_id, size)
+
+    def close(self):
+        self.device.close()
+
+class HidapiBackend:
+    name = 'hidapi'
+
+    # Exceptions that mean the device exists but can't be opened (yet).
+    open_errors = (hid.HIDException,)
+
+    def enumerate(self, vid=0, pid=0):
+        return hid.enumerate(vid, pid)
+
+    def open(self, path):
+        return HidapiDevice(hid.Device(path=path))
+
+# Feature reports carry 64 bytes of payload
+FEATURE_REPORT_SIZE = 64
+
+# Build a feature report: (report ID 0, type, length, payload, zero padding)
+def pack_feature_report(feature_report_type, report_bytes):
+    if isinstance(report_bytes, str):
+        report_bytes = report_bytes.encode()
+
+    # First byte is Feature Report type.  We'll stills end 64B of payload, but
+    # need this value prepended for PyHid
+    feature_report = struct.pack('=BBB', 0, feature_report_type, len(report_bytes)) + report_bytes
+
+    # pack the remainder of the hid_len + 1 bytes w/ 0's
+    feature_report += b'\0' * (FEATURE_REPORT_SIZE + 1 - len(feature_report))
+    return feature_report
+
+# Split a feature report into (report_type, report_length, report_bytes)
+def unpack_feature_report(report):
+    report_type = report[1]
+    report_length = report[2]
+    report_bytes = report[3: 3 + report_length]
+    return (report_type, report_length, report_bytes)
+
+# Is this enumerated HID interface the controller's vendor endpoint?
+def is_controller_endpoint(dev):
+    if sys.platform == 'win32':
+        return dev['usage_page'] >= 0xFF00
+    else:
+        return dev['interface_number'] == 2
+
+hid_backends = {
+    'hidapi': HidapiBackend,
+    'hidraw': HidrawBackend,
+    'virtual': VirtualBackend,
+}
+
+##########################################################################################################
+## Per-opcode feature report transaction statistics
+##########################################################################################################
+class TransactionStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.mismatches = 0
+        # Queue wait + service time, and service time (send + reply) alone
+        self.total_latency_s = 0.
+        self.max_latency_s = 0.
+        self.total_service_s = 0.
+        self.first_time = None
+        self.last_time = None
+
+    def add(self, submit_time, start_time, end_time):
+        if self.first_time is None:
+            self.first_time = start_time
+        self.last_time = end_time
+        self.count += 1
+
+        latency = end_time - submit_time
+        self.total_latency_s += latency
+        self.max_latency_s = max(self.max_latency_s, latency)
+        self.total_service_s += end_time - start_time
+
+    def summary(self):
+        elapsed = (self.last_time - self.first_time) if self.count > 1 else 0.
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'mismatches': self.mismatches,
+            'avg_latency_ms': self.total_latency_s * 1e3 / self.count if self.count else 0.,
+            'max_latency_ms': self.max_latency_s * 1e3,
+            'avg_service_ms': self.total_service_s * 1e3 / self.count if self.count else 0.,
+            'per_second': self.count / elapsed if elapsed else 0.,
+        }
+
 class HidDeviceManager:
-    def __init__(self, vid_pid_endpoint_list, connect_cb, msg_handler=None, dev_num=1):
+    # Size of a HID input report
+    REPORT_SIZE = 64
+
+    # Size of the preallocated read buffer.  Larger than a report so decoders can read fixed-size
+    # messages that run past the end of a short report without bounds checks.
+    READ_BUFFER_SIZE = 128
+
+    # Default time a feature report transaction may wait in the queue plus run
+    TRANSACTION_TIMEOUT_S = 1.0
+
+    # Result of a failed transaction that expects a reply, same as get_feature_report() on failure
+    NO_REPLY = (0, 0, '')
+
+    # Most reports batched reads drain per wakeup
+    READ_BATCH_SIZE = 32
+
+    # Longest a read blocks before the read thread checks whether it should stop.  Together with
+    # SHUTDOWN_TIMEOUT_S this bounds how long stop_read_thread() / restart() / shutdown() can take.
+    READ_TIMEOUT_MS = 100
+    SHUTDOWN_TIMEOUT_S = 0.5
+
+    # A failing read is retried after READ_ERROR_BACKOFF_S, doubling per consecutive failure.  After
+    # READ_ERROR_LIMIT in a row the read thread gives up and the device is reopened, so a dead
+    # device can't keep a (possibly realtime priority) reader spinning.
+    READ_ERROR_BACKOFF_S = 0.01
+    READ_ERROR_LIMIT = 8
+
+    # Hotplug polling interval when kernel hotplug events aren't available
+    HOTPLUG_POLL_S = 0.5
+
+    # backend is 'hidapi' (default, all platforms), 'hidraw' (Linux, no ctypes) or a backend object
+    # providing enumerate() / open().
+    # batch_read: after each blocking read, also take every report already queued (non-blocking) and
+    # decode them all under one lock acquisition.  Cuts per-report thread switching under load, at
+    # the cost of arrival timestamps only resolving when a batch was drained.
+    # read_cpu / read_fifo_priority / read_nice: pin the read thread to one CPU, run it SCHED_FIFO at
+    # that priority, or set its nice value (see thread_sched.py).  Each is applied where permitted;
+    # get_read_scheduling() reports what the thread actually got, and the wakeup latency the thread
+    # sees, probed every 100 ms for as long as it runs.
+    def __init__(self, vid_pid_endpoint_list, connect_cb, msg_handler=None, dev_num=1, packet_ring_size=4096, zero_copy_read=True, backend='hidapi', batch_read=False,
+                 read_cpu=None, read_fifo_priority=None, read_nice=None):
         self.last_data = {}
+
+        # Latest published (sequence number, snapshot of last_data).  The read thread builds a new
+        # snapshot per packet (a StateMapping for ValveMessageHandler, a dict for other handlers) and
+        # swaps this one reference; a published snapshot is never modified afterwards, so readers
+        # need no lock and can't see a half-updated state.
+        self.published = (0, {})
+
+        if isinstance(backend, str):
+            backend = hid_backends[backend]()
+        self.backend = backend
+
+        # Preallocated read buffer.  With zero_copy_read the read thread has the device fill it in
+        # place and hands the decoder a view of it instead of allocating a new bytes per report.
+        self.zero_copy_read = zero_copy_read
+        self.read_buffer = bytearray(self.READ_BUFFER_SIZE)
+        # ctypes view of the same memory, used to re-zero the tail without allocating
+        self.read_array = (ctypes.c_char * self.READ_BUFFER_SIZE).from_buffer(self.read_buffer)
+        self.read_view = memoryview(self.read_buffer)
+        self.read_dirty_len = 0
+
+        # Buffer pool for batched reads, one buffer per report in a batch
+        self.batch_read = batch_read
+        self.batch_buffers = [bytearray(self.READ_BUFFER_SIZE) for i in range(self.READ_BATCH_SIZE)]
+        self.batch_arrays = [(ctypes.c_char * self.READ_BUFFER_SIZE).from_buffer(b) for b in self.batch_buffers]
+        self.batch_views = [memoryview(b) for b in self.batch_buffers]
+        self.batch_dirty_lens = [0] * self.READ_BATCH_SIZE
+        self.batch_lengths = [0] * self.READ_BATCH_SIZE
+        self.batch_arrivals = [0] * self.READ_BATCH_SIZE
+        self.read_batches = 0
+        self.read_batch_reports = 0
+
+        # Read thread scheduling requested / achieved
+        self.read_cpu = read_cpu
+        self.read_fifo_priority = read_fifo_priority
+        self.read_nice = read_nice
+        self.read_scheduling = {}
+        self.wakeup_tracker = None
+
+        # Every decoded packet is also published here so consumers can read all of them
+        # instead of sampling last_data.
+        self.packet_ring = PacketRingBuffer(packet_ring_size)
         self.thread_lock = threading.Lock()
+        self.hotplug_lock = threading.RLock()
+        self.hotplug_monitor = None
+        self.should_reinstate_hotplug_thread = False
         self.device = None
-        self.run_read_thread = False
         self.read_thread = None
+        # Set to stop the current read thread.  Each read thread gets its own, so one that was
+        # abandoned by a timed-out stop can never be revived by the next start.
+        self.read_stop = threading.Event()
+
+        # Inter-arrival time histograms per message type, fed by the read thread
+        self.arrival_stats = ArrivalStats()
+
+        # Maps the state messages' frame counter to host time; published with each state packet
+        # as 'device_time_ns'.
+        # Refits run on the estimator's own thread, never on the read thread.
+        self.clock_estimator = DeviceClockEstimator(background=True)
+
+        # Raw report capture (see start_capture())
+        self.capture = None
+        self.capture_lock = threading.Lock()
 
         self.logger = logging.getLogger('RTST.HID')
 
@@ -35,9 +281,31 @@ class HidDeviceManager:
         self.vid_pid_endpoint_list = vid_pid_endpoint_list
         self.connect_cb = connect_cb
 
+        # Called as listener(hid_dev_mgr, connected) on every connect (before connect_cb) and
+        # disconnect, for state that belongs to one connection (see add_connection_listener()).
+        self.connection_listeners = []
+
         # Set to connect to the nth enumerated device.
         self.dev_num = dev_num
 
+        # Feature report transactions.  Requests from any thread (Tk, TA2, hotplug connect_cb) are
+        # queued and run one at a time by the transaction thread, which keeps each request paired
+        # with its reply.  The thread lives for the life of the manager; restart() leaves it running.
+        self.feature_lock = threading.Lock()
+        self.transaction_queue = queue.Queue()
+        self.transaction_stats = {}
+        self.transaction_stats_lock = threading.Lock()
+        self.transaction_thread = threading.Thread(target=self.__do_transaction_thread, daemon=True)
+        self.transaction_thread.start()
+
+        # Device supervisor.  One thread for the life of the manager does every device scan, open and
+        # unplug check, woken by hotplug events, restart() or the polling interval.
+        self.supervisor_wake = threading.Event()
+        self.run_supervisor = True
+        self.scan_retry_delay = None
+        self.supervisor_thread = threading.Thread(target=self.__do_supervisor_thread, daemon=True)
+        self.supervisor_thread.start()
+
         self.start_hotplug_thread()
 
 ##########################################################################################################
@@ -53,117 +321,395 @@ class HidDeviceManager:
         else:
             return False
 
-    def sample_handler(self, data):
+    # Decode one report.  If length is given, data is the preallocated read buffer holding a
+    # report of that many bytes and is decoded in place.  arrival_ns (CLOCK_MONOTONIC) is
+    # published with the packet as 'arrival_ns', and for controller state messages the host time
+    # the controller produced the packet (from the clock estimator) as 'device_time_ns'.
+    def sample_handler(self, data, length=None, arrival_ns=None):
         if not self.msg_handler:
             return
 
-        self.thread_lock.acquire()
-        self.last_data = self.msg_handler(data)
-        self.thread_lock.release()
+        with self.thread_lock:
+            self.decode_report(data, length, arrival_ns)
+
+    # sample_handler() without the lock.  Caller holds thread_lock.
+    def decode_report(self, data, length, arrival_ns):
+        decoded_count = getattr(self.msg_handler, 'decoded_count', None)
+        if length is None:
+            self.last_data = self.msg_handler(data)
+        else:
+            self.last_data = self.msg_handler.decode_from(data, length, arrival_ns)
+
+        # Publish a snapshot of the merged state for every packet the handler actually decoded.
+        if decoded_count is None or decoded_count != self.msg_handler.decoded_count:
+            snapshot = snapshot_data(self.last_data)
+            if arrival_ns is not None:
+                snapshot['arrival_ns'] = arrival_ns
+
+                # Only state messages carry a per-frame counter (last_packet_num, or packet_num on
+                # 0x01); status and debug messages would re-add a stale one with a later arrival.
+                msg_type = data[2]
+                record = getattr(self.msg_handler, 'last_record', None)
+                if msg_type in state_message_types and record is not None:
+                    packet_num = record[sequence_field_index[msg_type]]
+                    self.clock_estimator.add(packet_num, arrival_ns)
+                    device_time_ns = self.clock_estimator.device_time_ns(packet_num)
+                    if device_time_ns is not None:
+                        snapshot['device_time_ns'] = device_time_ns
+            self.packet_ring.push(snapshot)
+            self.published = (self.published[0] + 1, snapshot)
 
     def set_connect_cb(self, cb):
         self.connect_cb = cb
 
+    def add_connection_listener(self, listener):
+        self.connection_listeners.append(listener)
+
+    def notify_connection_listeners(self, connected):
+        for listener in self.connection_listeners:
+            try:
+                listener(self, connected)
+            except Exception as e:
+                self.logger.error('Connection listener failed: {}'.format(e))
+
     def start_hotplug_thread(self):
-        # start a timer to check for active devices
-        self.hotplug_timer = threading.Timer(.25, self.update_active_device)
-        self.hotplug_timer.start()
         self.should_reinstate_hotplug_thread = True
 
-    def __do_read_thread(self):
+        # Prefer udev / kernel hotplug events where available (Linux).  Then we only need one
+        # scan now for a device that's already plugged in.  Otherwise the supervisor polls.
+        if not self.hotplug_monitor:
+            self.hotplug_monitor = NetlinkHotplugMonitor(self.hotplug_event)
+            if self.hotplug_monitor.start():
+                self.logger.info('Using event-driven hotplug detection')
+            else:
+                self.hotplug_monitor = None
+
+        self.supervisor_wake.set()
+
+    def __do_supervisor_thread(self):
+        while True:
+            # Sleep until woken, or until the next poll / open retry is due
+            timeout = None if self.hotplug_monitor else self.HOTPLUG_POLL_S
+            if self.scan_retry_delay is not None:
+                timeout = self.scan_retry_delay if timeout is None else min(timeout, self.scan_retry_delay)
+            self.supervisor_wake.wait(timeout)
+            self.supervisor_wake.clear()
+
+            if not self.run_supervisor:
+                break
+
+            try:
+                self.check_active_device()
+            except Exception as e:
+                self.logger.error('Device check failed: {}'.format(e))
+
+            # The kernel 'add' event can arrive before udev has set the permissions on the new
+            # device node, so keep retrying the open for a little while.
+            if self.scan_retry_delay is not None:
+                if self.device or self.scan_retry_delay >= 2:
+                    self.scan_retry_delay = None
+                else:
+                    self.scan_retry_delay *= 2
+
+    # Reads time out every READ_TIMEOUT_MS so the thread notices stop within that time even if the
+    # device has gone quiet.
+    def __do_read_thread(self, device, stop):
+        # The in-place path needs a decoder that can work on a buffer.  Otherwise use the
+        # regular (allocating) read().
+        zero_copy = self.zero_copy_read and callable(getattr(self.msg_handler, 'decode_from', None))
+        batch = zero_copy and self.batch_read
+
+        wakeup_tracker = self.apply_read_scheduling()
+
+        errors = 0
         try:
-            while self.run_read_thread:
+            while not stop.is_set():
+                if wakeup_tracker:
+                    wakeup_tracker.probe(monotonic_ns())
                 try:
-                    self.sample_handler(self.device.read(64))
-                except:
-                    pass
+                    if batch:
+                        self.read_batch(device, stop)
+                    elif zero_copy:
+                        length = self.read_into_buffer(device, self.READ_TIMEOUT_MS)
+                        arrival_ns = monotonic_ns()
+                        if not length or stop.is_set():
+                            continue
+                        if length > 2:
+                            self.arrival_stats.add(self.read_buffer[2], arrival_ns)
+                            if self.capture:
+                                self.capture_report(self.read_view[:length], arrival_ns)
+                        self.sample_handler(self.read_view, length, arrival_ns)
+                    else:
+                        data = device.read(self.REPORT_SIZE, self.READ_TIMEOUT_MS)
+                        arrival_ns = monotonic_ns()
+                        if not data or stop.is_set():
+                            continue
+                        if len(data) > 2:
+                            self.arrival_stats.add(data[2], arrival_ns)
+                            if self.capture:
+                                self.capture_report(data, arrival_ns)
+                        self.sample_handler(data, None, arrival_ns)
+                    errors = 0
+                except Exception as e:
+                    errors += 1
+                    if errors == 1:
+                        self.logger.warning('Read thread error: {}'.format(e))
+                    if errors >= self.READ_ERROR_LIMIT:
+                        break
+                    stop.wait(self.READ_ERROR_BACKOFF_S * 2 ** (errors - 1))
         except:
             pass
 
-    def start_read_thread(self):
-        self.thread_lock.acquire()
-        if self.device:
-            self.logger.info("Opening device")
-            sys.stdout.flush()
-            # self.device.open()
+        # The read thread is the only reader, so it's safe to release the device once it's done.
+        try:
+            device.close()
+        except:
+            pass
 
-            if self.connect_cb:
-                self.connect_cb(self)
+        if errors >= self.READ_ERROR_LIMIT and not stop.is_set():
+            self.logger.warning('{} read thread errors in a row, reopening the device'.format(errors))
+            self.lost_connection(device)
+
+    # Called on the read thread.  Applies the requested CPU / policy / nice, and returns the
+    # WakeupLatencyTracker the thread should probe between reads (None without scheduling options).
+    def apply_read_scheduling(self):
+        if self.read_cpu is None and self.read_fifo_priority is None and self.read_nice is None:
+            return None
+
+        sched = apply_thread_scheduling(self.read_cpu, self.read_fifo_priority, self.read_nice)
+        for error in sched['errors']:
+            self.logger.warning('Read thread scheduling: {}'.format(error))
+        self.read_scheduling = sched
+        self.wakeup_tracker = WakeupLatencyTracker()
+
+        self.logger.info('Read thread: {} priority {} nice {} cpus {}'.format(
+            sched.get('policy'), sched.get('priority'), sched.get('nice'), sched.get('cpus')))
+        return self.wakeup_tracker
+
+    # {'policy', 'priority', 'nice', 'cpus', 'errors'} for the current read thread plus its wakeup
+    # latency so far ('wakeup_p50_us', 'wakeup_p99_us', 'wakeup_max_us', 'wakeup_recent_max_us' over
+    # the last 10 s, 'wakeup_probes'), or {} if no scheduling options were given.
+    def get_read_scheduling(self):
+        if not self.read_scheduling:
+            return {}
+        sched = dict(self.read_scheduling)
+        if self.wakeup_tracker:
+            sched.update(self.wakeup_tracker.summary())
+        return sched
+
+    # Block for one report, then drain whatever else is already queued, and decode the lot under
+    # one lock acquisition.  Returns the number of reports read.  The first read gives up after
+    # READ_TIMEOUT_MS, and nothing is decoded once stop is set.
+    def read_batch(self, device, stop=None):
+        buffers = self.batch_buffers
+        dirty_lens = self.batch_dirty_lens
+        lengths = self.batch_lengths
+        arrivals = self.batch_arrivals
+
+        count = 0
+        timeout_ms = self.READ_TIMEOUT_MS
+        while count < self.READ_BATCH_SIZE:
+            length = device.readinto(buffers[count], self.REPORT_SIZE, timeout_ms)
+            if length < dirty_lens[count]:
+                ctypes.memset(ctypes.addressof(self.batch_arrays[count]) + length, 0, dirty_lens[count] - length)
+            dirty_lens[count] = length
+            if not length:
+                break
+
+            lengths[count] = length
+            arrivals[count] = monotonic_ns()
+            count += 1
+            timeout_ms = 0
+
+        if not count or (stop and stop.is_set()):
+            return 0
 
-            sys.stdout.flush()
-            self.run_read_thread = True
-            self.read_thread = threading.Thread(target=self.__do_read_thread)
-            self.read_thread.start()
-        self.thread_lock.release()
+        views = self.batch_views
+        for i in range(count):
+            if lengths[i] > 2:
+                self.arrival_stats.add(buffers[i][2], arrivals[i])
+                if self.capture:
+                    self.capture_report(views[i][:lengths[i]], arrivals[i])
+
+        if self.msg_handler:
+            with self.thread_lock:
+                for i in range(count):
+                    self.decode_report(views[i], lengths[i], arrivals[i])
+
+        self.read_batches += 1
+        self.read_batch_reports += count
+        return count
+
+    # {'batches', 'reports', 'avg_batch'} since the last reset.  Only counts in batch_read mode.
+    def get_read_batch_stats(self):
+        batches = self.read_batches
+        reports = self.read_batch_reports
+        return {
+            'batches': batches,
+            'reports': reports,
+            'avg_batch': reports / batches if batches else 0.,
+        }
+
+    def reset_read_batch_stats(self):
+        self.read_batches = 0
+        self.read_batch_reports = 0
+
+    def capture_report(self, report, arrival_ns):
+        with self.capture_lock:
+            if self.capture:
+                self.capture.write(arrival_ns, report)
+
+    # Start writing every raw input report, with its CLOCK_MONOTONIC arrival time, to path
+    # (see hid_capture.py).  Replaces any capture already running.
+    def start_capture(self, path):
+        capture = HidCaptureWriter(path, getattr(self, 'device_vendor_id', 0) or 0, getattr(self, 'device_product_id', 0) or 0)
+        self.stop_capture()
+        with self.capture_lock:
+            self.capture = capture
+        self.logger.info('Capturing input reports to {}'.format(path))
+
+    # Returns the number of reports captured
+    def stop_capture(self):
+        with self.capture_lock:
+            capture = self.capture
+            self.capture = None
+        if not capture:
+            return 0
+
+        capture.close()
+        self.logger.info('Captured {} reports to {}'.format(capture.record_count, capture.path))
+        return capture.record_count
+
+    # Read one report straight into the preallocated read buffer and return its length.
+    # Bytes past the report are kept zeroed.
+    def read_into_buffer(self, device, timeout_ms=None):
+        length = device.readinto(self.read_buffer, self.REPORT_SIZE, timeout_ms)
 
+        if length < self.read_dirty_len:
+            ctypes.memset(ctypes.addressof(self.read_array) + length, 0, self.read_dirty_len - length)
+        self.read_dirty_len = length
+
+        return length
+
+    def start_read_thread(self):
+        with self.thread_lock:
+            if self.device:
+                self.logger.info("Opening device")
+                sys.stdout.flush()
+                # self.device.open()
+
+                self.notify_connection_listeners(True)
+                if self.connect_cb:
+                    self.connect_cb(self)
+
+                sys.stdout.flush()
+                self.arrival_stats = ArrivalStats()
+                self.clock_estimator.close()
+                self.clock_estimator = DeviceClockEstimator(background=True)
+                self.read_stop = threading.Event()
+                self.read_thread = threading.Thread(target=self.__do_read_thread, args=(self.device, self.read_stop), daemon=True)
+                self.read_thread.start()
+
+    # Each stop waits at most SHUTDOWN_TIMEOUT_S for its thread.
     def shutdown(self):
         self.stop_read_thread()
         self.stop_hotplug_thread()
-
+        self.stop_supervisor_thread()
+        self.stop_transaction_thread()
+        self.stop_capture()
+        self.clock_estimator.close()
+
+    # Drops the device and has the supervisor look for it again.  Returns once the old read thread
+    # has stopped; the reconnect happens in the background.  Queued transactions stay queued and run
+    # against the new device once it's open (or time out).
     def restart(self):
         self.logger.info('Restarting device manager')
-        self.device = None
-        self.shutdown()
-        sleep(.1)
-        self.start_hotplug_thread()
+        with self.hotplug_lock:
+            self.device = None
+            self.stop_read_thread()
+            self.should_reinstate_hotplug_thread = True
+        self.supervisor_wake.set()
+
+    def stop_transaction_thread(self):
+        if not self.transaction_thread:
+            return
+
+        self.transaction_queue.put(None)
+        if threading.current_thread() is not self.transaction_thread:
+            self.transaction_thread.join(self.SHUTDOWN_TIMEOUT_S)
+        self.transaction_thread = None
 
+    # Stops device scanning; the supervisor thread itself keeps running until shutdown().
     def stop_hotplug_thread(self):
-        # shutdown the find thread
         self.should_reinstate_hotplug_thread = False
+        self.scan_retry_delay = None
 
-        if self.hotplug_timer:
-            self.hotplug_timer.cancel()
-            self.hotplug_timer = None
+        if self.hotplug_monitor:
+            self.hotplug_monitor.stop()
+            self.hotplug_monitor = None
 
-    def stop_read_thread(self):
-        if self.read_thread:
+    def stop_supervisor_thread(self):
+        if not self.supervisor_thread:
+            return
 
-            self.run_read_thread = False
-            self.read_thread.join()
+        self.run_supervisor = False
+        self.supervisor_wake.set()
+        if threading.current_thread() is not self.supervisor_thread:
+            self.supervisor_thread.join(self.SHUTDOWN_TIMEOUT_S)
+        self.supervisor_thread = None
+
+    # The read thread sees stop within READ_TIMEOUT_MS.  One stuck in the driver past
+    # SHUTDOWN_TIMEOUT_S is abandoned (it's a daemon, and closes its device if it ever returns).
+    def stop_read_thread(self):
+        read_thread = self.read_thread
+        if read_thread:
+            self.read_stop.set()
+            if threading.current_thread() is not read_thread:
+                read_thread.join(self.SHUTDOWN_TIMEOUT_S)
+                if read_thread.is_alive():
+                    self.logger.warning('Read thread did not stop within {} s, abandoning it'.format(self.SHUTDOWN_TIMEOUT_S))
 
             self.clear_data()
             self.read_thread = None
             self.device = None
+            self.notify_connection_listeners(False)
 
     def device_is_plugged(self):
-        for dev in hid.enumerate(self.device_vendor_id,self.device_product_id):
+        for dev in self.backend.enumerate(self.device_vendor_id,self.device_product_id):
             if self.device_path == dev['path']:
                 return True
         return False
 
-    def update_active_device(self):
-        if not self.should_reinstate_hotplug_thread:
-            return
-        if self.device:
-            if self.device_is_plugged() == False:
-                self.logger.info('Device unplugged')
-                sys.stdout.flush()
-                self.stop_read_thread()
-        else:
-            # check for new devices
-            self.find_device()
-
-        # reinstall the timer
-        self.hotplug_timer = threading.Timer(.5, self.update_active_device)
-        self.hotplug_timer.start()
+    def check_active_device(self):
+        with self.hotplug_lock:
+            if not self.should_reinstate_hotplug_thread:
+                return
+            if self.device:
+                if self.device_is_plugged() == False:
+                    self.logger.info('Device unplugged')
+                    sys.stdout.flush()
+                    self.stop_read_thread()
+            else:
+                # check for new devices
+                self.find_device()
+
+    # Event-driven hotplug, called on the monitor thread.  action is 'add' or 'remove'.  The
+    # supervisor does the actual work.
+    def hotplug_event(self, action, devname):
+        if action == 'add':
+            self.scan_retry_delay = .05
+        self.supervisor_wake.set()
 
     def find_device(self):
         self.device = None
         devs_found = 0
 
         for (vid, pid) in self.vid_pid_endpoint_list:
-            connected_controllers = hid.enumerate(vid, pid)
+            connected_controllers = self.backend.enumerate(vid, pid)
 
             for dev in connected_controllers:
                 # check for specific endpoint if desired
-                found = False
-                if sys.platform == 'win32':
-                    if dev['usage_page'] >= 0xFF00:
-                        found = True
-                else:
-                    if dev['interface_number'] == 2:
-                        found = True    
-
+                found = is_controller_endpoint(dev)
 
                 # Connect only to the specified nth found device.
                 if found:
@@ -174,10 +720,10 @@ class HidDeviceManager:
                 self.logger.info('HID Mgr: Found match for endpoint w/ VID: {} PID: {}'.format(hex(vid), hex(pid)))
 
                 try:
-                    self.device = hid.Device(path=dev['path'])
-                except hid.HIDException as e:
-                    if e.args[0] != 'unable to open device':
-                        raise e
+                    self.device = self.backend.open(dev['path'])
+                except self.backend.open_errors as e:
+                    self.logger.info('Unable to open device: {}'.format(e))
+                    self.device = None
                     return
 
                 self.device_vendor_id = vid
@@ -200,14 +746,58 @@ class HidDeviceManager:
 ##########################################################################################################
 ## Data methods
 ##########################################################################################################
+    # Returns a private copy (a dict) of the latest data that the caller may modify.
     def get_data(self):
-        self.thread_lock.acquire()
-        data_copy = copy.copy(self.last_data)
-        self.thread_lock.release()
-        return data_copy
+        return self.published[1].copy()
+
+    # Returns a read-only view of the latest data without copying it.  The view stays consistent
+    # (it's one packet's state) even while newer packets are published.
+    def get_data_view(self):
+        return types.MappingProxyType(self.published[1])
+
+    # Returns (sequence number, read-only view) so pollers can cheaply tell whether anything new
+    # arrived since their last call.
+    def get_data_seq(self):
+        (seq, data) = self.published
+        return (seq, types.MappingProxyType(data))
+
+    # Latest published StateVector (see state_vector.py) for consumers that index fields by
+    # integer, or None if the handler doesn't keep one.  Read-only, like get_data_view().
+    def get_state(self):
+        return getattr(self.published[1], 'state', None)
+
+    # Get a cursor that returns every packet decoded after this call (see PacketCursor.read())
+    def new_packet_cursor(self, from_start=False):
+        return self.packet_ring.new_cursor(from_start)
+
+    # {msg_type: {'count', 'mean_us', 'p50_us', 'p95_us', 'p99_us', 'max_us'}} of the time between
+    # consecutive reports of each message type, as seen by the read thread.
+    def get_arrival_stats(self):
+        return self.arrival_stats.get_stats()
+
+    # Summary for the most frequent message type (the controller state stream), or None
+    def get_state_arrival_stats(self):
+        arrival_stats = self.arrival_stats
+        msg_type = arrival_stats.busiest_type()
+        if msg_type is None:
+            return None
+        return arrival_stats.histograms[msg_type].summary()
+
+    def reset_arrival_stats(self):
+        self.arrival_stats = ArrivalStats()
+
+    # Controller frame period, drift from nominal (ppm) and transport latency jitter, see
+    # clock_estimator.py.  Empty until enough packets have arrived.
+    def get_clock_stats(self):
+        return self.clock_estimator.get_stats()
+
+    # Host CLOCK_MONOTONIC time in ns at which the controller produced packet_num, or None
+    def device_time_ns(self, packet_num):
+        return self.clock_estimator.device_time_ns(packet_num)
 
     def clear_data(self):
         self.last_data = {}
+        self.published = (self.published[0], {})
 
         # If the registered message handler has a clear_data() method
         # then call it.
@@ -217,42 +807,138 @@ class HidDeviceManager:
 ##########################################################################################################
 ## Comms methods
 ##########################################################################################################
-    def send_feature_report(self, feature_report_type, report_bytes):
-        if not self.is_open():
-            return False
-
-        if isinstance(report_bytes, str):
-            report_bytes = report_bytes.encode()
-
-        # First byte is Feature Report type.  We'll stills end 64B of payload, but
-        # need this value prepended for PyHid
-        feature_report = struct.pack('=BBB', 0, feature_report_type, len(report_bytes)) + report_bytes
-        
-        hid_len = 64		
-        # pack the remainder of the hid_len + 1 bytes w/ 0's
-        feature_report += b'\0' * (hid_len + 1 - len(feature_report))
-        
+    # Queue a feature report and return a concurrent.futures.Future.  With reply=True the future's
+    # result is (report_type, report_length, report_bytes) of the reply, otherwise whether the
+    # report was sent.  If the transaction hasn't started within timeout seconds the future raises
+    # TimeoutError.  Safe to call from any thread; transactions run in submission order.
+    def submit_transaction(self, feature_report_type, report_bytes, reply=True, timeout=None):
+        if timeout is None:
+            timeout = self.TRANSACTION_TIMEOUT_S
+
+        future = Future()
+        if not self.transaction_thread:
+            future.set_result(self.NO_REPLY if reply else False)
+            return future
+
+        submit_time = perf_counter()
+        self.transaction_queue.put((feature_report_type, report_bytes, reply, submit_time, submit_time + timeout, future))
+        return future
+
+    # Send a feature report and (with reply=True) wait for its reply.  Returns the same values as the
+    # future from submit_transaction(), or NO_REPLY / False on timeout.
+    def transaction(self, feature_report_type, report_bytes, reply=True, timeout=None):
+        if timeout is None:
+            timeout = self.TRANSACTION_TIMEOUT_S
+
+        future = self.submit_transaction(feature_report_type, report_bytes, reply, timeout)
         try:
-            return (self.device.send_feature_report(feature_report) > 0)
-        except:
-            self.logger.info('Lost connection -- Restarting')
-            self.restart()
-            return 0
+            # A transaction that already started gets to finish; the HID call itself can't be abandoned.
+            return future.result(timeout)
+        except FutureTimeoutError:
+            if future.cancel():
+                return self.NO_REPLY if reply else False
+            return future.result()
+
+    def send_feature_report(self, feature_report_type, report_bytes):
+        return self.transaction(feature_report_type, report_bytes, reply=False)
 
+    # Read a pending reply outside of a transaction.  Prefer transaction(), which can't pick up
+    # another caller's reply.
     def get_feature_report(self):
-        if not self.is_open():
-            return (0, 0, '')
+        device = self.device
+        if not device:
+            return self.NO_REPLY
 
-        hid_len = 64
-        
         try:
-            report = self.device.get_feature_report(0, hid_len + 1)
-            report_type = report[1]
-            report_length = report[2]
-            report_bytes = report[3: 3 + report_length]
-            return (report_type, report_length, report_bytes)
+            with self.feature_lock:
+                return unpack_feature_report(device.get_feature_report(0, FEATURE_REPORT_SIZE + 1))
         except:
-            self.logger.info('Lost connection -- Restarting')
-            self.restart()
-            return 0
-        
\ No newline at end of file
+            self.lost_connection(device)
+            return self.NO_REPLY
+
+    # {opcode: summary dict} of everything run since the last reset_transaction_stats()
+    def get_transaction_stats(self):
+        with self.transaction_stats_lock:
+            return {op: stats.summary() for op, stats in self.transaction_stats.items()}
+
+    def reset_transaction_stats(self):
+        with self.transaction_stats_lock:
+            self.transaction_stats = {}
+
+    def __do_transaction_thread(self):
+        while True:
+            item = self.transaction_queue.get()
+            if item is None:
+                break
+
+            (feature_report_type, report_bytes, reply, submit_time, deadline, future) = item
+
+            # Cancelled by a caller that gave up waiting
+            if not future.set_running_or_notify_cancel():
+                with self.transaction_stats_lock:
+                    self.get_opcode_stats(feature_report_type).timeouts += 1
+                continue
+
+            start_time = perf_counter()
+            if start_time > deadline:
+                with self.transaction_stats_lock:
+                    self.get_opcode_stats(feature_report_type).timeouts += 1
+                future.set_exception(FutureTimeoutError('Feature report 0x{:02x} timed out in queue'.format(feature_report_type)))
+                continue
+
+            (result, ok) = self.run_transaction(feature_report_type, report_bytes, reply)
+            end_time = perf_counter()
+
+            with self.transaction_stats_lock:
+                stats = self.get_opcode_stats(feature_report_type)
+                stats.add(submit_time, start_time, end_time)
+                if not ok:
+                    stats.errors += 1
+                elif reply and result[0] != feature_report_type:
+                    stats.mismatches += 1
+
+            future.set_result(result)
+
+        # Fail anything still queued so no caller waits forever
+        while True:
+            try:
+                item = self.transaction_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None and item[5].set_running_or_notify_cancel():
+                item[5].set_result(self.NO_REPLY if item[2] else False)
+
+    # Caller holds transaction_stats_lock
+    def get_opcode_stats(self, feature_report_type):
+        stats = self.transaction_stats.get(feature_report_type)
+        if not stats:
+            stats = self.transaction_stats[feature_report_type] = TransactionStats()
+        return stats
+
+    # Send one feature report and read its reply as a unit.  Returns (result, ok).
+    def run_transaction(self, feature_report_type, report_bytes, reply):
+        device = self.device
+        if not device:
+            return ((self.NO_REPLY if reply else False), False)
+
+        feature_report = pack_feature_report(feature_report_type, report_bytes)
+        try:
+            with self.feature_lock:
+                sent = device.send_feature_report(feature_report) > 0
+                if not reply:
+                    return (sent, sent)
+                return (unpack_feature_report(device.get_feature_report(0, FEATURE_REPORT_SIZE + 1)), True)
+        except:
+            self.lost_connection(device)
+            return ((self.NO_REPLY if reply else False), False)
+
+    def lost_connection(self, device):
+        # The device may just have been closed by an unplug or restart, which is already handled.
+        if device is not self.device:
+            return
+        self.logger.info('Lost connection -- Restarting')
+        self.device = None
+
+        # Restart from its own thread.  restart() takes the hotplug lock, which the supervisor holds
+        # while connect_cb may itself be waiting on a transaction.
+        threading.Thread(target=self.restart, daemon=True).start()
@@ -0,0 +1,164 @@
+import os
+import sys
+import glob
+import select
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+##########################################################################################################
+## Native Linux hidraw transport
+##
+##   Talks to /dev/hidrawN directly: input reports with os.readv() into the caller's buffer (epoll
+##   when a timeout is requested) and feature reports with the HIDIOCSFEATURE / HIDIOCGFEATURE
+##   ioctls.  This skips the hidapi ctypes layer entirely.  HidrawBackend provides enumerate() and
+##   open() with the same shape as the hidapi backend in hid_dev_mgr.py.
+##########################################################################################################
+
+# ioctl request encoding from <asm-generic/ioctl.h>
+_IOC_WRITE = 1
+_IOC_READ = 2
+
+def _IOC(direction, type, nr, size):
+    return (direction << 30) | (size << 16) | (ord(type) << 8) | nr
+
+def HIDIOCSFEATURE(length):
+    return _IOC(_IOC_WRITE | _IOC_READ, 'H', 0x06, length)
+
+def HIDIOCGFEATURE(length):
+    return _IOC(_IOC_WRITE | _IOC_READ, 'H', 0x07, length)
+
+class HidrawDevice:
+    def __init__(self, path):
+        if isinstance(path, bytes):
+            path = path.decode()
+
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CLOEXEC)
+        self.epoll = select.epoll()
+        self.epoll.register(self.fd, select.EPOLLIN)
+
+        # readv() scatter lists by (buffer id, size).  The read thread cycles through a fixed set of buffers.
+        self.iovs = {}
+
+    def fileno(self):
+        return self.fd
+
+    # Read one input report into buffer and return its length.  timeout_ms=None blocks,
+    # otherwise 0 is returned if no report arrives in time.
+    def readinto(self, buffer, size, timeout_ms=None):
+        if timeout_ms is not None and not self.epoll.poll(timeout_ms / 1000.):
+            return 0
+
+        iov = self.iovs.get((id(buffer), size))
+        if iov is None:
+            iov = self.iovs[(id(buffer), size)] = [memoryview(buffer)[:size]]
+
+        return os.readv(self.fd, iov)
+
+    def read(self, size, timeout=None):
+        if timeout is not None and not self.epoll.poll(timeout / 1000.):
+            return b''
+        return os.read(self.fd, size)
+
+    # data[0] is the report ID, like hidapi.  Returns the number of bytes sent.
+    def send_feature_report(self, data):
+        buf = bytearray(data)
+        return fcntl.ioctl(self.fd, HIDIOCSFEATURE(len(buf)), buf, True)
+
+    # Returns the report (including the report ID byte), like hidapi.
+    def get_feature_report(self, report_id, size):
+        buf = bytearray(size)
+        buf[0] = report_id
+        length = fcntl.ioctl(self.fd, HIDIOCGFEATURE(size), buf, True)
+        return bytes(buf[:length])
+
+    def close(self):
+        if self.fd is None:
+            return
+
+        self.epoll.close()
+        os.close(self.fd)
+        self.fd = None
+
+class HidrawBackend:
+    name = 'hidraw'
+
+    # Exceptions that mean the device exists but can't be opened (yet).
+    open_errors = (OSError,)
+
+    def __init__(self):
+        self.logger = logging.getLogger('RTST.HIDRAW')
+
+    @staticmethod
+    def is_supported():
+        return sys.platform.startswith('linux') and fcntl is not None
+
+    # Same dict keys as hid.enumerate() for the fields we use.
+    def enumerate(self, vid=0, pid=0):
+        devices = []
+        for sys_path in sorted(glob.glob('/sys/class/hidraw/hidraw*')):
+            info = self.read_device_info(sys_path)
+            if not info:
+                continue
+            if vid and info['vendor_id'] != vid:
+                continue
+            if pid and info['product_id'] != pid:
+                continue
+            devices.append(info)
+        return devices
+
+    def open(self, path):
+        return HidrawDevice(path)
+
+    def read_device_info(self, sys_path):
+        uevent = {}
+        try:
+            with open(os.path.join(sys_path, 'device', 'uevent')) as f:
+                for line in f:
+                    key, _, val = line.strip().partition('=')
+                    uevent[key] = val
+        except OSError:
+            return None
+
+        # HID_ID=<bus>:<vendor>:<product>
+        try:
+            (_, vid, pid) = uevent['HID_ID'].split(':')
+        except (KeyError, ValueError):
+            return None
+
+        # The hid device sits under the USB interface it belongs to.
+        interface_number = -1
+        hid_device = os.path.realpath(os.path.join(sys_path, 'device'))
+        try:
+            with open(os.path.join(os.path.dirname(hid_device), 'bInterfaceNumber')) as f:
+                interface_number = int(f.read().strip(), 16)
+        except (OSError, ValueError):
+            pass
+
+        return {
+            'path': ('/dev/' + os.path.basename(sys_path)).encode(),
+            'vendor_id': int(vid, 16),
+            'product_id': int(pid, 16),
+            'serial_number': uevent.get('HID_UNIQ', ''),
+            'product_string': uevent.get('HID_NAME', ''),
+            'interface_number': interface_number,
+            'usage_page': self.read_usage_page(sys_path),
+        }
+
+    # First Usage Page item of the report descriptor, which is what hidapi reports too.
+    def read_usage_page(self, sys_path):
+        try:
+            with open(os.path.join(sys_path, 'device', 'report_descriptor'), 'rb') as f:
+                desc = f.read(3)
+        except OSError:
+            return 0
+
+        if len(desc) >= 3 and desc[0] == 0x06:
+            return desc[1] | (desc[2] << 8)
+        if len(desc) >= 2 and desc[0] == 0x05:
+            return desc[1]
+        return 0
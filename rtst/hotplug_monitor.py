@@ -0,0 +1,134 @@
+import os
+import sys
+import socket
+import select
+import struct
+import threading
+import logging
+
+##########################################################################################################
+## Linux hotplug monitor
+##
+##   Listens for kernel / udev uevents on a NETLINK_KOBJECT_UEVENT socket and reports add / remove
+##   events for the requested subsystems (hidraw by default).  The thread sleeps in select() until
+##   an event arrives, so it costs nothing while idle.  Use is_supported() to decide whether to
+##   fall back to polling hid.enumerate().
+##########################################################################################################
+class NetlinkHotplugMonitor:
+    NETLINK_KOBJECT_UEVENT = 15
+
+    # Multicast groups: 1 = raw kernel events, 2 = events re-broadcast by udev after its rules ran
+    # (i.e. once device node permissions are in place).
+    GROUP_KERNEL = 1
+    GROUP_UDEV = 2
+
+    UDEV_MONITOR_MAGIC = 0xfeedcafe
+
+    def __init__(self, event_cb, subsystems=('hidraw',)):
+        self.logger = logging.getLogger('RTST.HOTPLUG')
+        self.event_cb = event_cb
+        self.subsystems = set(subsystems)
+
+        self.sock = None
+        self.thread = None
+        self.run_thread = False
+        self.wake_r = None
+        self.wake_w = None
+
+    @staticmethod
+    def is_supported():
+        return sys.platform.startswith('linux') and hasattr(socket, 'AF_NETLINK')
+
+    # Open the netlink socket and start the monitor thread.  Returns False if the socket can't be
+    # opened (e.g. in a sandbox without netlink access) so the caller can fall back to polling.
+    def start(self):
+        if not self.is_supported():
+            return False
+
+        try:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, self.NETLINK_KOBJECT_UEVENT)
+            self.sock.bind((0, self.GROUP_KERNEL | self.GROUP_UDEV))
+        except OSError as e:
+            self.logger.info('Netlink hotplug unavailable ({}), falling back to polling'.format(e))
+            if self.sock:
+                self.sock.close()
+                self.sock = None
+            return False
+
+        # Self-pipe so stop() can wake the thread immediately.
+        self.wake_r, self.wake_w = os.pipe()
+
+        self.run_thread = True
+        self.thread = threading.Thread(target=self.__do_monitor_thread, daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        if not self.thread:
+            return
+
+        self.run_thread = False
+        os.write(self.wake_w, b'\0')
+
+        # stop() may be called from an event callback (e.g. a restart on a failed feature report)
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
+
+        self.thread = None
+        self.sock.close()
+        self.sock = None
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+        self.wake_r = self.wake_w = None
+
+    def __do_monitor_thread(self):
+        while self.run_thread:
+            try:
+                readable, _, _ = select.select([self.sock, self.wake_r], [], [])
+            except (OSError, ValueError):
+                break
+
+            if not self.run_thread or self.wake_r in readable:
+                break
+
+            try:
+                msg = self.sock.recv(8192)
+            except OSError:
+                continue
+
+            event = self.parse_uevent(msg)
+            if not event or event.get('SUBSYSTEM') not in self.subsystems:
+                continue
+
+            action = event.get('ACTION')
+            if action not in ('add', 'remove'):
+                continue
+
+            try:
+                self.event_cb(action, event.get('DEVNAME'))
+            except Exception as e:
+                self.logger.error('Hotplug callback failed: {}'.format(e))
+
+    # Parse either a raw kernel uevent ("action@devpath\0KEY=VAL\0...") or a udev monitor message
+    # (binary header followed by the same KEY=VAL\0 properties).  Returns a dict of properties.
+    @classmethod
+    def parse_uevent(cls, msg):
+        if msg.startswith(b'libudev\0'):
+            if len(msg) < 24:
+                return None
+            (magic,) = struct.unpack_from('!I', msg, 8)
+            (_, properties_off, properties_len) = struct.unpack_from('=3I', msg, 12)
+            if magic != cls.UDEV_MONITOR_MAGIC:
+                return None
+            payload = msg[properties_off:properties_off + properties_len]
+        else:
+            header, _, payload = msg.partition(b'\0')
+            if b'@' not in header:
+                return None
+
+        event = {}
+        for entry in payload.split(b'\0'):
+            key, sep, val = entry.partition(b'=')
+            if sep:
+                event[key.decode(errors='replace')] = val.decode(errors='replace')
+        return event
@@ -7,6 +7,8 @@ from time import sleep
 from ui import UIRoot, UIHelp
 from controller_if import ControllerInterface
 from valve_message_handler import ValveMessageHandler
+from virtual_device import VirtualBackend
+from hid_capture import ReplayBackend
 
 __version__ = "$Revision: #33 $"
 __date__ = "$DateTime: 2023/06/06 11:08:41 $"
@@ -678,11 +680,38 @@ def connect_cb(hid_dev_mgr):
 ## MAIN ENTRY
 ##########################################################################################################
 
-parser = argparse.ArgumentParser()
+# NumPy is optional (pip install numpy).  Without it the noise spectrum group stays off and Rushmore
+# frames use array('h'); batch_decoder.py and trackpad_vis_rushmore.py need it.
+parser = argparse.ArgumentParser(epilog='Optional: NumPy (pip install numpy) enables the noise spectrum analysis.')
 parser.add_argument('--chinese', '-c', action='store_true', default=False)
 parser.add_argument('--tcpip', '-t', action='store_true', default=False)
+parser.add_argument('--backend', choices=('hidapi', 'hidraw', 'virtual', 'replay'), default='hidapi',
+                    help='HID transport. hidraw talks to /dev/hidraw* directly (Linux only), virtual simulates a controller, replay plays back a --capture file')
+parser.add_argument('--virtual-rate', type=int, default=1000, help='Virtual controller frame rate in Hz (125 - 8000)')
+parser.add_argument('--virtual-loss', type=float, default=0.0, help='Fraction of virtual controller frames to drop')
+parser.add_argument('--virtual-seed', type=int, default=0, help='Virtual controller signal generator seed')
+parser.add_argument('--virtual-debug', action='store_true', default=False, help='Virtual controller also sends trackpad debug and Rushmore reports')
+parser.add_argument('--virtual-latency', type=float, default=0.0, help='Virtual controller feature report reply latency in seconds')
+parser.add_argument('--virtual-store', default=None, help='File the virtual controller keeps its settings and calibration in')
+parser.add_argument('--batch-read', action='store_true', default=False, help='Drain and decode all queued input reports per read wakeup')
+parser.add_argument('--reader-cpu', type=int, default=None, help='Pin the HID read thread to this CPU')
+parser.add_argument('--reader-fifo', type=int, default=None, metavar='PRIORITY', help='Run the HID read thread SCHED_FIFO at this priority (1 - 99, needs CAP_SYS_NICE or RLIMIT_RTPRIO)')
+parser.add_argument('--reader-nice', type=int, default=None, help='Nice value for the HID read thread (negative needs CAP_SYS_NICE)')
+parser.add_argument('--capture', default=None, help='Write every raw input report, timestamped, to this file')
+parser.add_argument('--replay', default=None, help='Capture file to play back with --backend replay')
+parser.add_argument('--replay-speed', type=float, default=1.0, help='Replay speed as a multiple of real time, 0 = as fast as possible')
+parser.add_argument('--replay-loop', action='store_true', default=False, help='Restart the replay when it reaches the end')
 args = parser.parse_args()
 
+backend = args.backend
+if backend == 'virtual':
+    backend = VirtualBackend(args.virtual_rate, args.virtual_loss, args.virtual_seed, args.virtual_debug, args.virtual_debug,
+                             feature_latency_s=args.virtual_latency, store_path=args.virtual_store)
+elif backend == 'replay':
+    if not args.replay:
+        parser.error('--backend replay needs --replay FILE')
+    backend = ReplayBackend(args.replay, args.replay_speed, args.replay_loop)
+
 ##########################################################################################################
 ## LANGUAGE SETUP
 ##########################################################################################################
@@ -733,7 +762,10 @@ logger.addHandler(ch)
 root = Tk.Tk()
 truncated_version = __version__[12:-1]
 root.wm_title("Jupiter Real-Time Status Tool - vB" + truncated_version)
-cntrlr_mgr = ControllerInterface( get_current_ep_list(), connect_cb)
+cntrlr_mgr = ControllerInterface( get_current_ep_list(), connect_cb, backend=backend, batch_read=args.batch_read,
+                                  read_cpu=args.reader_cpu, read_fifo_priority=args.reader_fifo, read_nice=args.reader_nice)
+if args.capture:
+    cntrlr_mgr.start_capture(args.capture)
 
 top_frame = Tk.Frame(root, bg = color_pallete[0])
 canvas = Tk.Canvas(top_frame, bg = color_pallete[0], bd=-2, highlightthickness=0)
@@ -17,6 +17,9 @@ eng_loc = {
     'Missed Packets':       'Missed Packets',
     'Avg. Missed/s':        'Avg. Missed/s',
     'Frame Rate':           'Frame Rate',
+    'Interval p50 (us)':    'Interval p50 (us)',
+    'Interval p99 (us)':    'Interval p99 (us)',
+    'Interval Max (us)':    'Interval Max (us)',
 
     'Trackpad':             'Trackpad',
     'X Left':               'X Left',
@@ -144,6 +147,9 @@ chi_loc = {
     'Missed Packets':       '丢失数据包数量',
     'Avg. Missed/s':        '平均数据包丢失率',
     'Frame Rate':           '帧刷新率',
+    'Interval p50 (us)':    '包间隔 p50 (微秒)',
+    'Interval p99 (us)':    '包间隔 p99 (微秒)',
+    'Interval Max (us)':    '包间隔最大值 (微秒)',
 
     'Trackpad':             '触摸板',
     'X Left':               '触摸板X轴左边',
@@ -0,0 +1,404 @@
+import types
+import ctypes
+from time import monotonic_ns
+import select
+import threading
+import logging
+
+from hid_dev_mgr import HidDeviceManager, hid_backends, is_controller_endpoint, pack_feature_report, unpack_feature_report, \
+    FEATURE_REPORT_SIZE
+from hotplug_monitor import NetlinkHotplugMonitor
+from packet_ring import PacketRingBuffer
+from arrival_stats import ArrivalStats
+from valve_message_handler import ValveMessageHandler
+from state_vector import snapshot_data
+
+##########################################################################################################
+## One streaming controller inside a MultiHidDeviceManager
+##########################################################################################################
+class DeviceStream:
+    REPORT_SIZE = 64
+    READ_BUFFER_SIZE = 128
+
+    def __init__(self, device_id, dev_info, device, msg_handler, packet_ring_size):
+        self.device_id = device_id
+        self.path = dev_info['path']
+        self.serial = dev_info.get('serial_number') or ''
+        self.vendor_id = dev_info['vendor_id']
+        self.product_id = dev_info['product_id']
+
+        self.device = device
+        self.msg_handler = msg_handler
+        self.feature_lock = threading.Lock()
+
+        # Same preallocated in-place read path as HidDeviceManager
+        self.read_buffer = bytearray(self.READ_BUFFER_SIZE)
+        self.read_array = (ctypes.c_char * self.READ_BUFFER_SIZE).from_buffer(self.read_buffer)
+        self.read_view = memoryview(self.read_buffer)
+        self.read_dirty_len = 0
+
+        self.packet_ring = PacketRingBuffer(packet_ring_size)
+        self.published = (0, {})
+        self.arrival_stats = ArrivalStats()
+
+        self.run_read_thread = False
+        self.read_thread = None
+
+        # Set when reading failed; the supervisor closes the stream and reopens the device
+        self.failed = False
+
+    def fileno(self):
+        fileno = getattr(self.device, 'fileno', None)
+        return fileno() if fileno else None
+
+    # Read and decode one report.  Returns the published snapshot, or None if nothing was decoded.
+    def read_and_decode(self, timeout_ms=None):
+        length = self.device.readinto(self.read_buffer, self.REPORT_SIZE, timeout_ms)
+        arrival_ns = monotonic_ns()
+        if length < self.read_dirty_len:
+            ctypes.memset(ctypes.addressof(self.read_array) + length, 0, self.read_dirty_len - length)
+        self.read_dirty_len = length
+        if length <= 2:
+            return None
+        self.arrival_stats.add(self.read_buffer[2], arrival_ns)
+
+        decoded_count = self.msg_handler.decoded_count
+        data = self.msg_handler.decode_from(self.read_view, length, arrival_ns)
+        if decoded_count == self.msg_handler.decoded_count:
+            return None
+
+        # Tag every packet with the device it came from so the merged stream can be split again.
+        snapshot = snapshot_data(data)
+        snapshot['device_id'] = self.device_id
+        snapshot['device_serial'] = self.serial
+        snapshot['arrival_ns'] = arrival_ns
+
+        self.packet_ring.push(snapshot)
+        self.published = (self.published[0] + 1, snapshot)
+        return snapshot
+
+    # Send a feature report and (with reply=True) read its reply under one lock, so concurrent
+    # callers can't pick up each other's replies.  Returns (report_type, report_length,
+    # report_bytes) of the reply, or whether the report was sent.  Raises on device errors.
+    def transaction(self, feature_report_type, report_bytes, reply=True):
+        feature_report = pack_feature_report(feature_report_type, report_bytes)
+        with self.feature_lock:
+            sent = self.device.send_feature_report(feature_report) > 0
+            if not reply:
+                return sent
+            return unpack_feature_report(self.device.get_feature_report(0, FEATURE_REPORT_SIZE + 1))
+
+    def close(self):
+        try:
+            self.device.close()
+        except Exception:
+            pass
+
+##########################################################################################################
+## Multi-device HID manager
+##
+##   Opens every matching controller endpoint in vid_pid_endpoint_list and streams all of them at
+##   once.  Each device gets its own ValveMessageHandler, packet ring and published snapshot, and
+##   every decoded packet is also pushed (tagged with device_id / device_serial) into one merged
+##   ring.  When every device has a file descriptor (the hidraw backend) a single epoll thread
+##   reads them all; otherwise each device gets its own read thread.
+##
+##   Device scans run on one supervisor thread for the life of the manager, woken by hotplug events
+##   or, without them, every SCAN_POLL_S.
+##########################################################################################################
+class MultiHidDeviceManager:
+    # Read timeout so per-device read threads notice a stop request.
+    READ_TIMEOUT_MS = 100
+
+    # Scan interval when hotplug events aren't available, and retry interval for devices that
+    # enumerate but failed to open
+    SCAN_POLL_S = 0.5
+
+    # Result of a failed transaction that expects a reply
+    NO_REPLY = HidDeviceManager.NO_REPLY
+
+    # backend is 'hidapi' (default, all platforms, one read thread per device), 'hidraw' (Linux, all
+    # devices read from one epoll thread) or a backend object, as for HidDeviceManager.
+    def __init__(self, vid_pid_endpoint_list, connect_cb=None, disconnect_cb=None, backend='hidapi', \
+                 msg_handler_factory=ValveMessageHandler, packet_ring_size=4096, merged_ring_size=16384):
+        self.logger = logging.getLogger('RTST.MULTI')
+
+        if isinstance(backend, str):
+            backend = hid_backends[backend]()
+        self.backend = backend
+
+        self.vid_pid_endpoint_list = vid_pid_endpoint_list
+        self.connect_cb = connect_cb
+        self.disconnect_cb = disconnect_cb
+        self.msg_handler_factory = msg_handler_factory
+        self.packet_ring_size = packet_ring_size
+
+        self.merged_ring = PacketRingBuffer(merged_ring_size)
+        self.merged_lock = threading.Lock()
+
+        # Streams by device_id.  Replaced (never mutated) so readers can iterate without a lock.
+        self.streams = {}
+        self.streams_lock = threading.RLock()
+        self.next_device_id = 1
+
+        self.epoll = select.epoll() if hasattr(select, 'epoll') else None
+        self.epoll_streams = {}
+        self.epoll_thread = None
+        self.run_epoll_thread = False
+
+        self.hotplug_monitor = None
+        self.supervisor_wake = threading.Event()
+        self.supervisor_thread = None
+        self.running = False
+
+    ##########################################################################################################
+    ## System methods
+    ##########################################################################################################
+    def start(self):
+        self.running = True
+
+        if self.epoll:
+            self.run_epoll_thread = True
+            self.epoll_thread = threading.Thread(target=self.__do_epoll_thread, daemon=True)
+            self.epoll_thread.start()
+
+        self.hotplug_monitor = NetlinkHotplugMonitor(self.hotplug_event)
+        if not self.hotplug_monitor.start():
+            self.hotplug_monitor = None
+
+        self.rescan()
+
+        self.supervisor_thread = threading.Thread(target=self.__do_supervisor_thread, daemon=True)
+        self.supervisor_thread.start()
+
+    def shutdown(self):
+        self.running = False
+
+        if self.hotplug_monitor:
+            self.hotplug_monitor.stop()
+            self.hotplug_monitor = None
+        if self.supervisor_thread:
+            self.supervisor_wake.set()
+            self.supervisor_thread.join()
+            self.supervisor_thread = None
+
+        for device_id in list(self.streams):
+            self.remove_stream(device_id)
+
+        if self.epoll_thread:
+            self.run_epoll_thread = False
+            self.epoll_thread.join()
+            self.epoll_thread = None
+
+    # Called on the monitor thread; the supervisor does the scan.
+    def hotplug_event(self, action, devname):
+        self.supervisor_wake.set()
+
+    def __do_supervisor_thread(self):
+        all_open = True
+        while True:
+            # Sleep until woken by a hotplug event, or until the next poll / open retry is due
+            timeout = None if self.hotplug_monitor and all_open else self.SCAN_POLL_S
+            self.supervisor_wake.wait(timeout)
+            self.supervisor_wake.clear()
+
+            if not self.running:
+                break
+
+            try:
+                all_open = self.rescan()
+            except Exception as e:
+                self.logger.error('Device scan failed: {}'.format(e))
+
+    # Open every matching endpoint that isn't open yet and drop streams whose device went away.
+    # Returns False if a matching endpoint couldn't be opened.  Only runs on the supervisor (and
+    # in start() before it exists), so scans never overlap; streams_lock is only taken to add or
+    # remove a stream, never across enumerate(), open() or connect_cb.
+    def rescan(self):
+        if not self.running:
+            return True
+
+        present = {}
+        for (vid, pid) in self.vid_pid_endpoint_list:
+            for dev in self.backend.enumerate(vid, pid):
+                if is_controller_endpoint(dev):
+                    present[dev['path']] = dev
+
+        for device_id, stream in list(self.streams.items()):
+            if stream.path not in present:
+                self.logger.info('Device {} unplugged'.format(device_id))
+                self.remove_stream(device_id)
+            elif stream.failed:
+                self.logger.info('Device {} read failed, reopening'.format(device_id))
+                self.remove_stream(device_id)
+
+        open_paths = {stream.path for stream in self.streams.values()}
+
+        all_open = True
+        for path, dev in present.items():
+            if path not in open_paths:
+                if not self.add_stream(dev):
+                    all_open = False
+        return all_open
+
+    def add_stream(self, dev):
+        try:
+            device = self.backend.open(dev['path'])
+        except self.backend.open_errors as e:
+            self.logger.info('Unable to open {}: {}'.format(dev['path'], e))
+            return None
+
+        stream = DeviceStream(self.next_device_id, dev, device, self.msg_handler_factory(), self.packet_ring_size)
+        self.next_device_id += 1
+        self.logger.info('Device {} connected (VID: {} PID: {} serial: {})'.format(
+            stream.device_id, hex(stream.vendor_id), hex(stream.product_id), stream.serial))
+
+        if self.connect_cb:
+            self.connect_cb(stream)
+
+        with self.streams_lock:
+            # Shut down while opening
+            if not self.running:
+                stream.close()
+                return None
+
+            streams = dict(self.streams)
+            streams[stream.device_id] = stream
+            self.streams = streams
+
+            fd = stream.fileno()
+            if self.epoll and fd is not None:
+                self.epoll_streams[fd] = stream
+                self.epoll.register(fd, select.EPOLLIN)
+            else:
+                stream.run_read_thread = True
+                stream.read_thread = threading.Thread(target=self.__do_read_thread, args=(stream,), daemon=True)
+                stream.read_thread.start()
+
+        return stream
+
+    def remove_stream(self, device_id):
+        with self.streams_lock:
+            stream = self.streams.get(device_id)
+            if not stream:
+                return
+
+            streams = dict(self.streams)
+            del streams[device_id]
+            self.streams = streams
+
+            fd = stream.fileno()
+            if fd is not None and fd in self.epoll_streams:
+                self.epoll.unregister(fd)
+                del self.epoll_streams[fd]
+                stream.close()
+            elif stream.read_thread:
+                stream.run_read_thread = False
+                if threading.current_thread() is not stream.read_thread:
+                    stream.read_thread.join()
+                stream.read_thread = None
+                stream.close()
+
+        if self.disconnect_cb:
+            self.disconnect_cb(stream)
+
+    def __do_epoll_thread(self):
+        while self.run_epoll_thread:
+            try:
+                events = self.epoll.poll(self.READ_TIMEOUT_MS / 1000.)
+            except OSError:
+                continue
+
+            if not events:
+                continue
+
+            # One lock acquisition per wakeup keeps hotplug from closing a device mid-read.
+            failed = []
+            with self.streams_lock:
+                for fd, event in events:
+                    stream = self.epoll_streams.get(fd)
+                    if not stream:
+                        continue
+                    # A read or decode error only takes down its own stream, not the shared reader
+                    try:
+                        packet = stream.read_and_decode()
+                    except Exception as e:
+                        self.logger.info('Device {} read failed: {}'.format(stream.device_id, e))
+                        failed.append(stream.device_id)
+                        continue
+                    if packet is not None:
+                        self.push_merged(packet)
+
+            # Reopen them if they're still there
+            for device_id in failed:
+                self.remove_stream(device_id)
+            if failed:
+                self.supervisor_wake.set()
+
+    # On a read error the stream is flagged for the supervisor, which removes it (joining this
+    # thread, so it can't be done from here) and reopens the device if it's still there.
+    def __do_read_thread(self, stream):
+        while stream.run_read_thread:
+            try:
+                packet = stream.read_and_decode(self.READ_TIMEOUT_MS)
+            except Exception as e:
+                self.logger.info('Device {} read failed: {}'.format(stream.device_id, e))
+                stream.failed = True
+                self.supervisor_wake.set()
+                break
+            if packet is not None:
+                self.push_merged(packet)
+
+    # With one read thread per device several threads publish into the merged ring, so serialize
+    # the pushes.  Uncontended in epoll mode.
+    def push_merged(self, packet):
+        with self.merged_lock:
+            self.merged_ring.push(packet)
+
+    ##########################################################################################################
+    ## Data methods
+    ##########################################################################################################
+    def get_device_ids(self):
+        return sorted(self.streams)
+
+    def get_stream(self, device_id):
+        return self.streams.get(device_id)
+
+    def is_open(self, device_id):
+        return device_id in self.streams
+
+    def get_data(self, device_id):
+        stream = self.streams.get(device_id)
+        return stream.published[1].copy() if stream else {}
+
+    def get_data_view(self, device_id):
+        stream = self.streams.get(device_id)
+        return types.MappingProxyType(stream.published[1] if stream else {})
+
+    def get_arrival_stats(self, device_id):
+        stream = self.streams.get(device_id)
+        return stream.arrival_stats.get_stats() if stream else {}
+
+    # Cursor over one device's packets
+    def new_packet_cursor(self, device_id, from_start=False):
+        return self.streams[device_id].packet_ring.new_cursor(from_start)
+
+    # Cursor over every device's packets, in arrival order
+    def new_merged_cursor(self, from_start=False):
+        return self.merged_ring.new_cursor(from_start)
+
+    ##########################################################################################################
+    ## Comms methods
+    ##########################################################################################################
+    # Feature report transaction with one device, see DeviceStream.transaction().  Returns NO_REPLY /
+    # False if the device isn't open or failed; a failed device is reopened by the supervisor.
+    def transaction(self, device_id, feature_report_type, report_bytes, reply=True):
+        stream = self.streams.get(device_id)
+        if stream:
+            try:
+                return stream.transaction(feature_report_type, report_bytes, reply)
+            except Exception as e:
+                self.logger.info('Device {} feature report failed: {}'.format(device_id, e))
+                stream.failed = True
+                self.supervisor_wake.set()
+        return self.NO_REPLY if reply else False
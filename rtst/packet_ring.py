@@ -0,0 +1,107 @@
+import threading
+
+##########################################################################################################
+## Lossless packet ring buffer
+##
+##   Single writer (the HID read thread), any number of readers.  The writer never blocks and never
+##   waits on a reader: every slot is preallocated and a new packet simply overwrites the oldest one.
+##   Each reader owns a PacketCursor and gets every packet published since its last read, plus a
+##   count of packets it lost because it fell more than 'capacity' packets behind.
+##########################################################################################################
+class PacketRingBuffer:
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+
+        # Each slot holds a (sequence number, packet) tuple so readers can detect a slot that was
+        # overwritten while they were copying out of it.
+        self.slots = [None] * capacity
+
+        # Sequence number of the next packet to be written.  Only the writer assigns it.
+        self.head = 0
+
+    # Publish a packet.  Called from the writer thread only.
+    def push(self, packet):
+        seq = self.head
+        self.slots[seq % self.capacity] = (seq, packet)
+        self.head = seq + 1
+
+    def get_head(self):
+        return self.head
+
+    # Get the most recently published packet, or None if nothing was published yet.
+    def get_latest(self):
+        head = self.head
+        if not head:
+            return None
+
+        slot = self.slots[(head - 1) % self.capacity]
+        return slot[1]
+
+    # Read every packet in [seq, head).  Returns (packets, next_seq, overflow) where overflow is the
+    # number of requested packets that had already been overwritten.
+    def read_since(self, seq):
+        head = self.head
+
+        # Sequence numbers never go backwards, so a cursor ahead of head can only come from a
+        # different ring.  Resync to head.
+        if seq > head:
+            return [], head, 0
+
+        overflow = 0
+        oldest = head - self.capacity
+        if seq < oldest:
+            overflow = oldest - seq
+            seq = oldest
+
+        packets = []
+        slots = self.slots
+        capacity = self.capacity
+        for expected in range(seq, head):
+            slot = slots[expected % capacity]
+
+            # The writer lapped us while we were reading.
+            if slot[0] != expected:
+                overflow += 1
+                continue
+
+            packets.append(slot[1])
+
+        return packets, head, overflow
+
+    def new_cursor(self, from_start=False):
+        return PacketCursor(self, from_start)
+
+##########################################################################################################
+## Per-consumer read position in a PacketRingBuffer
+##########################################################################################################
+class PacketCursor:
+    def __init__(self, ring, from_start=False):
+        self.ring = ring
+        self.lock = threading.Lock()
+
+        # By default only packets published after the cursor was created are returned.
+        if from_start:
+            self.seq = max(0, ring.get_head() - ring.capacity)
+        else:
+            self.seq = ring.get_head()
+
+        # Total number of packets this consumer has lost to overflow.
+        self.overflow = 0
+        self.read_count = 0
+
+    # Return every packet published since the last read (oldest first).
+    def read(self):
+        with self.lock:
+            packets, self.seq, overflow = self.ring.read_since(self.seq)
+            self.overflow += overflow
+            self.read_count += len(packets)
+        return packets
+
+    # Number of packets waiting to be read (may include packets already lost to overflow).
+    def pending(self):
+        return self.ring.get_head() - self.seq
+
+    # Drop everything pending and continue from the current head.
+    def skip_to_head(self):
+        with self.lock:
+            self.seq = self.ring.get_head()
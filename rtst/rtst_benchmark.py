@@ -0,0 +1,482 @@
+import time
+import struct
+import argparse
+import threading
+
+from hid_dev_mgr import HidDeviceManager, hid_backends, is_controller_endpoint
+from valve_message_handler import ValveMessageHandler, valve_messages, valve_message_layouts
+from virtual_device import VirtualControllerDevice
+from virtual_device import VirtualBackend
+from controller_if import ControllerInterface
+from multi_dev_mgr import MultiHidDeviceManager
+from hid_capture import ReplayBackend, read_capture
+
+# Needs numpy
+try:
+    import batch_decoder
+except ImportError:
+    batch_decoder = None
+
+##########################################################################################################
+## RTST host-side benchmarks
+##
+##   python rtst_benchmark.py <benchmark> [options]
+##########################################################################################################
+
+# Device endpoint filter list (wired + wireless), same as the RTST defaults.
+default_vid_pids = (
+    (0x28DE, 0x1102),
+    (0x28DE, 0x1201),
+    (0x28DE, 0x1203),
+    (0x28DE, 0x1204),
+    (0x28DE, 0x1205),
+    (0x28DE, 0x1206),
+    (0x28DE, 0x1142),
+)
+
+def find_endpoint(backend):
+    for (vid, pid) in default_vid_pids:
+        for dev in backend.enumerate(vid, pid):
+            if is_controller_endpoint(dev):
+                return dev
+    return None
+
+def report_timing(label, count, wall_s, cpu_s):
+    print('  {:<28} {:>8} reports  {:>9.1f} us/report wall  {:>7.2f} us/report CPU'.format(
+        label, count, wall_s * 1e6 / count, cpu_s * 1e6 / count))
+
+##########################################################################################################
+## hid-read: per-report overhead of each HID transport
+##
+##   Input reads are paced by the controller frame rate, so the interesting number is the CPU time
+##   spent per report.  Feature report round trips (GET_SETTING) aren't paced and show the raw
+##   per-call latency of each path.
+##########################################################################################################
+def bench_hid_read(args):
+    for name in args.backends:
+        backend = hid_backends[name]()
+        if hasattr(backend, 'is_supported') and not backend.is_supported():
+            print('{}: not supported on this platform'.format(name))
+            continue
+
+        dev = find_endpoint(backend)
+        if not dev:
+            print('{}: no controller found'.format(name))
+            continue
+
+        device = backend.open(dev['path'])
+        print('{} ({})'.format(name, dev['path']))
+
+        buffer = bytearray(128)
+        for i in range(100):
+            device.readinto(buffer, 64)
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        for i in range(args.count):
+            device.read(64)
+        report_timing('read() (new bytes)', args.count, time.perf_counter() - wall, time.process_time() - cpu)
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        for i in range(args.count):
+            device.readinto(buffer, 64)
+        report_timing('readinto() (preallocated)', args.count, time.perf_counter() - wall, time.process_time() - cpu)
+
+        # GET_SETTING(64) round trips.  Report ID 0, then type, length, payload.
+        request = struct.pack('=BBBBh', 0, 0x89, 3, 64, 0)
+        request += b'\0' * (65 - len(request))
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        for i in range(args.feature_count):
+            device.send_feature_report(request)
+            device.get_feature_report(0, 65)
+        report_timing('feature round trip', args.feature_count, time.perf_counter() - wall, time.process_time() - cpu)
+
+        device.close()
+
+##########################################################################################################
+## feature-rate: feature report transaction throughput
+##
+##   Several threads submit GET_SETTING transactions at once through HidDeviceManager, the way the
+##   Tk and TA2 threads do, and the per-opcode stats show throughput, latency and any replies that
+##   didn't match their request.
+##########################################################################################################
+def bench_feature_rate(args):
+    mgr = HidDeviceManager(default_vid_pids, None, backend=args.backend)
+    for i in range(50):
+        if mgr.is_open():
+            break
+        time.sleep(.1)
+    else:
+        print('{}: no controller found'.format(args.backend))
+        mgr.shutdown()
+        return
+
+    request = struct.pack('=Bh', 64, 0)
+
+    def worker():
+        futures = [mgr.submit_transaction(0x89, request) for i in range(args.count)]
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+
+    threads = [threading.Thread(target=worker) for i in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = args.count * args.threads
+    print('{} transactions from {} threads in {:.2f} s ({:.0f}/s)'.format(total, args.threads, elapsed, total / elapsed))
+    for op, stats in sorted(mgr.get_transaction_stats().items()):
+        print('  0x{:02x}: {}'.format(op, stats))
+
+    mgr.shutdown()
+
+##########################################################################################################
+## virtual: end-to-end host stack throughput against a simulated controller
+##
+##   Runs the read thread and decoder against VirtualBackend at the requested frame rate while a
+##   packet cursor drains every decoded packet (like the logger).  Frames the host fell too far
+##   behind on show up as overruns.
+##########################################################################################################
+def bench_virtual(args):
+    backend = VirtualBackend(args.rate, args.loss, args.seed, args.debug, args.debug)
+    mgr = HidDeviceManager(((VirtualBackend.VENDOR_ID, VirtualBackend.PRODUCT_ID),), None, ValveMessageHandler(),
+                           backend=backend, batch_read=args.batch)
+    while not mgr.is_open():
+        time.sleep(.01)
+
+    cursor = mgr.new_packet_cursor()
+    consumed = 0
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    while time.perf_counter() - wall < args.seconds:
+        consumed += len(cursor.read())
+        time.sleep(.01)
+    consumed += len(cursor.read())
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+
+    device = mgr.device
+    print('virtual controller at {} Hz for {:.1f} s'.format(args.rate, wall))
+    report_timing('decoded + consumed', max(consumed, 1), wall, cpu)
+    print('  frames sent {}  dropped (injected) {}  overrun {}  cursor overflow {}'.format(
+        device.frames_sent, device.frames_lost, device.frames_overrun, cursor.overflow))
+    print('  decoder missed_packets {}'.format(mgr.get_data().get('missed_packets')))
+    for (msg_type, stats) in sorted(mgr.msg_handler.get_sequence_stats().items()):
+        print('  0x{:02X} lost {}/{}  longest gap {}  bursts {}  gaps {}'.format(
+            msg_type, stats['lost'], stats['expected'], stats['longest_gap'], stats['bursts'], stats['gap_histogram']))
+    if args.batch:
+        print('  average batch {:.2f} reports'.format(mgr.get_read_batch_stats()['avg_batch']))
+
+    mgr.shutdown()
+
+##########################################################################################################
+## multi: several simulated controllers streaming at once through MultiHidDeviceManager
+##
+##   Every virtual controller runs at the requested frame rate while a merged cursor drains all of
+##   them.  Per device: frames sent, frames lost to the host falling behind (overrun), and the
+##   frame counter loss the decoder saw.  The manager keeps up if overrun and loss stay at the
+##   injected loss and the merged rate is devices x rate.
+##########################################################################################################
+def bench_multi(args):
+    backend = VirtualBackend(args.rate, args.loss, args.seed, count=args.devices)
+    mgr = MultiHidDeviceManager(((VirtualBackend.VENDOR_ID, VirtualBackend.PRODUCT_ID),), backend=backend)
+    mgr.start()
+    while len(mgr.get_device_ids()) < args.devices:
+        time.sleep(.01)
+
+    cursor = mgr.new_merged_cursor()
+    per_device = {}
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    while True:
+        for packet in cursor.read():
+            per_device[packet['device_id']] = per_device.get(packet['device_id'], 0) + 1
+        if time.perf_counter() - wall >= args.seconds:
+            break
+        time.sleep(.01)
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+
+    consumed = sum(per_device.values())
+    print('{} virtual controllers at {} Hz for {:.1f} s, merged {:.0f} packets/s'.format(
+        args.devices, args.rate, wall, consumed / wall))
+    report_timing('decoded + consumed', max(consumed, 1), wall, cpu)
+    print('  merged cursor overflow {}'.format(cursor.overflow))
+    for device_id in mgr.get_device_ids():
+        stream = mgr.get_stream(device_id)
+        device = stream.device
+        state = stream.msg_handler.get_sequence_stats().get(0x09, {})
+        print('  device {}  packets {}  frames sent {}  dropped (injected) {}  overrun {}  decoder lost {}/{}'.format(
+            device_id, per_device.get(device_id, 0), device.frames_sent, device.frames_lost, device.frames_overrun,
+            state.get('lost', 0), state.get('expected', 0)))
+
+    mgr.shutdown()
+
+##########################################################################################################
+## connect-sequence: command round trips of a UI connect against the feature report emulator
+##
+##   Replays the feature report commands jupiter_realtime_status issues on connect (connect_cb plus
+##   UIRoot.connected()) against a virtual controller with the given reply latency, first one
+##   blocking call at a time as the UI does, then with every GET_SETTING submitted up front.
+##########################################################################################################
+connect_settings = (51, 64, 68, 77, 72, 73, 19, 20, 63, 69, 65, 75, 79, 67, 48)
+
+def run_connect_sequence(cntrlr):
+    cntrlr.set_setting(6, 0)
+    cntrlr.sys_steamwatchdog(0)
+    cntrlr.mouse_kbd_control(False)
+    cntrlr.set_setting(49, 2)
+    for setting_num in connect_settings:
+        cntrlr.get_setting(setting_num)
+    cntrlr.get_attributes()
+    cntrlr.get_str_attribute(0)
+    cntrlr.get_str_attribute(1)
+    cntrlr.get_system_status()
+
+def bench_connect_sequence(args):
+    backend = VirtualBackend(feature_latency_s=args.latency)
+    cntrlr = ControllerInterface(((VirtualBackend.VENDOR_ID, VirtualBackend.PRODUCT_ID),), None, backend=backend)
+    while not cntrlr.is_open():
+        time.sleep(.01)
+
+    mgr = cntrlr.hid_dev_mgr
+    print('connect sequence, {:.2f} ms reply latency'.format(args.latency * 1e3))
+
+    mgr.reset_transaction_stats()
+    wall = time.perf_counter()
+    for i in range(args.count):
+        run_connect_sequence(cntrlr)
+    wall = time.perf_counter() - wall
+    commands = sum(stats['count'] for stats in mgr.get_transaction_stats().values())
+    print('  serial:     {:7.2f} ms per connect  {:6.0f} commands/s'.format(wall * 1e3 / args.count, commands / wall))
+
+    # The GET_SETTING block again, all queued before waiting on any reply
+    request = [struct.pack('=Bh', setting_num, 0) for setting_num in connect_settings]
+    mgr.reset_transaction_stats()
+    wall = time.perf_counter()
+    for i in range(args.count):
+        futures = [mgr.submit_transaction(0x89, report_bytes) for report_bytes in request]
+        for future in futures:
+            future.result()
+    wall = time.perf_counter() - wall
+    stats = mgr.get_transaction_stats()[0x89]
+    print('  settings queued:  {:7.2f} ms per {} settings  {:6.0f} commands/s  {:.2f} ms avg service'.format(
+        wall * 1e3 / args.count, len(connect_settings), stats['count'] / wall, stats['avg_service_ms']))
+
+    cntrlr.shutdown()
+
+##########################################################################################################
+## decode: message unpack cost, format strings vs compiled layouts
+##
+##   On a virtual controller report stream: unpacking each payload the old way (format string
+##   lookup, struct.unpack_from and a per-field dict), into a compiled layout record, and into a
+##   record plus its dict; then the whole ValveMessageHandler.decode_from(), and the NumPy batch
+##   decoder on all reports at once when numpy is available.
+##########################################################################################################
+def unpack_with_format(buf):
+    (msg_version, msg_type, msg_length) = struct.unpack_from('1H2B', buf, 0)
+    (msg_format, msg_field_names) = valve_messages[msg_type]
+    read_list = struct.unpack_from(msg_format, buf, 4)
+    result = {}
+    for i in range(len(msg_field_names)):
+        result[msg_field_names[i]] = read_list[i]
+    return result
+
+def unpack_to_record(buf):
+    layout = valve_message_layouts[buf[2]]
+    return layout.record_type._make(layout.struct.unpack_from(buf, 4))
+
+def unpack_to_record_dict(buf):
+    return unpack_to_record(buf)._asdict()
+
+def bench_decode(args):
+    device = VirtualControllerDevice(debug=args.debug, rushmore=args.debug)
+    buffers = []
+    while len(buffers) < args.count:
+        device.generate_frame()
+        while device.pending:
+            buffer = bytearray(ValveMessageHandler.RX_BUFFER_SIZE)
+            report = device.pending.popleft()
+            buffer[:len(report)] = report
+            buffers.append(buffer)
+
+    print('decode, {} virtual controller reports'.format(len(buffers)))
+    for (label, unpack) in (('format string + dict', unpack_with_format),
+                            ('compiled record', unpack_to_record),
+                            ('compiled record + dict', unpack_to_record_dict)):
+        wall = time.perf_counter()
+        for buffer in buffers:
+            unpack(buffer)
+        wall = time.perf_counter() - wall
+        print('  {:<28} {:>10.0f} packets/s'.format(label, len(buffers) / wall))
+
+    handler = ValveMessageHandler()
+    wall = time.perf_counter()
+    for buffer in buffers:
+        handler.decode_from(buffer, 64)
+    wall = time.perf_counter() - wall
+    print('  {:<28} {:>10.0f} packets/s'.format('decode_from()', len(buffers) / wall))
+
+    if not batch_decoder:
+        print('  batch decoder: numpy not installed')
+        return
+
+    raw = batch_decoder.reports_to_array(buffers)
+    wall = time.perf_counter()
+    (messages, rows) = batch_decoder.decode_array(raw)
+    for msg_type in messages:
+        messages[msg_type] = batch_decoder.add_derived_fields(msg_type, messages[msg_type])
+    wall = time.perf_counter() - wall
+    print('  {:<28} {:>10.0f} packets/s'.format('batch_decoder (+ derived)', len(buffers) / wall))
+
+##########################################################################################################
+## reconnect: restart() to first decoded packet
+##
+##   Times restart() itself (the bounded read thread shutdown) and the reconnect from restart() to
+##   the first packet decoded from the re-opened device, against a virtual controller.  Low frame
+##   rates show the read timeout at work: the old thread may be waiting on a frame when stopped.
+##########################################################################################################
+def bench_reconnect(args):
+    backend = VirtualBackend(args.rate)
+    mgr = HidDeviceManager(((VirtualBackend.VENDOR_ID, VirtualBackend.PRODUCT_ID),), None, ValveMessageHandler(),
+                           backend=backend, batch_read=args.batch)
+    while not mgr.is_open():
+        time.sleep(.01)
+
+    restart_ms = []
+    reconnect_ms = []
+    for i in range(args.count):
+        # Let the stream settle
+        time.sleep(2. / args.rate)
+
+        start = time.perf_counter()
+        mgr.restart()
+        restart_ms.append((time.perf_counter() - start) * 1e3)
+        seq = mgr.get_data_seq()
+        while mgr.get_data_seq() == seq:
+            time.sleep(.0002)
+        reconnect_ms.append((time.perf_counter() - start) * 1e3)
+
+    start = time.perf_counter()
+    mgr.shutdown()
+    shutdown_ms = (time.perf_counter() - start) * 1e3
+
+    print('reconnect, virtual controller at {} Hz, {} restarts'.format(args.rate, args.count))
+    for (label, times) in (('restart()', restart_ms), ('restart to first packet', reconnect_ms)):
+        times.sort()
+        print('  {:<24} p50 {:7.2f} ms  max {:7.2f} ms'.format(label, times[len(times) // 2], times[-1]))
+    print('  {:<24}     {:7.2f} ms'.format('shutdown()', shutdown_ms))
+
+##########################################################################################################
+## replay: decode a capture file as fast as possible
+##
+##   First ValveMessageHandler alone on every report of the capture, then the full read thread /
+##   decode / cursor path via ReplayBackend at the requested speed (0 = unpaced).
+##########################################################################################################
+def bench_replay(args):
+    records = read_capture(args.capture)
+    if not records:
+        print('{}: empty capture'.format(args.capture))
+        return
+    duration = (records[-1][0] - records[0][0]) / 1e9
+    print('{}: {} reports over {:.1f} s ({:.0f} reports/s as recorded)'.format(
+        args.capture, len(records), duration, len(records) / duration if duration else 0))
+
+    handler = ValveMessageHandler()
+    buffer = bytearray(128)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    for (timestamp_ns, report) in records:
+        buffer[:len(report)] = report
+        handler.decode_from(buffer, len(report), timestamp_ns)
+    report_timing('decode_from()', len(records), time.perf_counter() - wall, time.process_time() - cpu)
+
+    backend = ReplayBackend(args.capture, args.speed)
+    mgr = HidDeviceManager(((backend.vendor_id, backend.product_id),), None, ValveMessageHandler(), backend=backend)
+    while not mgr.is_open():
+        time.sleep(.01)
+
+    cursor = mgr.new_packet_cursor(from_start=True)
+    consumed = 0
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    while not mgr.device.finished:
+        consumed += len(cursor.read())
+        time.sleep(.01)
+    consumed += len(cursor.read())
+    report_timing('replay (x{})'.format(args.speed) if args.speed else 'replay (unpaced)', max(consumed, 1),
+                  time.perf_counter() - wall, time.process_time() - cpu)
+    print('  cursor overflow {}'.format(cursor.overflow))
+
+    mgr.shutdown()
+
+##########################################################################################################
+## MAIN ENTRY
+##########################################################################################################
+def main():
+    parser = argparse.ArgumentParser(description='RTST host-side benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    p = subparsers.add_parser('hid-read', help='Per-report overhead of the HID transports (needs a controller)')
+    p.add_argument('--backends', nargs='+', choices=sorted(hid_backends), default=sorted(hid_backends))
+    p.add_argument('--count', type=int, default=5000, help='Input reports to read per mode')
+    p.add_argument('--feature-count', type=int, default=200, help='Feature report round trips')
+    p.set_defaults(func=bench_hid_read)
+
+    p = subparsers.add_parser('feature-rate', help='Feature report transaction throughput (needs a controller)')
+    p.add_argument('--backend', choices=sorted(hid_backends), default='hidapi')
+    p.add_argument('--threads', type=int, default=4, help='Submitting threads')
+    p.add_argument('--count', type=int, default=250, help='Transactions per thread')
+    p.set_defaults(func=bench_feature_rate)
+
+    p = subparsers.add_parser('virtual', help='End-to-end read / decode throughput with a simulated controller')
+    p.add_argument('--rate', type=int, default=1000, help='Frame rate in Hz (125 - 8000)')
+    p.add_argument('--loss', type=float, default=0.0, help='Fraction of frames to drop')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--debug', action='store_true', help='Also send trackpad debug and Rushmore reports')
+    p.add_argument('--seconds', type=float, default=5.0)
+    p.add_argument('--batch', action='store_true', help='Use batched (drain-all) reads')
+    p.set_defaults(func=bench_virtual)
+
+    p = subparsers.add_parser('multi', help='Several simulated controllers streaming at once through MultiHidDeviceManager')
+    p.add_argument('--devices', type=int, default=8, help='Virtual controllers')
+    p.add_argument('--rate', type=int, default=1000, help='Frame rate in Hz of each controller (125 - 8000)')
+    p.add_argument('--loss', type=float, default=0.0, help='Fraction of frames to drop')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--seconds', type=float, default=5.0)
+    p.set_defaults(func=bench_multi)
+
+    p = subparsers.add_parser('connect-sequence', help='Feature report round trips of a UI connect, against the emulator')
+    p.add_argument('--latency', type=float, default=0.001, help='Emulated reply latency in seconds')
+    p.add_argument('--count', type=int, default=20, help='Connect sequences to run')
+    p.set_defaults(func=bench_connect_sequence)
+
+    p = subparsers.add_parser('decode', help='Message unpack / decode rate, format strings vs compiled layouts')
+    p.add_argument('--count', type=int, default=100000, help='Reports to decode')
+    p.add_argument('--debug', action='store_true', help='Also include trackpad debug and Rushmore reports')
+    p.set_defaults(func=bench_decode)
+
+    p = subparsers.add_parser('reconnect', help='Time from restart() to the first decoded packet, against a simulated controller')
+    p.add_argument('--rate', type=int, default=1000, help='Frame rate in Hz (125 - 8000)')
+    p.add_argument('--count', type=int, default=20, help='Restarts to time')
+    p.add_argument('--batch', action='store_true', help='Use batched (drain-all) reads')
+    p.set_defaults(func=bench_reconnect)
+
+    p = subparsers.add_parser('replay', help='Decode throughput on a capture file (see jupiter_realtime_status.py --capture)')
+    p.add_argument('capture')
+    p.add_argument('--speed', type=float, default=0, help='Replay speed as a multiple of real time, 0 = as fast as possible')
+    p.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import math
+import collections
+
+##########################################################################################################
+## Sliding-window running statistics
+##
+##   Mean / variance of the last `window` samples, updated in constant time per sample by keeping a
+##   running sum and sum of squares: the new sample is added and the one leaving the window is
+##   subtracted.  The sums are taken about a shift, seeded with the first sample so a large offset
+##   doesn't swamp a small variance.  Integer samples (raw controller fields) stay exact.  For float
+##   samples the sums are recomputed once per window about the window mean, so rounding error can't
+##   build up and the shift follows a drifting offset.
+##########################################################################################################
+class RunningWindowStats:
+    def __init__(self, window=128):
+        self.window = window
+        self.values = collections.deque(maxlen=window)
+        self.clear()
+
+    def add(self, value):
+        values = self.values
+        if not values:
+            self.shift = value
+        elif len(values) == self.window:
+            old = values[0] - self.shift
+            self.total -= old
+            self.total_sq -= old * old
+        values.append(value)
+        value -= self.shift
+        self.total += value
+        self.total_sq += value * value
+
+        if type(value) is float:
+            self.float_adds += 1
+            if self.float_adds >= self.window:
+                self.float_adds = 0
+                shift = self.shift = math.fsum(values) / len(values)
+                self.total = math.fsum(v - shift for v in values)
+                self.total_sq = math.fsum((v - shift) * (v - shift) for v in values)
+
+    def count(self):
+        return len(self.values)
+
+    def mean(self):
+        n = len(self.values)
+        return self.shift + self.total / n if n else 0.
+
+    # Sample variance (n - 1), same as statistics.variance()
+    def variance(self):
+        n = len(self.values)
+        if n < 2:
+            return 0.
+        return max(0., (n * self.total_sq - self.total * self.total) / (n * (n - 1)))
+
+    def stdev(self):
+        return math.sqrt(self.variance())
+
+    def clear(self):
+        self.values.clear()
+        # Sums are of (value - shift)
+        self.shift = 0
+        self.total = 0
+        self.total_sq = 0
+        self.float_adds = 0
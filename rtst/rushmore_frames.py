@@ -0,0 +1,127 @@
+import array
+import collections
+
+from packet_ring import PacketRingBuffer
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+##########################################################################################################
+## Rushmore debug frame assembler
+##
+##   A raw trackpad frame arrives as three 0x0C messages (rowsets 0, 1, 2) that carry the same
+##   data_last_packet_num.  Rowset payloads are copied byte for byte, without unpacking, into a
+##   preallocated int16 frame (a NumPy array when NumPy is available, array('h') otherwise) and a
+##   frame is published into a bounded
+##   PacketRingBuffer only once all three rowsets of one packet arrived in order, so consumers get
+##   every complete frame through a cursor and never see a partly written one.
+##
+##   Frames that can't be completed are counted instead: 'torn' when a rowset belongs to a
+##   different packet than the rowsets before it, 'incomplete' when a rowset is missing or out of
+##   order.
+##
+##   Frame buffers are recycled.  A published frame's values stay untouched until queue_size more
+##   frames were published; consumers that hold on to frames longer than that must copy them.
+##########################################################################################################
+
+# One complete frame.  seq counts published frames, packet_num is the controller's
+# data_last_packet_num, values holds FRAME_VALUES int16s.
+RushmoreFrame = collections.namedtuple('RushmoreFrame', ('seq', 'packet_num', 'values'))
+
+class RushmoreFrameAssembler:
+    FRAME_VALUES = 64
+
+    # (start, end) of each rowset in the frame.  The last rowset only carries 16 used values.
+    ROWSET_SLICES = ((0, 24), (24, 48), (48, 64))
+
+    def __init__(self, queue_size=256):
+        self.frame_queue = PacketRingBuffer(queue_size)
+
+        # queue_size frames can be in the queue, plus the one being assembled
+        self.frame_pool = [self.new_frame_buffer() for i in range(queue_size + 1)]
+        self.pool_index = 0
+        (self.frame, self.frame_bytes) = self.frame_pool[0]
+
+        # Rowset expected next and the packet number of the frame being assembled
+        self.next_rowset = 0
+        self.packet_num = None
+
+        # Packet number of the last rowsets dropped, so a broken frame is only counted once
+        self.orphan_packet = None
+
+        self.complete = 0
+        self.torn = 0
+        self.incomplete = 0
+
+    # (values, writable byte view of values)
+    def new_frame_buffer(self):
+        if np is not None:
+            values = np.zeros(self.FRAME_VALUES, dtype=np.int16)
+        else:
+            values = array.array('h', bytes(2 * self.FRAME_VALUES))
+        return (values, memoryview(values).cast('B'))
+
+    # Add one rowset whose native int16 values start at buf[offset].  Called from the read thread
+    # only.  Returns the RushmoreFrame it completed, or None.
+    def add_rowset(self, packet_num, rowset, buf, offset=0):
+        if rowset >= len(self.ROWSET_SLICES):
+            return None
+
+        if rowset != self.next_rowset:
+            # The frame in progress lost its remaining rowsets
+            if self.next_rowset:
+                self.incomplete += 1
+                self.orphan_packet = self.packet_num
+                self.next_rowset = 0
+            # Rowsets of a frame whose start was missed; count the frame once
+            elif rowset and packet_num != self.orphan_packet:
+                self.incomplete += 1
+
+            if rowset:
+                self.orphan_packet = packet_num
+                return None
+        elif rowset and packet_num != self.packet_num:
+            # Rowset of the next packet arrived in sequence; neither frame can complete
+            self.torn += 1
+            self.orphan_packet = packet_num
+            self.next_rowset = 0
+            return None
+
+        (start, end) = self.ROWSET_SLICES[rowset]
+        self.frame_bytes[2 * start:2 * end] = buf[offset:offset + 2 * (end - start)]
+        self.packet_num = packet_num
+        self.next_rowset = rowset + 1
+
+        if self.next_rowset < len(self.ROWSET_SLICES):
+            return None
+
+        frame = RushmoreFrame(self.complete, packet_num, self.frame)
+        self.frame_queue.push(frame)
+        self.complete += 1
+
+        self.pool_index = (self.pool_index + 1) % len(self.frame_pool)
+        (self.frame, self.frame_bytes) = self.frame_pool[self.pool_index]
+        self.next_rowset = 0
+        return frame
+
+    # Drop a partly assembled frame (e.g. after a reconnect) without counting it.
+    def reset(self):
+        self.next_rowset = 0
+        self.packet_num = None
+        self.orphan_packet = None
+
+    # Cursor returning every frame published after this call (see PacketCursor.read())
+    def new_cursor(self, from_start=False):
+        return self.frame_queue.new_cursor(from_start)
+
+    def get_latest(self):
+        return self.frame_queue.get_latest()
+
+    def get_stats(self):
+        return {
+            'complete': self.complete,
+            'torn': self.torn,
+            'incomplete': self.incomplete,
+        }
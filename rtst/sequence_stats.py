@@ -0,0 +1,156 @@
+import collections
+from array import array
+from time import monotonic_ns
+
+##########################################################################################################
+## Per message type sequence gap statistics
+##
+##   Every message type that carries a frame counter is tracked on its own, so loss in one stream
+##   (e.g. debug data) can't hide or fake loss in another.  For each type the read thread feeds the
+##   counter of every decoded message; the step between consecutive messages of that type (its
+##   stride: 1 for the state stream, more for debug data sent every n frames) is learned as the
+##   smallest step seen.  Each step of more than one stride is a gap of (step / stride - 1) lost
+##   messages.
+##
+##   Kept incrementally, in constant time per message:
+##     - lost / expected totals and a histogram of gap lengths
+##     - bursts (gaps of at least burst_min messages), the longest gap and bursts in the last minute
+##     - lost / expected per second (monotonic clock) for the last 60 s, so the 1 s / 10 s / 60 s loss rates
+##       are exact counts over the last 1 / 10 / 60 complete seconds rather than a smoothed value
+##
+##   A repeated counter (the three rowsets of a Rushmore frame share one) is not a message of its
+##   own.  A step of more than max_gap (controller reset, reordering) resyncs without counting loss.
+##########################################################################################################
+class SequenceTracker:
+    WINDOWS_S = (1, 10, 60)
+
+    # Window of recent_loss_pct, which is refreshed once a second for publishing with every packet
+    RECENT_WINDOW_S = 10
+
+    def __init__(self, burst_min=2, max_gap=1000, gap_bins=64):
+        self.burst_min = burst_min
+        self.max_gap = max_gap
+        self.gap_bins = gap_bins
+
+        self.last_seq = None
+        self.stride = None
+
+        self.received = 0
+        self.expected = 0
+        self.lost = 0
+        self.repeats = 0
+        self.resyncs = 0
+
+        # gap_histogram[n] counts gaps of n lost messages; the last bin counts everything longer.
+        self.gap_histogram = array('Q', bytes(8 * (gap_bins + 1)))
+        self.longest_gap = 0
+        self.bursts = 0
+        self.burst_times_ns = collections.deque()
+
+        # Ring of one-second buckets: bucket_second[i] says which second bucket i currently holds.
+        num_buckets = max(self.WINDOWS_S) + 1
+        self.bucket_second = array('q', [-1] * num_buckets)
+        self.bucket_expected = array('Q', bytes(8 * num_buckets))
+        self.bucket_lost = array('Q', bytes(8 * num_buckets))
+        self.recent_loss_pct = 0.
+
+    # Called from the read thread for every message of this type
+    def add(self, seq, now_ns):
+        last = self.last_seq
+        self.last_seq = seq
+        if last is None:
+            return
+
+        step = (seq - last) & 0xFFFFFFFF
+        if not step:
+            self.repeats += 1
+            return
+        if step > self.max_gap:
+            self.resyncs += 1
+            return
+
+        stride = self.stride
+        if stride is None or step < stride:
+            stride = self.stride = step
+        steps = (step + stride // 2) // stride
+        gap = steps - 1
+
+        self.received += 1
+        self.expected += steps
+
+        if gap:
+            self.lost += gap
+            self.gap_histogram[min(gap, self.gap_bins)] += 1
+            if gap > self.longest_gap:
+                self.longest_gap = gap
+            if gap >= self.burst_min:
+                self.bursts += 1
+                burst_times_ns = self.burst_times_ns
+                burst_times_ns.append(now_ns)
+                while now_ns - burst_times_ns[0] > 60000000000:
+                    burst_times_ns.popleft()
+
+        second = now_ns // 1000000000
+        index = second % len(self.bucket_second)
+        if self.bucket_second[index] != second:
+            self.bucket_expected[index] = 0
+            self.bucket_lost[index] = 0
+            self.bucket_second[index] = second
+            self.recent_loss_pct = self.window_loss(self.RECENT_WINDOW_S, now_ns)
+        self.bucket_expected[index] += steps
+        self.bucket_lost[index] += gap
+
+    # Loss in percent over the window_s complete seconds before now_ns
+    def window_loss(self, window_s, now_ns):
+        current = now_ns // 1000000000
+        num_buckets = len(self.bucket_second)
+
+        expected = 0
+        lost = 0
+        for second in range(current - window_s, current):
+            index = second % num_buckets
+            if self.bucket_second[index] == second:
+                expected += self.bucket_expected[index]
+                lost += self.bucket_lost[index]
+        return 100. * lost / expected if expected else 0.
+
+    def summary(self, now_ns=None):
+        if now_ns is None:
+            now_ns = monotonic_ns()
+
+        stats = {
+            'received': self.received,
+            'expected': self.expected,
+            'lost': self.lost,
+            'loss_pct': 100. * self.lost / self.expected if self.expected else 0.,
+            'stride': self.stride,
+            'repeats': self.repeats,
+            'resyncs': self.resyncs,
+            'longest_gap': self.longest_gap,
+            'bursts': self.bursts,
+            'bursts_per_min': sum(1 for t in list(self.burst_times_ns) if now_ns - t <= 60000000000),
+            'gap_histogram': {gap: n for gap, n in enumerate(self.gap_histogram) if n},
+        }
+        for window_s in self.WINDOWS_S:
+            stats['loss_{}s_pct'.format(window_s)] = self.window_loss(window_s, now_ns)
+        return stats
+
+class SequenceStats:
+    def __init__(self, burst_min=2, max_gap=1000):
+        self.burst_min = burst_min
+        self.max_gap = max_gap
+
+        # msg_type: SequenceTracker
+        self.trackers = {}
+
+    # Called from the read thread for every message that carries a frame counter
+    def add(self, msg_type, seq, now_ns):
+        tracker = self.trackers.get(msg_type)
+        if tracker is None:
+            tracker = self.trackers[msg_type] = SequenceTracker(self.burst_min, self.max_gap)
+        tracker.add(seq, now_ns)
+
+    # {msg_type: summary dict}
+    def get_stats(self):
+        now_ns = monotonic_ns()
+        return {msg_type: tracker.summary(now_ns) for msg_type, tracker in list(self.trackers.items())}
@@ -0,0 +1,292 @@
+import logging
+import math
+import threading
+from time import monotonic_ns
+
+from state_vector import StateMapping
+from valve_message_handler import sequence_field_index
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+##########################################################################################################
+## Streaming noise spectrum analysis
+##
+##   Reads every decoded packet from a packet cursor on its own thread, so the read thread does no
+##   extra work.  Each new controller state message (a new frame counter) adds one sample of every
+##   analysed field to a preallocated NumPy ring of the last `window` samples.  Every cadence_s the
+##   ring is turned into a Welch power spectral density per field (Hann window, `segment` samples
+##   per segment, 50% overlap, mean removed per segment) and published as one results dict:
+##     - rms: noise over the whole spectrum without DC, comparable to the *_stdev fields
+##     - peaks: the strongest spectral peaks, frequency refined between bins, with their power and rms
+##     - band_power: power (counts^2) in each band of bands_hz
+##
+##   Samples are placed on the controller's frame grid: frames lost in transit are linearly
+##   interpolated (and counted) rather than shifting everything after them, and the sample rate is
+##   the slope of host arrival time against frame number over the window, so it follows the
+##   controller's actual frame rate.  A jump in the frame counter of more than max_gap (reconnect,
+##   controller reset) empties the ring.
+##########################################################################################################
+class SpectrumAnalyzer:
+    DEFAULT_FIELDS = (
+        'left_x',
+        'right_x',
+        'trigger_raw_left',
+        'trigger_raw_right',
+        'accel_x',
+        'accel_y',
+        'accel_z',
+        'gyro_x',
+        'gyro_y',
+        'gyro_z',
+    )
+
+    # (low, high) Hz; high None is up to Nyquist.  Bands above Nyquist are left out.
+    DEFAULT_BANDS_HZ = ((0.5, 10), (10, 50), (50, 150), (150, 400), (400, None))
+
+    def __init__(self, cursor, fields=DEFAULT_FIELDS, window=2048, segment=256, cadence_s=1.0, num_peaks=3,
+                 bands_hz=DEFAULT_BANDS_HZ, max_gap=1000, poll_s=0.05):
+        self.logger = logging.getLogger('RTST.SPECTRUM')
+        self.cursor = cursor
+        self.fields = tuple(fields)
+        self.window = window
+        self.segment = segment
+        self.cadence_s = cadence_s
+        self.num_peaks = num_peaks
+        self.bands_hz = tuple(bands_hz)
+        self.max_gap = max_gap
+        self.poll_s = poll_s
+
+        self.thread = None
+        self.stop_event = threading.Event()
+
+        # slot: (position of the frame counter, position of each field or None) in that message type's record
+        self.slot_positions = {}
+
+        self.last_packet_num = None
+        self.resyncs = 0
+
+        # Latest results, replaced as a whole on every analysis
+        self.results = {}
+
+        if np is not None:
+            self.samples = np.zeros((len(self.fields), window))
+            self.frames = np.zeros(window, dtype=np.int64)
+            self.arrivals = np.zeros(window, dtype=np.int64)
+        self.count = 0
+        self.frame = 0
+
+    def start(self):
+        if np is None:
+            self.logger.warning('NumPy is not installed, spectrum analysis disabled')
+            return False
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.__do_analysis_thread, daemon=True)
+            self.thread.start()
+        return True
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __do_analysis_thread(self):
+        next_analysis_ns = monotonic_ns() + int(self.cadence_s * 1e9)
+        while not self.stop_event.wait(self.poll_s):
+            self.add_packets(self.cursor.read())
+
+            now_ns = monotonic_ns()
+            if now_ns >= next_analysis_ns:
+                next_analysis_ns = max(next_analysis_ns + int(self.cadence_s * 1e9), now_ns)
+                try:
+                    self.results = self.analyze()
+                except Exception:
+                    self.logger.exception('Spectrum analysis failed')
+
+    ##########################################################################################################
+    ## Sampling
+    ##########################################################################################################
+    # (frame counter, arrival_ns, field values) of a packet, or None if it carries no state message.
+    # The counter is last_packet_num, or packet_num for 0x01 controllers (see sequence_field_index).
+    def get_sample(self, packet):
+        if isinstance(packet, StateMapping):
+            state = packet.state
+            layout = state.layout
+
+            # The latest record carrying the first field is the state message the packet came with
+            # (or an earlier one, which is skipped as a repeat below).
+            index = layout.field_index.get(self.fields[0])
+            source = state.source(index) if index is not None else None
+            if source is None:
+                return None
+            slot = source[0]
+            positions = self.slot_positions.get(slot)
+            if positions is None:
+                names = layout.slot_field_names[slot]
+                positions = self.slot_positions[slot] = (
+                    sequence_field_index.get(layout.msg_types[slot]),
+                    tuple(names.index(field) if field in names else None for field in self.fields))
+            if positions[0] is None:
+                return None
+
+            record = state.records[slot]
+            values = tuple(record[position] if position is not None else math.nan for position in positions[1])
+            return (record[positions[0]], state.extra.get('arrival_ns', 0), values)
+
+        packet_num = packet.get('last_packet_num', packet.get('packet_num'))
+        if packet_num is None:
+            return None
+        return (packet_num, packet.get('arrival_ns', 0), tuple(packet.get(field, math.nan) for field in self.fields))
+
+    def add_packets(self, packets):
+        rows = []
+        frames = []
+        arrivals = []
+        for packet in packets:
+            sample = self.get_sample(packet)
+            if sample is None:
+                continue
+            (packet_num, arrival_ns, values) = sample
+
+            last = self.last_packet_num
+            self.last_packet_num = packet_num
+            if last is not None:
+                step = (packet_num - last) & 0xFFFFFFFF
+                if not step:
+                    continue
+                if step > self.max_gap:
+                    self.resyncs += 1
+                    self.count = 0
+                    rows = []
+                    frames = []
+                    arrivals = []
+                    step = 0
+                self.frame += step
+
+            rows.append(values)
+            frames.append(self.frame)
+            arrivals.append(arrival_ns or 0)
+
+        if not rows:
+            return
+
+        window = self.window
+        if len(rows) > window:
+            del rows[:-window], frames[:-window], arrivals[:-window]
+        index = (self.count + np.arange(len(rows))) % window
+        self.samples[:, index] = np.array(rows, dtype=float).T
+        self.frames[index] = frames
+        self.arrivals[index] = arrivals
+        self.count += len(rows)
+
+    ##########################################################################################################
+    ## Analysis
+    ##########################################################################################################
+    # Band name used in the results
+    def band_name(self, low, high):
+        if high is None:
+            return '{:g}Hz+'.format(low)
+        return '{:g}-{:g}Hz'.format(low, high)
+
+    def analyze(self):
+        start_ns = monotonic_ns()
+        results = {
+            'time_ns': start_ns,
+            'samples': min(self.count, self.window),
+            'resyncs': self.resyncs,
+            'overflow': self.cursor.overflow,
+            'fields': {},
+        }
+
+        n = results['samples']
+        if n < self.segment:
+            return results
+
+        # Window in arrival order
+        index = (self.count - n + np.arange(n)) % self.window
+        frames = self.frames[index]
+        arrivals = self.arrivals[index]
+        samples = self.samples[:, index]
+
+        # Frame counter step of this stream, then resample lost frames onto the frame grid
+        stride = int(np.diff(frames).min())
+        grid = np.arange(frames[0], frames[-1] + 1, stride)
+        if len(grid) != n:
+            samples = np.array([np.interp(grid, frames, row) for row in samples])
+        results['interpolated'] = len(grid) - n
+
+        if not arrivals.all():
+            return results
+        ns_per_frame = np.polyfit(frames - frames[0], arrivals - arrivals[0], 1)[0]
+        if ns_per_frame <= 0:
+            return results
+        fs = 1e9 * stride / ns_per_frame
+        results['fs_hz'] = float(fs)
+
+        # Welch PSD of every field at once: (fields, segments, segment)
+        segment = self.segment
+        starts = np.arange(0, len(grid) - segment + 1, segment // 2)
+        segments = samples[:, starts[:, None] + np.arange(segment)]
+        segments -= segments.mean(axis=2, keepdims=True)
+        taper = np.hanning(segment)
+        psd = (np.abs(np.fft.rfft(segments * taper, axis=2)) ** 2).mean(axis=1) / (fs * (taper ** 2).sum())
+        psd[:, 1:] *= 2
+        if not segment % 2:
+            psd[:, -1] /= 2
+        freqs = np.fft.rfftfreq(segment, 1. / fs)
+        df = fs / segment
+        nyquist = fs / 2
+
+        results['segments'] = len(starts)
+        results['resolution_hz'] = float(df)
+
+        bands = []
+        for (low, high) in self.bands_hz:
+            if low >= nyquist:
+                continue
+            top = nyquist if high is None else min(high, nyquist)
+            bands.append((self.band_name(low, high), (freqs >= low) & (freqs < top)))
+
+        min_peak_hz = min(low for (low, high) in self.bands_hz) if self.bands_hz else df
+        for (field, field_psd) in zip(self.fields, psd):
+            # Field not carried by this controller's state messages
+            if np.isnan(field_psd).any():
+                continue
+
+            results['fields'][field] = {
+                'rms': float(math.sqrt(field_psd[1:].sum() * df)),
+                'peaks': self.find_peaks(field_psd, df, min_peak_hz),
+                'band_power': {name: float(field_psd[mask].sum() * df) for (name, mask) in bands},
+            }
+
+        results['compute_ms'] = (monotonic_ns() - start_ns) / 1e6
+        return results
+
+    # The num_peaks strongest local maxima of psd at or above min_hz, strongest first
+    def find_peaks(self, psd, df, min_hz):
+        first = max(1, int(math.ceil(min_hz / df)))
+        middle = psd[first:-1]
+        maxima = np.nonzero((middle > psd[first - 1:-2]) & (middle >= psd[first + 1:]))[0] + first
+        # Peak bin and its neighbours, leaving out DC
+        powers = ((maxima > 1) * psd[maxima - 1] + psd[maxima] + psd[maxima + 1]) * df
+        order = np.argsort(powers)[::-1][:self.num_peaks]
+        maxima = maxima[order]
+
+        peaks = []
+        for (k, power) in zip(maxima, powers[order]):
+            # Parabola through the log power of the peak bin and its neighbours
+            (a, b, c) = np.log(np.maximum(psd[k - 1:k + 2], 1e-30))
+            curvature = a - 2 * b + c
+            offset = 0.5 * (a - c) / curvature if curvature < 0 else 0.
+            peaks.append({
+                'freq_hz': float((k + offset) * df),
+                'power': float(power),
+                'rms': float(math.sqrt(power)),
+            })
+        return peaks
+
+    def get_results(self):
+        return self.results
@@ -0,0 +1,197 @@
+import collections.abc
+
+##########################################################################################################
+## Fixed-layout controller state
+##
+##   Instead of a dict that grows as message types show up, the decoded state is one preallocated
+##   slot per message type holding that type's latest record (an immutable namedtuple, see
+##   valve_message_handler.py) and the decode count it arrived at.  Storing a message is two list
+##   stores, and copying the state for publishing copies one reference per message type, not one
+##   per field.
+##
+##   StateLayout gives every field name a stable index.  A field carried by several message types
+##   (left_x is in 0x01, 0x08 and 0x09) reads from whichever of them was decoded last, which is what
+##   merging every message into one dict did.  A field is valid once a message carrying it was
+##   decoded and its value isn't None.  Fields outside the layout (derived fields, arrival_ns,
+##   counters) go in a small 'extra' dict.
+##
+##   Hot consumers read fields by index (StateVector.value()); StateMapping wraps a StateVector in
+##   the usual dict interface for everything else.
+##########################################################################################################
+class StateLayout:
+    # layouts: objects with msg_type and field_names (valve_message_handler.MessageLayout)
+    def __init__(self, layouts):
+        self.msg_types = tuple(layout.msg_type for layout in layouts)
+        self.slot_index = {msg_type: slot for slot, msg_type in enumerate(self.msg_types)}
+        self.slot_field_names = tuple(tuple(layout.field_names) for layout in layouts)
+
+        # Names in order of first appearance, each with the (slot, position) of every message
+        # type carrying it
+        sources = {}
+        for (slot, field_names) in enumerate(self.slot_field_names):
+            for (position, name) in enumerate(field_names):
+                sources.setdefault(name, []).append((slot, position))
+        self.field_names = tuple(sources)
+        self.field_index = {name: i for i, name in enumerate(self.field_names)}
+        self.field_sources = tuple(tuple(sources[name]) for name in self.field_names)
+
+class StateVector:
+    __slots__ = ('layout', 'records', 'stamps', 'extra')
+
+    def __init__(self, layout, records=None, stamps=None, extra=None):
+        self.layout = layout
+        self.records = records if records is not None else [None] * len(layout.msg_types)
+        self.stamps = stamps if stamps is not None else [0] * len(layout.msg_types)
+        self.extra = extra if extra is not None else {}
+
+    def copy(self):
+        return StateVector(self.layout, self.records[:], self.stamps[:], dict(self.extra))
+
+    # Called from the read thread.  seq orders the updates (the handler's decode count).
+    def set_record(self, slot, record, seq):
+        self.records[slot] = record
+        self.stamps[slot] = seq
+
+    # (slot, position) of the latest message that set field index, or None if none has
+    def source(self, index):
+        sources = self.layout.field_sources[index]
+        stamps = self.stamps
+        (slot, position) = sources[0]
+        for other in sources[1:]:
+            if stamps[other[0]] > stamps[slot]:
+                (slot, position) = other
+        return (slot, position) if stamps[slot] else None
+
+    # Value of field index, or None if it isn't valid
+    def value(self, index):
+        source = self.source(index)
+        return self.records[source[0]][source[1]] if source else None
+
+    # Decode count of the message that last set field index, 0 if none has
+    def last_updated(self, index):
+        source = self.source(index)
+        return self.stamps[source[0]] if source else 0
+
+    def is_valid(self, index):
+        return self.value(index) is not None
+
+    # Plain dict of the valid fields and the extras.  Keys are in layout order, so the order only
+    # changes when a new message type shows up.
+    def as_dict(self):
+        data = {}
+        records = self.records
+        names = self.layout.slot_field_names
+        present = [slot for (slot, stamp) in enumerate(self.stamps) if stamp]
+        for slot in present:
+            data.update(zip(names[slot], records[slot]))
+
+        # Again oldest first, so shared fields end up with the latest value; keys are already in place
+        present.sort(key=self.stamps.__getitem__)
+        for slot in present:
+            data.update(zip(names[slot], records[slot]))
+
+        if any(None in records[slot] for slot in present):
+            for (name, value) in list(data.items()):
+                if value is None:
+                    del data[name]
+        data.update(self.extra)
+        return data
+
+##########################################################################################################
+## Dict interface to a StateVector
+##
+##   Keys with a field index read the latest message carrying that field; anything else is an
+##   extra.  copy() returns a plain dict.  Published snapshots are never modified once pushed, so
+##   they build that dict once and reuse it for copy() and iteration.
+##########################################################################################################
+class StateMapping(collections.abc.MutableMapping):
+    __slots__ = ('state', 'cache_dict', 'data')
+
+    def __init__(self, state, cache_dict=False):
+        self.state = state
+        self.cache_dict = cache_dict
+        self.data = None
+
+    def as_dict(self):
+        if not self.cache_dict:
+            return self.state.as_dict()
+        if self.data is None:
+            self.data = self.state.as_dict()
+        return self.data
+
+    def __getitem__(self, key):
+        state = self.state
+        index = state.layout.field_index.get(key)
+        if index is None:
+            return state.extra[key]
+        value = state.value(index)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    # Setting a message field replaces it in the latest record carrying it.
+    def __setitem__(self, key, value):
+        state = self.state
+        index = state.layout.field_index.get(key)
+        self.data = None
+        if index is None:
+            state.extra[key] = value
+            return
+
+        source = state.source(index)
+        if source is None:
+            raise KeyError(key)
+        (slot, position) = source
+        state.records[slot] = state.records[slot]._replace(**{key: value})
+
+    def __delitem__(self, key):
+        state = self.state
+        index = state.layout.field_index.get(key)
+        self.data = None
+        if index is None:
+            del state.extra[key]
+            return
+
+        if state.value(index) is None:
+            raise KeyError(key)
+        for (slot, position) in state.layout.field_sources[index]:
+            if state.records[slot] is not None:
+                state.records[slot] = state.records[slot]._replace(**{key: None})
+
+    def __iter__(self):
+        return iter(self.as_dict())
+
+    def __len__(self):
+        return len(self.as_dict())
+
+    def __contains__(self, key):
+        state = self.state
+        index = state.layout.field_index.get(key)
+        if index is None:
+            return key in state.extra
+        return state.value(index) is not None
+
+    def get(self, key, default=None):
+        state = self.state
+        index = state.layout.field_index.get(key)
+        if index is None:
+            return state.extra.get(key, default)
+        value = state.value(index)
+        return default if value is None else value
+
+    def copy(self):
+        return dict(self.as_dict()) if self.cache_dict else self.state.as_dict()
+
+    # Independent StateMapping over a copy of the state, for publishing
+    def snapshot(self):
+        return StateMapping(self.state.copy(), True)
+
+    def __repr__(self):
+        return 'StateMapping({!r})'.format(self.as_dict())
+
+# Copy of a handler's last_data for publishing: a StateMapping snapshot, or a dict copy of
+# anything else.
+def snapshot_data(data):
+    if isinstance(data, StateMapping):
+        return data.snapshot()
+    return dict(data)
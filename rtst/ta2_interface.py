@@ -10,7 +10,7 @@ from controller_if import ControllerInterface
 ## TA2 Test Automation Interface
 ##########################################################################################################
 class Ta2InterfaceHost:
-    VERSION = "2024.01.02.1"
+    VERSION = "2026.10.18.3"
     LOCALHOST = "127.0.0.1"  # Standard loopback interface address (localhost)
     TA2_INTERFACE_PORT = 35892  # Port to listen on (non-privileged ports are > 1023)
 
@@ -24,6 +24,14 @@ class Ta2InterfaceHost:
         self.last_packet_number = 0
         self.data = None
 
+        # Cursors into the controller packet stream.  GET returns the newest packet it hasn't
+        # sent yet, GETALL returns every packet received since the previous GETALL.
+        self.data_cursor = self.controller_interface.new_packet_cursor()
+        self.packet_cursor = self.controller_interface.new_packet_cursor()
+
+        # BUTTONS returns every button press / release since the previous BUTTONS.
+        self.button_cursor = self.controller_interface.new_button_event_cursor()
+
         # try to open interface socket - can raise exception if socket already bound
         try:
             self.fsc_socket.bind((self.LOCALHOST, self.TA2_INTERFACE_PORT))
@@ -36,6 +44,9 @@ class Ta2InterfaceHost:
         while True:
             self.fsc_socket.listen()
             conn, addr = self.fsc_socket.accept()
+            # Clients get every derived field while connected
+            derived_fields = self.controller_interface.get_derived_field_names()
+            self.controller_interface.subscribe_fields(derived_fields)
             with conn:
                 self.logger.info((f"interface connected to by {addr}"))
                 while True:
@@ -49,9 +60,33 @@ class Ta2InterfaceHost:
                     if message == 'GET':
                         self.wait_for_new_data()
                         # encode data dict to json
-                        response = json.dumps(self.data)
+                        response = json.dumps(self.data.copy())
                         conn.sendall(response.encode())
                         
+                    # GETALL command returns every packet received since the previous GETALL
+                    elif message == 'GETALL':
+                        packets = [packet.copy() for packet in self.packet_cursor.read()]
+                        response = json.dumps({'packets': packets, 'overflow': self.packet_cursor.overflow})
+                        conn.sendall(response.encode())
+
+                    # BUTTONS command returns every button edge since the previous BUTTONS, plus
+                    # per button counters
+                    elif message == 'BUTTONS':
+                        events = [event._asdict() for event in self.button_cursor.read()]
+                        response = json.dumps({'events': events, 'overflow': self.button_cursor.overflow,
+                                               'stats': self.controller_interface.get_button_stats()})
+                        conn.sendall(response.encode())
+
+                    # SPECTRUM command returns the latest noise spectra: per field rms, dominant
+                    # frequencies and band power (see SpectrumAnalyzer.analyze()).  The first
+                    # SPECTRUM starts the analysis if the UI hasn't; NAK without NumPy.
+                    elif message == 'SPECTRUM':
+                        if self.controller_interface.start_spectrum_analysis():
+                            response = json.dumps(self.controller_interface.get_spectrum())
+                            conn.sendall(response.encode())
+                        else:
+                            conn.sendall('NAK'.encode())
+
                     # SET: command changes RTST settings using key_cb
                     elif message.startswith('KEY:'):
                         chars = message[4:]
@@ -107,21 +142,18 @@ class Ta2InterfaceHost:
                         self.logger.warn(f'ta2 request: {message} could not be parsed!')
                         conn.sendall('NAK'.encode())
 
+            self.controller_interface.unsubscribe_fields(derived_fields)
             self.logger.info((f"ta2 interface disconnected"))        
 
     # if we've already sent the current packet, wait for fresh data
-    # TODO: is this too slow? check for missed packets
     def wait_for_new_data(self):
         while True:
-            data = self.controller_interface.get_data()
-            packet_number = data['last_packet_num']
-
-            if packet_number != self.last_packet_number:
-                self.data = data
-                self.last_packet_number = packet_number
+            packets = self.data_cursor.read()
+            if packets:
+                self.data = packets[-1]
+                self.last_packet_number = self.data.get('last_packet_num')
                 break
-            else:
-                continue
+            time.sleep(0.0005)
 
     def get_metadata(self):
         metadata = self.controller_interface.get_attributes()
@@ -0,0 +1,111 @@
+import os
+import time
+import threading
+import collections
+
+from arrival_stats import InterArrivalHistogram
+
+##########################################################################################################
+## Thread scheduling helpers
+##
+##   On Linux the os.sched_* calls and setpriority() on a thread ID act on a single thread, so these
+##   are meant to be called from the thread being configured (e.g. at the top of the HID read
+##   thread).  Raising priority (SCHED_FIFO, negative nice) needs CAP_SYS_NICE or an RLIMIT_RTPRIO /
+##   RLIMIT_NICE allowance; when it isn't permitted the failure is recorded and the thread keeps
+##   running with what it has.
+##########################################################################################################
+
+sched_policy_names = {}
+for name in ('SCHED_OTHER', 'SCHED_BATCH', 'SCHED_IDLE', 'SCHED_FIFO', 'SCHED_RR'):
+    if hasattr(os, name):
+        sched_policy_names[getattr(os, name)] = name
+
+# Apply the requested settings to the calling thread.  Returns get_thread_scheduling() plus an
+# 'errors' list of anything that couldn't be applied.
+def apply_thread_scheduling(cpu=None, fifo_priority=None, nice=None):
+    errors = []
+
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except (AttributeError, OSError) as e:
+            errors.append('affinity cpu {}: {}'.format(cpu, e))
+
+    if fifo_priority is not None:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(fifo_priority))
+        except (AttributeError, OSError) as e:
+            errors.append('SCHED_FIFO {}: {}'.format(fifo_priority, e))
+
+    if nice is not None:
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+        except (AttributeError, OSError) as e:
+            errors.append('nice {}: {}'.format(nice, e))
+
+    sched = get_thread_scheduling()
+    sched['errors'] = errors
+    return sched
+
+# Scheduling the calling thread actually has
+def get_thread_scheduling():
+    sched = {}
+    try:
+        policy = os.sched_getscheduler(0)
+        sched['policy'] = sched_policy_names.get(policy, str(policy))
+        sched['priority'] = os.sched_getparam(0).sched_priority
+        sched['cpus'] = sorted(os.sched_getaffinity(0))
+        sched['nice'] = os.getpriority(os.PRIO_PROCESS, threading.get_native_id())
+    except (AttributeError, OSError):
+        pass
+    return sched
+
+##########################################################################################################
+## Continuous wakeup latency
+##
+##   The thread being measured calls probe() between its reads.  Every interval_s it sleeps for
+##   sleep_s and records how late it woke up, so the scheduling latency it sees is tracked for as
+##   long as it runs, including under load bursts, not just when it started.  A high wakeup latency
+##   at the time of a drop means the drop is on the host side (the reader isn't getting scheduled);
+##   a low one with gaps in the frame counter points at the link or the controller.  Reports that
+##   arrive during a probe's sleep are queued by the kernel, not lost.
+##########################################################################################################
+class WakeupLatencyTracker:
+    def __init__(self, interval_s=0.1, sleep_s=0.0005, recent_s=10):
+        self.interval_ns = int(interval_s * 1e9)
+        self.sleep_s = sleep_s
+        self.recent_ns = int(recent_s * 1e9)
+        self.next_probe_ns = 0
+
+        # 10 us bins up to 20 ms
+        self.histogram = InterArrivalHistogram(bin_width_us=10, num_bins=2000)
+
+        # (probe time ns, lateness ns) of the probes in the last recent_s
+        self.recent = collections.deque()
+
+    def probe(self, now_ns):
+        if now_ns < self.next_probe_ns:
+            return
+        self.next_probe_ns = now_ns + self.interval_ns
+
+        start = time.perf_counter_ns()
+        time.sleep(self.sleep_s)
+        late = max(0, time.perf_counter_ns() - start - int(self.sleep_s * 1e9))
+
+        self.histogram.add(late)
+        recent = self.recent
+        recent.append((now_ns, late))
+        while now_ns - recent[0][0] > self.recent_ns:
+            recent.popleft()
+
+    # Overshoot p50 / p99 / max in us since the tracker started, and the max over the last recent_s
+    def summary(self):
+        histogram = self.histogram
+        max_us = histogram.max_ns / 1000.
+        return {
+            'wakeup_probes': histogram.count,
+            'wakeup_p50_us': min(histogram.percentile(50), max_us),
+            'wakeup_p99_us': min(histogram.percentile(99), max_us),
+            'wakeup_max_us': max_us,
+            'wakeup_recent_max_us': max((late for (t, late) in list(self.recent)), default=0) / 1000.,
+        }
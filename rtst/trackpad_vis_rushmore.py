@@ -100,6 +100,9 @@ class TrackpadVis():
 
         self.last_packet_num = 0
 
+        # Complete Rushmore frames, read every tick
+        self.frame_cursor = cntrlr_mgr.new_rushmore_frame_cursor()
+
         self.rank =  8
         self.num_x = self.rank
         self.num_y = self.rank    
@@ -672,38 +675,33 @@ class TrackpadVis():
     ## Main Tick
     ############################################################################################################
     def tick( self ):
-        gotdata = False
         if self.cntrlr_mgr.is_open(): 
+            # Every frame assembled since the last tick, so the history and the log skip none.
+            frames = self.frame_cursor.read()
             for pad_num in range(self.num_pads):
-                device_data = self.cntrlr_mgr.get_data()
-
-                if not ('rushmore_raw_data') in device_data:
-                    continue
+                raw_values = None
+                for frame in frames:
+                    # Values come in reversed.
+                    raw_values = np.array( frame.values[::-1], dtype=np.float32)
+                    self.last_packet_num = frame.packet_num
+                    if self.logfile:
+                        self.logfile.write( 'packet_num, {0}, raw_vals, '.format( frame.packet_num ) )
+                
+                        for val in raw_values:
+                            self.logfile.write( '{0}, '.format( val ) )
+                        self.logfile.write( '\n' )
 
-                gotdata = True
-                # Values come in reversed.
-                raw_values = np.array( device_data['rushmore_raw_data'], dtype=np.float32)
-                raw_values = raw_values[::-1]
-                if self.logfile:
-                    self.logfile.write( 'raw_vals, ' )
-            
-                    for val in raw_values:
-                        self.logfile.write( '{0}, '.format( val ) )
+                    self.compute_collapsed_values(pad_num, raw_values)
+                    self.compute_total_mag(pad_num, raw_values)
+                    self.compute_pos(pad_num, raw_values)
+                    self.compute_z_corrected_val(pad_num, raw_values)
 
-                    self.last_packet_num = packet_num
-                    self.tick_job = self.root.after( self.args.tick, self.tick )        
-                    return
-            
-            if gotdata:
-                self.compute_collapsed_values(pad_num, raw_values)
-                self.compute_total_mag(pad_num, raw_values)
-                self.compute_pos(pad_num, raw_values)
-                self.compute_z_corrected_val(pad_num, raw_values)
+                    self.compute_finger_down(pad_num, raw_values)
 
-                self.compute_finger_down(pad_num, raw_values)
-            
+                if raw_values is None:
+                    continue
 
-                ## Drawing
+                ## Drawing, latest frame only
                 self.draw_grid(pad_num, raw_values)
                 self.draw_collapsed_xy(pad_num, raw_values)
                 self.draw_pos_dot(pad_num, raw_values)
@@ -711,7 +709,6 @@ class TrackpadVis():
                 self.draw_z_history_text(pad_num, raw_values)
                 self.draw_z_history_graph(pad_num, raw_values)
 
-                                      
         self.tick_job = self.root.after( self.args.tick, self.tick )        
 
 def key_cb( event ):
@@ -4,44 +4,12 @@ import logging
 import gzip
 from textwrap import dedent
 from loc_strings import loc_strings
+from button_events import button_masks, button_bit_fields
 
 highlight = False
 color_pallete = []
 debug_trails = 0
 
-button_masks = {
-    'trigger_right':			0x0000000000000001,
-    'trigger_left':				0x0000000000000002,
-    'bumper_right':				0x0000000000000004,
-    'bumper_left':				0x0000000000000008,
-    'y':						0x0000000000000010,
-    'b':						0x0000000000000020,
-    'x':						0x0000000000000040,
-    'a':						0x0000000000000080,
-    'up':						0x0000000000000100,
-    'right':					0x0000000000000200,
-    'left':						0x0000000000000400,
-    'down':						0x0000000000000800,
-    'select':					0x0000000000001000,
-    'steam':					0x0000000000002000,
-    'start':					0x0000000000004000,
-    'grip_left':				0x0000000000008000,
-    'grip_right':				0x0000000000010000,
-    'grip2_left':				0x0000000000000200,
-    'grip2_right':				0x0000000000000400,
-    'padclick_left':			0x0000000000020000,
-    'padclick_right':			0x0000000000040000,
-    'finger_present_left':		0x0000000000080000,
-    'finger_present_right':		0x0000000000100000,
-    'battery_low':				0x0000000000200000,
-    'thumbstick_left_button':	0x0000000000400000,
-    'thumbstick_right_button':	0x0000000004000000,
-
-# Below here are the button1 (32-bit upper bits) masks.
-    'thumbstick_left_touch':	0x00004000,
-    'thumbstick_right_touch':	0x00008000,	
-    'alt_guide':				0x00040000,
-    }
 
 ui_scale = 2
 ui_fonts = {
@@ -125,6 +93,15 @@ class UIRoot:
         self.canvas = canvas
         self.root = root
 
+        self.arrival_stats = {}
+        self.arrival_stats_time = 0
+
+        # Noise spectra, computed off the UI thread (see spectrum_analyzer.py).  The analysis is
+        # started by the first get_spectrum_peak(); None until then.
+        self.spectrum_enabled = None
+        self.spectrum = {}
+        self.spectrum_time = 0
+
         self.tick_job = self.root.after(self.tick_interval_ms, self.tick)
 
         ##########################################################################################################################################
@@ -216,30 +193,45 @@ class UIRoot:
                 self.get_loc_str('Missed Packets'),
                 self.get_loc_str('Avg. Missed/s'),
                 self.get_loc_str('Frame Rate'),
+                self.get_loc_str('Interval p50 (us)'),
+                self.get_loc_str('Interval p99 (us)'),
+                self.get_loc_str('Interval Max (us)'),
             ),
             "ranges" : (
                 (0, 256),
                 (0, (2 ** 32) - 1),
                 (0, 166),
                 (0, 40),
+                (0, 10000),
+                (0, 10000),
+                (0, 10000),
             ),
             "trigger_limits" : (
                 (0, 256),
                 (0, (2 ** 32) - 1),
                 (0, 166),
                 (0, 0),
+                (0, 0),
+                (0, 0),
+                (0, 0),
             ),
             "data_xform_funcs" : (
                 (lambda x: x % 256),
                 None,
                 None,
                 (lambda x: self.get_frame_rate()),
+                (lambda x: self.get_arrival_stat('p50_us')),
+                (lambda x: self.get_arrival_stat('p99_us')),
+                (lambda x: self.get_arrival_stat('max_us')),
             ),
             "data_fields" : (
                 'last_packet_num',
                 'missed_packets',
                 'missed_avg',
                 None,
+                None,
+                None,
+                None,
             )
         }
         
@@ -988,9 +980,41 @@ class UIRoot:
             )
         }
 
+        noise_spectrum_group = {
+            "title" : 'Noise Spectrum',
+            "type" : "TextWithLabels",
+            "labels" : (
+                'Pad X Left',
+                'Pad X Right',
+                'Trigger Left',
+                'Trigger Right',
+                'Accel',
+                'Gyro',
+            ),
+            "ranges" : None,
+            "trigger_limits" : None,
+            "data_xform_funcs" : (
+                (lambda x: self.get_spectrum_peak(('left_x',))),
+                (lambda x: self.get_spectrum_peak(('right_x',))),
+                (lambda x: self.get_spectrum_peak(('trigger_raw_left',))),
+                (lambda x: self.get_spectrum_peak(('trigger_raw_right',))),
+                (lambda x: self.get_spectrum_peak(('accel_x', 'accel_y', 'accel_z'))),
+                (lambda x: self.get_spectrum_peak(('gyro_x', 'gyro_y', 'gyro_z'))),
+            ),
+            "data_fields" : (
+                None,
+                None,
+                None,
+                None,
+                None,
+                None,
+            )
+        }
+
         self.ass_end_groups.append(device_control_group)
         self.ass_end_groups.append(trackpad_config_group)
         self.ass_end_groups.append(haptic_group)
+        self.ass_end_groups.append(noise_spectrum_group)
 
         ##########################################################################################################################################
 
@@ -1031,9 +1055,15 @@ class UIRoot:
         self.pressure_cal_current_step = 0 
         
         self.logfile = None
+        self.button_logfile = None
         self.log_compression = False
+        self.log_cursor = None
+        self.log_overflow = 0
         self.prev_packet_num = 0
 
+        # Every button edge, so presses shorter than a tick still light up and get logged
+        self.button_cursor = self.cntrlr_mgr.new_button_event_cursor()
+
         self.ticking = 0
         self.tick_count = 0
         self.tick_interval = 20
@@ -1120,11 +1150,33 @@ class UIRoot:
                     self.logger.info("Error: Couldn't open log file")
                     return
 
+            if self.log_compression:
+                self.button_logfile = gzip.open("jupiter_button_events.txt.gz", 'wt')
+            else:
+                self.button_logfile = open("jupiter_button_events.csv", 'w')
+            self.button_logfile.write("timestamp(ns), packet_num, button, pressed, duration(ns), duration(packets), bounce\n")
+
+            # Log every derived field too
+            self.log_fields = self.cntrlr_mgr.get_derived_field_names()
+            self.cntrlr_mgr.subscribe_fields(self.log_fields)
+
 #			// Hea for columns
+            # The columns are fixed here; fields a packet doesn't have (device_time_ns before the
+            # clock estimate settles, derived fields not computed yet) are written as empty cells.
             data = self.cntrlr_mgr.get_data()
+            data.pop('arrival_ns', None)
             sorted_keys = list(data.keys())
+            for entry in ['device_time_ns'] + list(self.log_fields):
+                if entry not in data:
+                    sorted_keys.append(entry)
 #			sorted_keys.sort()
+            self.log_columns = sorted_keys
             self.log_timestamp = True
+
+            # Log from a packet cursor so every packet is written, not just the one that
+            # happens to be current when the UI ticks.
+            self.log_cursor = self.cntrlr_mgr.new_packet_cursor()
+            self.log_overflow = 0
             
             if self.log_timestamp:
                 self.logfile.write("timestamp(ns), ")
@@ -1136,31 +1188,49 @@ class UIRoot:
         elif not state and self.logfile:
             self.logfile.close()
             self.logfile = None
+            self.button_logfile.close()
+            self.button_logfile = None
+            self.log_cursor = None
+            self.cntrlr_mgr.unsubscribe_fields(self.log_fields)
 
-    def log_data(self, data):
+    def log_data(self, data, button_events=()):
         if self.logfile is None:
             return False
-        if not data:
-            return True
 
-        # Check if we've come around too soon and the packet hasn't updated. If so, then ignore. 
+        for event in button_events:
+            self.button_logfile.write("{0}, {1}, {2}, {3}, {4}, {5}, {6}\n".format(
+                event.time_ns, event.packet_num, event.button, int(event.pressed),
+                event.duration_ns, event.duration_packets, int(event.bounce)))
+
+        # Write every packet decoded since the last tick, stamped with its arrival time.
         # Return True to indicate that we're still in logging state.
-        if data['last_packet_num'] == self.prev_packet_num:
-            return True
+        timestamp = time.monotonic_ns()
+        for packet in self.log_cursor.read():
+            self.log_packet(packet, packet.get('arrival_ns', timestamp))
+
+        if self.log_cursor.overflow != self.log_overflow:
+            self.logger.info('Logging fell behind, {} packets lost'.format(self.log_cursor.overflow - self.log_overflow))
+            self.log_overflow = self.log_cursor.overflow
+
+        return True
 
-        self.prev_packet_num = data['last_packet_num']
+    def log_packet(self, data, timestamp):
+        if not data:
+            return
+
+        self.prev_packet_num = data.get('last_packet_num')
 
-        sorted_keys = list(data.keys())
-#		sorted_keys.sort()
         if self.log_timestamp:
-            self.logfile.write("{0}, ".format(time.perf_counter_ns()))
-        for entry in sorted_keys:
-            if (entry == 'buttons_0' or entry == 'buttons_1'):
-                self.logfile.write("{0}, ".format("0x{:08x}".format(data[entry])))
+            self.logfile.write("{0}, ".format(timestamp))
+        for entry in self.log_columns:
+            value = data.get(entry)
+            if value is None:
+                self.logfile.write(", ")
+            elif (entry == 'buttons_0' or entry == 'buttons_1'):
+                self.logfile.write("{0}, ".format("0x{:08x}".format(value)))
             else:
-                self.logfile.write("{0}, ".format(data[entry]))
+                self.logfile.write("{0}, ".format(value))
         self.logfile.write('\n')
-        return True
 
     def get_thumbstick_cal_current_step(self):
         return self.thumbstick_cal_current_step
@@ -1349,6 +1419,41 @@ class UIRoot:
     def get_frame_rate(self):
         return self.get_trackpad_framerate()
 
+    # Inter-arrival stat of the controller state stream.  Refreshed at most every 250 ms since the
+    # percentiles walk the histogram.
+    def get_arrival_stat(self, key):
+        now = time.monotonic()
+        if now - self.arrival_stats_time > .25:
+            self.arrival_stats = self.cntrlr_mgr.get_state_arrival_stats() or {}
+            self.arrival_stats_time = now
+        return int(self.arrival_stats.get(key, 0))
+
+    # Strongest noise peak in the latest spectra of fields (the axes of one sensor), as
+    # '[axis] frequency, peak rms / total rms'.  Refreshed at most every 250 ms.
+    def get_spectrum_peak(self, fields):
+        if self.spectrum_enabled is None:
+            self.spectrum_enabled = self.cntrlr_mgr.start_spectrum_analysis()
+        if not self.spectrum_enabled:
+            return 'NumPy not installed'
+
+        now = time.monotonic()
+        if now - self.spectrum_time > .25:
+            self.spectrum = self.cntrlr_mgr.get_spectrum()
+            self.spectrum_time = now
+
+        best = None
+        for field in fields:
+            spectrum = self.spectrum.get('fields', {}).get(field)
+            if spectrum and spectrum['peaks'] and (best is None or spectrum['peaks'][0]['power'] > best[1]['peaks'][0]['power']):
+                best = (field, spectrum)
+        if best is None:
+            return '-'
+
+        (field, spectrum) = best
+        peak = spectrum['peaks'][0]
+        axis = field[-1].upper() + ' ' if len(fields) > 1 else ''
+        return '{}{:.1f} Hz  {:.1f} / {:.1f} rms'.format(axis, peak['freq_hz'], peak['rms'], spectrum['rms'])
+
     def conv_board_rev(self, unit):
         if unit == 1:
             hw_id = self.get_dev_info('hw_id')
@@ -1465,6 +1570,9 @@ class UIRoot:
     def create_ui(self):
         self.all_column_data = (self.far_left_groups, self.left_groups, self.middle_groups, self.right_groups, self.far_right_groups, self.ass_end_groups)
 
+        # Have the decoder compute the derived fields the groups show
+        self.cntrlr_mgr.subscribe_fields([field for column_data in self.all_column_data for group in column_data for field in group["data_fields"]])
+
         for column_data in self.all_column_data:
             new_column = GroupColumn(self.canvas)
 
@@ -1530,7 +1638,7 @@ class UIRoot:
         self.cntrlr_mgr.clear_data()
 
     def tick(self):
-        data = self.cntrlr_mgr.get_data()
+        data = self.cntrlr_mgr.get_data_view()
         if data == None:
             return
 
@@ -1539,7 +1647,9 @@ class UIRoot:
             self.tick_job = self.root.after(self.tick_interval_ms, self.tick)
             return
 
-        if not self.log_data(data):
+        button_events = self.button_cursor.read()
+        if not self.log_data(data, button_events):
+            data = self.latch_button_presses(data, button_events)
 
             group_column_list = zip(self.all_column_data, self.columns)
 
@@ -1573,6 +1683,21 @@ class UIRoot:
             
         self.tick_job = self.root.after(self.tick_interval_ms, self.tick)
 
+    # Show buttons pressed at any point since the last tick as pressed for this one
+    def latch_button_presses(self, data, button_events):
+        latched = {}
+        for event in button_events:
+            if event.pressed:
+                (field, mask) = button_bit_fields[event.button]
+                latched[field] = latched.get(field, 0) | mask
+        if not latched:
+            return data
+
+        data = dict(data)
+        for (field, mask) in latched.items():
+            data[field] = data.get(field, 0) | mask
+        return data
+
     def get_size(self):
         # add up the widths of the previous columns to set the origin for the next
         x_sum = 0
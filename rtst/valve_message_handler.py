@@ -3,8 +3,15 @@ import struct
 import copy
 import math
 import logging
-import statistics
+import threading
 import collections
+from time import monotonic_ns
+
+from running_stats import RunningWindowStats
+from rushmore_frames import RushmoreFrameAssembler
+from sequence_stats import SequenceStats
+from state_vector import StateLayout, StateVector, StateMapping
+from button_events import ButtonEventTracker
 
 __version__ = "$Revision: #32 $"
 __date__ = "$DateTime: 2022/06/29 11:08:41 $"
@@ -254,6 +261,57 @@ valve_messages = {
     ),
 }
 
+##########################################################################################################
+## Compiled message layouts
+##
+##   valve_messages compiled once at import: a struct.Struct per message type plus a namedtuple
+##   record type for its fields.  Decoding unpacks straight into a record (a plain tuple, fields by
+##   index or by name) and stores it into the fixed-layout state (see state_vector.py) without
+##   building a per-message dict; a record's _asdict() makes one only when a consumer asks for it.
+##########################################################################################################
+class MessageLayout:
+    __slots__ = ('msg_type', 'struct', 'field_names', 'field_index', 'record_type', 'state_slot')
+
+    def __init__(self, msg_type, msg_format, field_names):
+        self.msg_type = msg_type
+        self.struct = struct.Struct(msg_format)
+        self.field_names = tuple(field_names)
+        self.field_index = {name: i for i, name in enumerate(self.field_names)}
+        self.record_type = collections.namedtuple('ValveMessage{:02X}'.format(msg_type), self.field_names)
+
+        # Slot of this message type in a StateVector, set once state_layout is built
+        self.state_slot = None
+
+message_header = struct.Struct('1H2B')
+
+valve_message_layouts = {msg_type: MessageLayout(msg_type, msg_format, field_names)
+                         for msg_type, (msg_format, field_names) in valve_messages.items()}
+
+# Slot of every message type and stable index of every message field in the decoded state
+state_layout = StateLayout(list(valve_message_layouts.values()))
+for layout in valve_message_layouts.values():
+    layout.state_slot = state_layout.slot_index[layout.msg_type]
+
+battery_voltage_index = state_layout.field_index['battery_voltage']
+
+# Index of the frame counter in each message type's record.  Status (0x04) only repeats the state
+# stream's counter once a second, so it has none of its own.
+sequence_field_index = {}
+for (msg_type, layout) in valve_message_layouts.items():
+    for name in ('packet_num', 'last_packet_num', 'data_last_packet_num'):
+        if name in layout.field_index and msg_type != 0x04:
+            sequence_field_index[msg_type] = layout.field_index[name]
+            break
+
+# Message types whose records carry every one of the required fields
+def message_types_with(required):
+    return tuple(msg_type for msg_type, layout in valve_message_layouts.items()
+                 if all(field in layout.field_index for field in required))
+
+# Controller state messages; missed_packets and packet_error_rate describe these, and button
+# events come from their buttons_0 / buttons_1.
+state_message_types = (0x01, 0x08, 0x09)
+
 wireless_event_messages = ("Placeholder",
     "Disconnect (code 1)",
     "Connect (code 2)",
@@ -264,46 +322,220 @@ status_event_messages = ("Normal (code 0)",
     "Gyro init error (code 2)")
 
 class ValveMessageHandler:
+    # Message header (version, type, length) precedes the payload.
+    HEADER_SIZE = 4
+
+    # Reports are padded to this size before decoding.
+    RX_BUFFER_SIZE = 128
+
+    # Default stick deadzone for the dz_* fields
+    STICK_DEADZONE = 4000
+
     def __init__(self):
+        # Complete Rushmore debug frames assembled from 0x0C rowsets
+        self.rushmore_frames = RushmoreFrameAssembler()
+
+        # Press / release events from the button words of every state message
+        self.button_events = ButtonEventTracker()
+
         self.clear_data()
         self.logger = logging.getLogger('RTST.VMH')
 
-        self.history_index = 0
+        self.rx_buffer = bytearray(self.RX_BUFFER_SIZE)
+        self.rx_zero_pad = bytes(self.RX_BUFFER_SIZE)
+
         self.len_history = 128
         self.debug_history = 32
-        self.rushmore_raw_data = []
-        self.data_last_packet_num = 0 
-
-        self.stick_deadzone = 4000
+        # Record of the last message decoded (see valve_message_layouts)
+        self.last_record = None
 
-        self.l_x_history = collections.deque(maxlen = self.len_history)
-        self.l_y_history = collections.deque(maxlen = self.len_history)
-        self.r_x_history = collections.deque(maxlen = self.len_history)
-        self.r_y_history = collections.deque(maxlen = self.len_history)
+        self.stick_deadzone = self.STICK_DEADZONE
 
         self.left_debug_history = collections.deque(maxlen = self.debug_history)
         self.right_debug_history = collections.deque(maxlen = self.debug_history)
 
-
-        self.l_x_history.append(0)
-        self.l_y_history.append(0)
-        self.r_x_history.append(0)
-        self.r_y_history.append(0)        
-        self.l_x_history.append(0)
-        self.l_y_history.append(0)
-        self.r_x_history.append(0)
-        self.r_y_history.append(0)
+        # Derived fields, see declare_derived().  The tables the read thread uses are replaced,
+        # never modified, so declaring and subscribing are safe from any thread.
+        self.derived_fields = {}
+        self.field_subscriptions = collections.Counter()
+        self.subscription_lock = threading.Lock()
+        self.active_derivations = {}
+        self.active_derived_names = set()
+        self.stale_fields = ()
+
+        # Running noise statistics: field -> (RunningWindowStats, last_data key, log_scale)
+        self.noise_stats = {}
+
+        self.declare_derived('euler', ('roll', 'pitch', 'yaw'),
+                             ('gyro_quat_w', 'gyro_quat_x', 'gyro_quat_y', 'gyro_quat_z'), self.derive_euler)
+        self.declare_derived('stick_deadzone', ('dz_left_stick_x', 'dz_left_stick_y', 'dz_right_stick_x', 'dz_right_stick_y'),
+                             ('left_stick_x', 'left_stick_y', 'right_stick_x', 'right_stick_y'), self.derive_stick_deadzone)
+        self.declare_derived('rushmore_raw_data', ('rushmore_raw_data',),
+                             ('data_last_packet_num', 'rowset'), self.derive_rushmore_raw_data)
+
+        # Stick noise for the status display, log2 scaled
+        self.track_noise('left_x', 'l_x_stdev', log_scale=True)
+        self.track_noise('left_y', 'l_y_stdev', log_scale=True)
+        self.track_noise('right_x', 'r_x_stdev', log_scale=True)
+        self.track_noise('right_y', 'r_y_stdev', log_scale=True)
 
     def set_stick_deadzone(self, dz):
         self.stick_deadzone = dz
 
+    ##########################################################################################################
+    ## Derived fields
+    ##
+    ##   Fields computed from a message rather than read from it (Euler angles, deadzoned sticks,
+    ##   noise, the latest Rushmore frame).  Each is declared once with the message fields it needs and is only computed while
+    ##   a consumer (UI group, logger, TA2 client) has subscribed to one of its outputs.
+    ##   Subscriptions are reference counted per output field; an output nobody wants any more is
+    ##   dropped from last_data on the next packet.
+    ##########################################################################################################
+    # compute(layout, record, derived) stores the outputs in derived.  It runs for every message type
+    # that carries all the required fields.  Outputs can't reuse message field names.
+    def declare_derived(self, name, outputs, required, compute):
+        for field in outputs:
+            if field in state_layout.field_index:
+                raise ValueError('Derived field {} is a message field'.format(field))
+
+        msg_types = message_types_with(required)
+        with self.subscription_lock:
+            derived_fields = dict(self.derived_fields)
+            derived_fields[name] = (tuple(outputs), msg_types, compute)
+            self.derived_fields = derived_fields
+            self.update_active_derivations()
+
+    def undeclare_derived(self, name):
+        with self.subscription_lock:
+            derived_fields = dict(self.derived_fields)
+            removed = derived_fields.pop(name, None)
+            self.derived_fields = derived_fields
+            if removed and name in self.active_derived_names:
+                self.active_derived_names.discard(name)
+                self.stale_fields = tuple(set(self.stale_fields) | set(removed[0]))
+            self.update_active_derivations()
+
+    # Every output of every declared derived field
+    def get_derived_field_names(self):
+        return [field for (outputs, msg_types, compute) in self.derived_fields.values() for field in outputs]
+
+    # fields may name any data fields; only derived outputs affect decoding.
+    def subscribe_fields(self, fields):
+        with self.subscription_lock:
+            for field in fields:
+                self.field_subscriptions[field] += 1
+            self.stale_fields = tuple(set(self.stale_fields) - set(fields))
+            self.update_active_derivations()
+
+    def unsubscribe_fields(self, fields):
+        with self.subscription_lock:
+            for field in fields:
+                if self.field_subscriptions[field] <= 1:
+                    del self.field_subscriptions[field]
+                else:
+                    self.field_subscriptions[field] -= 1
+            self.update_active_derivations()
+
+    # Rebuild msg_type -> computes from the declarations and subscriptions, and mark the outputs of
+    # anything no longer computed as stale.  Caller holds subscription_lock.
+    def update_active_derivations(self):
+        active = {}
+        active_names = set()
+        stale = set(self.stale_fields)
+        for (name, (outputs, msg_types, compute)) in self.derived_fields.items():
+            if any(self.field_subscriptions.get(field) for field in outputs):
+                active_names.add(name)
+                for msg_type in msg_types:
+                    active.setdefault(msg_type, []).append(compute)
+            elif name in self.active_derived_names:
+                stale.update(outputs)
+
+        self.active_derived_names = active_names
+        self.stale_fields = tuple(stale)
+        self.active_derivations = {msg_type: tuple(computes) for msg_type, computes in active.items()}
+
+    def derive_euler(self, layout, record, derived):
+        q0 = record.gyro_quat_w / 32768.
+        q1 = record.gyro_quat_x / 32768.
+        q2 = record.gyro_quat_y / 32768.
+        q3 = record.gyro_quat_z / 32768.
+
+        (derived['roll'], derived['pitch'], derived['yaw']) = self.euler(q0, q1, q2, q3)
+
+    def derive_stick_deadzone(self, layout, record, derived):
+        dz_left_stick_x = record.left_stick_x
+        dz_left_stick_y = record.left_stick_y
+        dz_right_stick_x = record.right_stick_x
+        dz_right_stick_y = record.right_stick_y
+
+        # Deadzone applied.  Change True to False to disable RTST deadzoning of sticks
+        if True:
+            if dz_left_stick_x < self.stick_deadzone and dz_left_stick_x > -self.stick_deadzone and \
+                dz_left_stick_y < self.stick_deadzone and dz_left_stick_y > -self.stick_deadzone:
+                    dz_left_stick_x = 0
+                    dz_left_stick_y = 0
+
+            if dz_right_stick_x < self.stick_deadzone and dz_right_stick_x > -self.stick_deadzone and \
+                dz_right_stick_y < self.stick_deadzone and dz_right_stick_y > -self.stick_deadzone:
+                    dz_right_stick_x = 0
+                    dz_right_stick_y = 0
+
+        derived['dz_left_stick_x'] = dz_left_stick_x
+        derived['dz_left_stick_y'] = dz_left_stick_y
+        derived['dz_right_stick_x'] = dz_right_stick_x
+        derived['dz_right_stick_y'] = dz_right_stick_y
+
+    # Latest complete Rushmore frame as a list, for pollers and loggers.  Use
+    # new_rushmore_frame_cursor() to get every frame.
+    def derive_rushmore_raw_data(self, layout, record, derived):
+        if self.rushmore_frame:
+            derived['rushmore_raw_data'] = self.rushmore_frame.values.tolist()
+
+    # Declare last_data[key] (default field + '_stdev') as the standard deviation of field over the
+    # last window packets carrying it.  With log_scale the value is round(10 * log2(stdev + 1)), as
+    # shown for the sticks.  Like any derived field it's only computed while subscribed.  Returns key.
+    def track_noise(self, field, key=None, window=None, log_scale=False):
+        key = key or field + '_stdev'
+        stats = RunningWindowStats(window or self.len_history)
+
+        def derive_noise(layout, record, derived):
+            stats.add(record[layout.field_index[field]])
+            if len(stats.values) > 1:
+                stdev = stats.stdev()
+                derived[key] = round(math.log2(stdev + 1) * 10) if log_scale else stdev
+
+        noise_stats = dict(self.noise_stats)
+        noise_stats[field] = (stats, key, log_scale)
+        self.noise_stats = noise_stats
+        self.declare_derived('noise:' + field, (key,), (field,), derive_noise)
+        return key
+
+    def untrack_noise(self, field):
+        noise_stats = dict(self.noise_stats)
+        noise_stats.pop(field, None)
+        self.noise_stats = noise_stats
+        self.undeclare_derived('noise:' + field)
+
+    # {field: {'count', 'mean', 'stdev'}} for every tracked field
+    def get_noise_stats(self):
+        return {field: {'count': stats.count(), 'mean': stats.mean(), 'stdev': stats.stdev()}
+                for field, (stats, key, log_scale) in self.noise_stats.items()}
+
     def clear_data(self):
-        self.last_data = {}
-        self.first_packet_num = 0
-        self.last_packet_num = 0
-        self.first_read_count = 0
-        self.last_missed = 0
-        self.missed = []
+        # Decoded state, and the dict interface to it the handler returns
+        self.state = StateVector(state_layout)
+        self.last_data = StateMapping(self.state)
+
+        # Number of messages actually decoded (rejected / unknown messages don't count).
+        self.decoded_count = 0
+        self.sequence_stats = SequenceStats()
+
+        # Button words of the previous connection would turn into spurious edges
+        self.button_events.reset()
+
+        # Drop a partly assembled Rushmore frame; the frame the current message completed (or None)
+        self.rushmore_frames.reset()
+        self.rushmore_frame = None
 
     def euler(self, q0, q1, q2, q3):
         y = 2 * (q0 * q1 + q2 * q3)
@@ -324,192 +556,121 @@ class ValveMessageHandler:
 
         return (roll, pitch, yaw)
 
-    def __call__(self, data):
-        # Must be > 1 + header.
-        if len(data) < 5:
-            return self.last_data
-
+    def __call__(self, data, arrival_ns=None):
         # Data must be 64 bytes since the radio will not always send a full
         # state message, but Jupiter can send longer messages and needs
-        # more room.  Pad with zeros.
-
-        data += b'\0' * (128 - len(data))
+        # more room.  Pad with zeros into our own buffer.
+        length = min(len(data), self.RX_BUFFER_SIZE)
+        self.rx_buffer[:length] = data[:length]
+        self.rx_buffer[length:] = self.rx_zero_pad[length:]
+
+        return self.decode_from(self.rx_buffer, length, arrival_ns)
+
+    # Decode a report in place.  buf must be at least RX_BUFFER_SIZE bytes with everything past
+    # 'length' zeroed; the HID read thread passes its preallocated read buffer here directly so no
+    # per-packet copies are made.  arrival_ns (CLOCK_MONOTONIC) is when the report was read, used to
+    # time button events; decode time if not given.
+    def decode_from(self, buf, length, arrival_ns=None):
+        # Must be > 1 + header.
+        if length < 5:
+            return self.last_data
 
         # Parse the message header.
-        (msg_version, msg_type, msg_length) = struct.unpack('1H2B', data[0:4])
+        (msg_version, msg_type, msg_length) = message_header.unpack_from(buf, 0)
         if msg_version != 1:
             return self.last_data
 
-       # self.logger.info(":".join("{:02x}".format(ord(c)) for c in data[0:16]))
+       # self.logger.info(":".join("{:02x}".format(c) for c in buf[0:16]))
 
-        # The rest of the data is the payload.
-        data = data[4:]
-
-        # Get message parsing data for the message type.
-        msg_desc = valve_messages.get(msg_type)
-        if not msg_desc:
+        # Get the compiled layout for the message type.
+        layout = valve_message_layouts.get(msg_type)
+        if not layout:
             return self.last_data
 
-        (msg_format, msg_field_names) = msg_desc
-        msg_length = struct.calcsize(msg_format)
-
-        read_list = struct.unpack(msg_format, data[:msg_length])
-        result = {}
-        for i in range(len(msg_field_names)):
-            result[msg_field_names[i]] = read_list[i]
-
-        if msg_type == 1 or msg_type == 9:
-            q0 = result['gyro_quat_w'] / 32768.
-            q1 = result['gyro_quat_x'] / 32768.
-            q2 = result['gyro_quat_y'] / 32768.
-            q3 = result['gyro_quat_z'] / 32768.
-
-            (roll, pitch, yaw) = self.euler(q0, q1, q2, q3)
-
-            result['roll'] = roll
-            result['pitch'] = pitch
-            result['yaw'] = yaw
-
-            # The "thunk" noise isn't interesting for this analysis.  Ignore readings where it has popped back to zero zero.
-            #if result['left_x'] != 0: 
-            self.l_x_history.append(result['left_x'] )
-            #if result['left_y'] != 0: 
-            self.l_y_history.append(result['left_y'])
-            #if result['right_x'] != 0: 
-            self.r_x_history.append(result['right_x'] )
-            #if result['right_y'] != 0: 
-            self.r_y_history.append(result['right_y'])
-            
-            # The history index isn't necessary when using deques.  Remove?
-            self.history_index += 1
-            if self.history_index >= self.len_history / 8:
-                self.history_index = 0
-                result['l_x_stdev'] = round(math.log2(statistics.stdev(self.l_x_history)+1)*10)
-                result['l_y_stdev'] = round(math.log2(statistics.stdev(self.l_y_history)+1)*10)
-                result['r_x_stdev'] = round(math.log2(statistics.stdev(self.r_x_history)+1)*10)
-                result['r_y_stdev'] = round(math.log2(statistics.stdev(self.r_y_history)+1)*10)
-
-            result['dz_left_stick_x'] = result['left_stick_x']
-            result['dz_left_stick_y'] = result['left_stick_y']
-            result['dz_right_stick_x'] = result['right_stick_x']
-            result['dz_right_stick_y'] = result['right_stick_y']
-
-            # Deadzone applied.  Change True to False to disable RTST deadzoning of sticks
-            if True:
-                if result['dz_left_stick_x'] < self.stick_deadzone and result['dz_left_stick_x'] > -self.stick_deadzone and \
-                    result['dz_left_stick_y'] < self.stick_deadzone and result['dz_left_stick_y'] > -self.stick_deadzone:
-                        result['dz_left_stick_x'] = 0
-                        result['dz_left_stick_y'] = 0
-
-                if result['dz_right_stick_x'] < self.stick_deadzone and result['dz_right_stick_x'] > -self.stick_deadzone and \
-                    result['dz_right_stick_y'] < self.stick_deadzone and result['dz_right_stick_y'] > -self.stick_deadzone:
-                        result['dz_right_stick_x'] = 0
-                        result['dz_right_stick_y'] = 0
+        # The rest of the data is the payload.
+        record = layout.record_type._make(layout.struct.unpack_from(buf, self.HEADER_SIZE))
+        self.last_record = record
+
+        # Fields computed from the message, merged into last_data after the record
+        derived = {}
 
         if msg_type == 0x0C:
-            # Collect the next 24 16-bit values after the first 6 bytes.
+            # Rowset of 24 16-bit values after the first 6 bytes.
             offset = 6
-            values_to_collect = 24
-
-            raw_data = struct.unpack('24h',  data[offset:values_to_collect*2 + offset])
-
-            rowset = result['rowset']
-            if rowset == 0:
-                dl = result['sample_count']
-                self.data_last_packet_num = result['data_last_packet_num']
-                self.rushmore_raw_data[0:24] = raw_data
-            elif rowset == 1:
-                dl = result['sample_count']
-                if result['data_last_packet_num'] != self.data_last_packet_num:
-                    self.logger.error('Missed timing on Rushmore debug data')
-                self.rushmore_raw_data[24:48] = raw_data
-            elif rowset == 2:
-                dl = result['sample_count']
-                if result['data_last_packet_num'] != self.data_last_packet_num:
-                    self.logger.error('Missed timing on Rushmore debug data')
-                self.rushmore_raw_data[48:64] = raw_data
-
-                result['rushmore_raw_data'] = self.rushmore_raw_data[0:64]
 
-        # Filter out some bad results.
-        if 'battery_voltage' in result and result['battery_voltage'] == 0:
-            del result['battery_voltage']
+            frames = self.rushmore_frames
+            torn = frames.torn
+            self.rushmore_frame = frames.add_rowset(record.data_last_packet_num, record.rowset, buf, self.HEADER_SIZE + offset)
+            if frames.torn != torn:
+                self.logger.error('Missed timing on Rushmore debug data')
+
+        for compute in self.active_derivations.get(msg_type, ()):
+            compute(layout, record, derived)
 
         if msg_type == 3:
-            code = result['wireless_event']
+            code = record.wireless_event
             self.logger.info('Wireless Event:', wireless_event_messages[code])
-        elif msg_type == 4 and result['event_code']:
-            code = result['event_code']
+        elif msg_type == 4 and record.event_code:
+            code = record.event_code
             if code < len(status_event_messages):
                 self.logger.info('Event code:', status_event_messages[code])
             else:
                 self.logger.info('Unknown event code: ', hex(code))
 
-        self.update_last_data(msg_type, result)
-        self.update_missed_packets()
-
-        return self.last_data
-
-    def update_last_data(self, msg_type, new_data):
-        # merge new with old.
-        self.last_data.update(new_data)
-
-        # init read_count first time reading this device
-        if not 'read_count' in self.last_data:
-            self.last_data['read_count'] = 0
-        elif msg_type != 3:
-            self.last_data['read_count'] += 1
-
-    def update_missed_packets(self):
-        if 'last_packet_num' not in self.last_data:
-            return 0
-
-        if not self.last_packet_num:
-            self.total_packets = 0
-            self.index_per = 0
-            self.total_missed_per = [0, 0]
-            self.total_packets_per = [0, 0]
-            self.packet_per = 0.
-            self.last_packet_num = self.last_data['last_packet_num']
-            return 0
-
-        if self.last_packet_num != self.last_data['last_packet_num']:
-            num_packets = self.last_data['last_packet_num'] - self.last_packet_num
-
-            # Weird stuff sometimes happens, guard against them.
-            if num_packets < 0 or num_packets > 1000:
-                return 0
+        self.update_last_data(msg_type, layout, record, derived)
+        self.update_missed_packets(msg_type, record)
 
-            self.total_packets += num_packets
-            self.total_packets_per[0] += num_packets
-            self.total_packets_per[1] += num_packets
+        if msg_type in state_message_types:
+            self.button_events.update(record.buttons_0, record.buttons_1, record[sequence_field_index[msg_type]],
+                                      monotonic_ns() if arrival_ns is None else arrival_ns)
 
-            self.last_packet_num = self.last_data['last_packet_num']
-
-            if not self.first_packet_num:
-                self.first_packet_num = self.last_packet_num
-            if not self.first_read_count:
-                self.first_read_count = self.last_data['read_count']
+        return self.last_data
 
-            missed = self.last_packet_num - self.first_packet_num
-            missed -= self.last_data['read_count'] - self.first_read_count
-            self.last_data['missed_packets'] = missed
+    def update_last_data(self, msg_type, layout, record, derived):
+        # Store the record as this message type's latest.
+        state = self.state
+        self.decoded_count += 1
 
-            missed_step = missed - self.last_missed
-            self.total_missed_per[0] += missed_step
-            self.total_missed_per[1] += missed_step
-            self.last_missed = missed
+        # Filter out some bad results.
+        if 'battery_voltage' in layout.field_index and record.battery_voltage == 0:
+            record = record._replace(battery_voltage=state.value(battery_voltage_index))
 
-            per = float(self.total_missed_per[self.index_per])
-            per /= self.total_packets_per[self.index_per]
+        state.set_record(layout.state_slot, record, self.decoded_count)
 
-            self.packet_per += .01 * (per - self.packet_per)
+        extra = state.extra
+        extra.update(derived)
 
-            buffer_index = 1 - self.index_per
-            if self.total_packets_per[buffer_index] > 4000:
-                self.total_packets_per[self.index_per] = 0
-                self.total_missed_per[self.index_per] = 0
-                self.index_per = buffer_index
+        # Derived fields nobody subscribes to any more
+        if self.stale_fields:
+            (stale_fields, self.stale_fields) = (self.stale_fields, ())
+            for field in stale_fields:
+                extra.pop(field, None)
 
-            self.last_data['total_packets'] = self.total_packets
-            self.last_data['packet_error_rate'] = self.packet_per * 100.
+        # init read_count first time reading this device
+        if not 'read_count' in extra:
+            extra['read_count'] = 0
+        elif msg_type != 3:
+            extra['read_count'] += 1
+
+    # Track the frame counter of every message type that has one (see SequenceStats) and publish
+    # the state stream's loss as missed_packets / total_packets, and packet_error_rate (%) over the
+    # last 10 s.
+    def update_missed_packets(self, msg_type, record):
+        index = sequence_field_index.get(msg_type)
+        if index is None:
+            return
+
+        sequence_stats = self.sequence_stats
+        sequence_stats.add(msg_type, record[index], monotonic_ns())
+
+        if msg_type in state_message_types:
+            tracker = sequence_stats.trackers[msg_type]
+            extra = self.state.extra
+            extra['missed_packets'] = tracker.lost
+            extra['total_packets'] = tracker.expected
+            extra['packet_error_rate'] = tracker.recent_loss_pct
+
+    # {msg_type: {'received', 'expected', 'lost', 'loss_pct', 'loss_1s_pct', 'loss_10s_pct',
+    # 'loss_60s_pct', 'longest_gap', 'bursts', 'bursts_per_min', 'gap_histogram', ...}}
+    def get_sequence_stats(self):
+        return self.sequence_stats.get_stats()
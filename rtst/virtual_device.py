@@ -0,0 +1,267 @@
+import math
+import time
+import struct
+import random
+import collections
+import logging
+
+from valve_message_handler import valve_messages
+from feature_emulator import FeatureReportEmulator
+
+##########################################################################################################
+## Virtual controller
+##
+##   Synthesizes a Jupiter input report stream for exercising the host stack without hardware.
+##   Reports use the valve_messages layouts: 0x09 controller state every frame, 0x04 status once a
+##   second, and optionally 0x0A / 0x0B trackpad debug and 0x0C Rushmore rowsets.  All signals are
+##   computed from the frame number and a seeded RNG, so two runs with the same settings produce
+##   the same report stream (only the wall-clock pacing differs).
+##
+##   VirtualBackend has the same enumerate() / open() shape as the hidapi and hidraw backends in
+##   hid_dev_mgr.py, so it plugs into HidDeviceManager with backend='virtual' (or a configured
+##   VirtualBackend object).
+##########################################################################################################
+
+REPORT_SIZE = 64
+MSG_VERSION = 1
+
+# Controller frames the real device buffers when the host falls behind before it drops the oldest.
+# Matches the kernel's hidraw queue depth.
+QUEUE_DEPTH = 64
+
+class VirtualControllerDevice:
+    STICK_AMPLITUDE = 30000
+    TRIGGER_MAX = 32767
+
+    def __init__(self, rate_hz=1000, loss=0.0, seed=0, debug=False, rushmore=False, rushmore_divider=4, feature_emulator=None):
+        self.logger = logging.getLogger('RTST.VIRTUAL')
+
+        self.rate_hz = rate_hz
+        self.frame_period = 1. / rate_hz
+        self.loss = loss
+        self.debug = debug
+        self.rushmore = rushmore
+        self.rushmore_divider = rushmore_divider
+
+        self.rng = random.Random(seed)
+        self.state_format = '=HBB' + valve_messages[0x09][0]
+        self.status_format = '=HBB' + valve_messages[0x04][0]
+        self.debug_format = '=HBB' + valve_messages[0x0A][0]
+        self.rowset_format = '=HBB' + valve_messages[0x0C][0] + '24h'
+
+        # Random-walk IMU state
+        self.accel = [0, 0, 16384]
+        self.gyro = [0, 0, 0]
+
+        self.frame = 0
+        self.start_time = None
+        self.pending = collections.deque()
+
+        self.frames_sent = 0
+        self.frames_lost = 0
+        self.frames_overrun = 0
+
+        # Answers feature report commands
+        self.feature_emulator = feature_emulator or FeatureReportEmulator(frame_interval_us=int(1e6 / rate_hz))
+        self.closed = False
+
+    ##########################################################################################################
+    ## Device interface (same as HidapiDevice / HidrawDevice)
+    ##########################################################################################################
+    # Copy the next report into buffer and return its length.  Waits for the next frame time;
+    # timeout_ms=None waits as long as needed, otherwise 0 is returned if nothing is due in time.
+    def readinto(self, buffer, size, timeout_ms=None):
+        report = self.next_report(timeout_ms)
+        if not report:
+            return 0
+
+        length = min(size, len(report))
+        buffer[:length] = report[:length]
+        return length
+
+    def read(self, size, timeout=None):
+        report = self.next_report(timeout)
+        return report[:size] if report else b''
+
+    def send_feature_report(self, data):
+        if self.closed:
+            raise OSError('Virtual device closed')
+        return self.feature_emulator.send_feature_report(data)
+
+    def get_feature_report(self, report_id, size):
+        if self.closed:
+            raise OSError('Virtual device closed')
+        return self.feature_emulator.get_feature_report(report_id, size)
+
+    def close(self):
+        self.closed = True
+
+    ##########################################################################################################
+    ## Report generation
+    ##########################################################################################################
+    def next_report(self, timeout_ms):
+        if self.closed:
+            raise OSError('Virtual device closed')
+
+        if self.pending:
+            return self.pending.popleft()
+
+        now = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = now
+
+        due = self.start_time + self.frame * self.frame_period
+        wait = due - now
+        if wait > 0:
+            if timeout_ms is not None and wait > timeout_ms / 1000.:
+                time.sleep(timeout_ms / 1000.)
+                return None
+            time.sleep(wait)
+        else:
+            # A real controller keeps producing frames when the host stops reading and the oldest
+            # ones fall out of the queue.
+            behind = int(-wait / self.frame_period)
+            if behind > QUEUE_DEPTH:
+                skipped = behind - QUEUE_DEPTH
+                self.frames_overrun += skipped
+                for i in range(skipped):
+                    self.advance_signals()
+                self.frame += skipped
+
+        self.generate_frame()
+        return self.pending.popleft() if self.pending else None
+
+    # Queue every report belonging to the current frame and move to the next one.
+    def generate_frame(self):
+        frame = self.frame
+        self.frame += 1
+        self.advance_signals()
+
+        if self.loss and self.rng.random() < self.loss:
+            self.frames_lost += 1
+        else:
+            self.pending.append(self.state_report(frame))
+            self.frames_sent += 1
+
+        if frame % self.rate_hz == 0:
+            self.pending.append(self.status_report(frame))
+
+        if self.debug:
+            self.pending.append(self.debug_report(frame, 0x0A if frame & 1 else 0x0B))
+
+        if self.rushmore and frame % self.rushmore_divider == 0:
+            for rowset in range(3):
+                self.pending.append(self.rowset_report(frame, rowset))
+
+    def advance_signals(self):
+        rng = self.rng
+        for i in range(3):
+            self.accel[i] = max(-32768, min(32767, self.accel[i] + rng.randint(-64, 64)))
+            self.gyro[i] = max(-32768, min(32767, int(self.gyro[i] * 0.99) + rng.randint(-32, 32)))
+
+    def pack_report(self, fmt, msg_type, *values):
+        report = struct.pack(fmt, MSG_VERSION, msg_type, struct.calcsize(fmt) - 4, *values)
+        return report + bytes(REPORT_SIZE - len(report))
+
+    def state_report(self, frame):
+        t = frame * self.frame_period
+        a = self.STICK_AMPLITUDE
+
+        # Left stick circles at 0.5 Hz, right stick traces a 1:2 Lissajous figure.
+        left_x = int(a * math.sin(2 * math.pi * 0.5 * t))
+        left_y = int(a * math.cos(2 * math.pi * 0.5 * t))
+        right_x = int(a * math.sin(2 * math.pi * 0.25 * t))
+        right_y = int(a * math.sin(2 * math.pi * 0.5 * t))
+
+        # Triggers ramp up and down once a second, out of phase.
+        phase = (t % 1.)
+        trigger_left = int(self.TRIGGER_MAX * (1. - abs(2 * phase - 1.)))
+        trigger_right = self.TRIGGER_MAX - trigger_left
+
+        # Slow yaw rotation for the quaternion
+        angle = 2 * math.pi * 0.1 * t
+        quat_w = int(32767 * math.cos(angle / 2))
+        quat_z = int(32767 * math.sin(angle / 2))
+
+        # Walk one button bit per half second.
+        buttons_0 = 1 << (int(t * 2) % 32)
+        buttons_1 = 0
+
+        return self.pack_report(self.state_format, 0x09,
+            frame & 0xFFFFFFFF, buttons_0, buttons_1,
+            left_x, left_y, right_x, right_y,
+            self.accel[0], self.accel[1], self.accel[2],
+            self.gyro[0], self.gyro[1], self.gyro[2],
+            quat_w, 0, 0, quat_z,
+            trigger_left, trigger_right,
+            left_x, left_y, right_x, right_y,
+            trigger_left >> 4, trigger_right >> 4,
+            0, 0)
+
+    def status_report(self, frame):
+        return self.pack_report(self.status_format, 0x04, frame & 0xFFFFFFFF, 0, 0, 8000, 100, 0)
+
+    def debug_report(self, frame, msg_type):
+        values = [int(1000 * math.sin(frame * 0.01 + i)) for i in range(18)]
+        return self.pack_report(self.debug_format, msg_type, frame & 0xFFFFFFFF, frame & 1, 0, 0, 0, *values)
+
+    def rowset_report(self, frame, rowset):
+        base = rowset * 24
+        values = [int(500 * math.sin(frame * 0.05 + (base + i) * 0.2)) for i in range(24)]
+        return self.pack_report(self.rowset_format, 0x0C, frame & 0xFFFFFFFF, rowset, 1, *values)
+
+##########################################################################################################
+## Virtual backend
+##########################################################################################################
+class VirtualBackend:
+    name = 'virtual'
+
+    # Opening a virtual device can't fail.
+    open_errors = ()
+
+    # Enumerates as a wired Jupiter.
+    VENDOR_ID = 0x28DE
+    PRODUCT_ID = 0x1205
+
+    # count > 1 enumerates several virtual controllers (e.g. for MultiHidDeviceManager).
+    # feature_latency_s and store_path configure each controller's FeatureReportEmulator; with
+    # store_path, controller N keeps its settings and calibration in store_path.N.
+    def __init__(self, rate_hz=1000, loss=0.0, seed=0, debug=False, rushmore=False, count=1, feature_latency_s=0.0, store_path=None):
+        self.rate_hz = rate_hz
+        self.loss = loss
+        self.seed = seed
+        self.debug = debug
+        self.rushmore = rushmore
+        self.count = count
+        self.feature_latency_s = feature_latency_s
+        self.store_path = store_path
+
+        # One emulator per controller, kept across re-opens so settings survive a restart()
+        self.feature_emulators = {}
+
+    def enumerate(self, vid=0, pid=0):
+        if (vid and vid != self.VENDOR_ID) or (pid and pid != self.PRODUCT_ID):
+            return []
+
+        return [{
+            'path': 'virtual:{}'.format(i).encode(),
+            'vendor_id': self.VENDOR_ID,
+            'product_id': self.PRODUCT_ID,
+            'serial_number': 'VIRTUAL{:04d}'.format(i),
+            'product_string': 'Virtual Controller',
+            'interface_number': 2,
+            'usage_page': 0xFF00,
+        } for i in range(self.count)]
+
+    def open(self, path):
+        index = int(path.decode().split(':')[1])
+
+        emulator = self.feature_emulators.get(index)
+        if not emulator:
+            store_path = '{}.{}'.format(self.store_path, index) if self.store_path else None
+            emulator = FeatureReportEmulator(self.feature_latency_s, store_path, self.PRODUCT_ID,
+                                             'VIRTUAL{:04d}'.format(index), int(1e6 / self.rate_hz))
+            self.feature_emulators[index] = emulator
+
+        return VirtualControllerDevice(self.rate_hz, self.loss, self.seed + index, self.debug, self.rushmore,
+                                       feature_emulator=emulator)